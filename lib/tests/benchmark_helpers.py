@@ -0,0 +1,136 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+import importlib
+import importlib.util
+import logging
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+# ********************************************************************************************************************
+# Shared pieces of the wal_writer and tsc_generator benchmarks (wal_writer/test/benchmark.py and
+# tsc_generator/test/benchmark.py). Both run their service's main module in process against a throwaway sqlite dataset
+# configured from deploy/config_example.yaml.
+# ********************************************************************************************************************
+
+REPO_DIR = Path(__file__).resolve().parents[2]
+CONFIG_EXAMPLE = REPO_DIR / "deploy" / "config_example.yaml"
+REQUIREMENTS = REPO_DIR / "requirements.txt"
+
+
+class StageTimer:
+    """Collects how long each call to a wrapped function took, grouped by stage."""
+
+    def __init__(self):
+        self.times = {}
+
+    def wrap(self, stage: str, func):
+        samples = self.times.setdefault(stage, [])
+
+        if asyncio.iscoroutinefunction(func):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    samples.append(time.perf_counter() - start)
+        return timed
+
+    def add(self, stage: str, seconds: float):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def totals(self) -> dict:
+        return {stage: sum(samples) for stage, samples in self.times.items()}
+
+    def clear(self):
+        # the wrapped functions keep appending to the same lists so they are emptied instead of replaced
+        for samples in self.times.values():
+            samples.clear()
+
+    def report(self, stages=None):
+        for stage in stages or self.times:
+            samples = self.times.get(stage)
+            if not samples:
+                continue
+            samples_ms = np.array(samples) * 1000
+            print("  {:<11} n={:<8} total={:>9.3f}s  p50={:.3f}ms  p99={:.3f}ms  mean={:.3f}ms".format(
+                stage, samples_ms.size, samples_ms.sum() / 1000, np.percentile(samples_ms, 50),
+                np.percentile(samples_ms, 99), samples_ms.mean()))
+
+
+def write_config(config_dir: Path, dataset_location: Path, sections: dict):
+    """
+    Writes config.yaml and an empty secrets.yaml to config_dir from deploy/config_example.yaml with the metadata going
+    to a sqlite database in dataset_location. sections is merged into the config's sections, for example
+    {'svc_wal_writer': {'wal_folder_path': ...}}.
+    """
+    with open(CONFIG_EXAMPLE, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+
+    cfg['loglevel'] = "warning"
+    cfg['dataset_location'] = str(dataset_location)
+    cfg['bench_metadb'] = {'type': "sqlite", 'username': "", 'password': ""}
+    for section, values in sections.items():
+        cfg[section].update(values)
+
+    with open(config_dir / "config.yaml", 'w') as f:
+        yaml.dump(cfg, f)
+    with open(config_dir / "secrets.yaml", 'w') as f:
+        yaml.dump({}, f)
+
+
+def import_service_main(service_dir: Path, config_env: str, config_dir: Path, required_modules):
+    """
+    Imports a service's main module with its config loaded from config_dir. The services export metrics with open
+    telemetry and talk to their queues and databases through their own client libraries, so the service's requirements
+    have to be installed (pip install -r requirements.txt), this exits with a message saying what's missing if they
+    aren't.
+    """
+    missing = [module for module in required_modules if importlib.util.find_spec(module) is None]
+    if missing:
+        sys.exit("The benchmark needs {} installed, install the service requirements with: pip install -r {}".format(
+            ", ".join(missing), REQUIREMENTS))
+
+    # the config is loaded when the service's config module is imported so this has to be set before importing main
+    os.environ[config_env] = str(config_dir)
+    sys.path.insert(0, str(service_dir))
+    # there is no collector to send metrics to
+    logging.getLogger("opentelemetry").setLevel(logging.ERROR)
+    return importlib.import_module("main")
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
@@ -0,0 +1,102 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import unittest
+import time
+import numpy as np
+
+from wal.io.data import NANO
+from wal.io.enums import ValueMode, ValueType, ScaleType
+from wal.io.header_structure import WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR
+from wal.io.reader import WALReader
+from wal.io.writer import WALWriter
+from wal.io.recovery import repair_file
+from tests.wal_data_generator import generate_test_data
+
+
+class TestRecovery(unittest.TestCase):
+
+    def test_repair_time_value_pairs(self):
+        self._test_repair(ValueMode.TIME_VALUE_PAIRS.value, samples_per_message=1)
+
+    def test_repair_intervals(self):
+        self._test_repair(ValueMode.INTERVALS.value, samples_per_message=256)
+
+    def test_repair_intervals_line_by_line(self):
+        self._test_repair(ValueMode.INTERVALS.value, samples_per_message=0)
+
+    def test_repair_compressed(self):
+        self._test_repair(ValueMode.INTERVALS.value, samples_per_message=0, frame_size=8, flags=WAL_FLAG_ZSTD)
+
+    def test_repair_columnar(self):
+        self._test_repair(ValueMode.INTERVALS.value, samples_per_message=0, frame_size=8, flags=WAL_FLAG_COLUMNAR)
+        self._test_repair(ValueMode.TIME_VALUE_PAIRS.value, samples_per_message=1, frame_size=8,
+                          flags=WAL_FLAG_COLUMNAR)
+
+    def _test_repair(self, mode, samples_per_message, frame_size=None, flags=0):
+        num_messages = 100
+        message_length = 1 if mode == ValueMode.TIME_VALUE_PAIRS.value else max(samples_per_message, 100)
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['INT32'].value, num_messages, mode, 500 * NANO,
+                               message_length, np.array([12.0, 0.0012, 0.0, 0.0], dtype=np.dtype("<f8")),
+                               ScaleType.LINEAR.value, int(time.time()) * NANO, ValueType['FLOAT64'].value,
+                               1 if frame_size is None else 2, bytes("MDC_RESP", 'utf-8'),
+                               bytes("MDC_DIM_X_OHM", 'utf-8'))
+        header_dict['samples_per_message'] = samples_per_message
+        if frame_size is not None:
+            header_dict['flags'] = flags
+            header_dict['frame_size'] = frame_size
+
+        writer = WALWriter.from_metadata(".", header_dict)
+        filename = writer.filename
+        writer.write_header(header_dict)
+        for message_i in range(num_messages):
+            if mode == ValueMode.TIME_VALUE_PAIRS.value:
+                writer.write_time_value_pair_message(int(times[message_i]), int(server_times[message_i]),
+                                                     values[message_i])
+            else:
+                start = message_i * message_length
+                writer.write_interval_message(int(times[start]), int(server_times[start]),
+                                              values[start:start + message_length])
+        writer.close()
+        complete_size = os.path.getsize(filename)
+
+        # a file with nothing wrong with it shouldn't be touched
+        self.assertEqual(0, repair_file(filename))
+        self.assertEqual(complete_size, os.path.getsize(filename))
+
+        # simulate a crash part way through writing the next message
+        with open(filename, 'ab') as f:
+            f.write(b'\x01' * 13)
+
+        self.assertEqual(13, repair_file(filename))
+        self.assertEqual(complete_size, os.path.getsize(filename))
+
+        data = WALReader(filename).read_all()
+        os.remove(filename)
+        data.interpret_byte_array()
+        self.assertEqual(num_messages, len(data.time_data))
+
+
+if __name__ == '__main__':
+    unittest.main()
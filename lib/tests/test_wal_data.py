@@ -182,6 +182,54 @@ class TestWALData(unittest.TestCase):
 
                 wal_data_incremental_write_read_arr[wal_i] = incremental_read_wal_data
 
+    def test_copy_views(self):
+        for enum_mode in list(ValueMode):
+            wal_data = generate_wal_data_arr(enum_mode.value, 10 ** 3, 1)[0]
+            wal_data.prepare_byte_array()
+            original = WALData(byte_arr=wal_data.byte_arr.copy())
+            original.interpret_byte_array()
+
+            # the copy gets its own byte_arr and the columns are views of it instead of separate copies
+            wal_data_copy = original.copy()
+            self.assertTrue(wal_data_copy == original)
+            for column in (wal_data_copy.data, wal_data_copy.time_data, wal_data_copy.value_data):
+                self.assertTrue(np.shares_memory(column, wal_data_copy.byte_arr))
+                self.assertFalse(np.shares_memory(column, original.byte_arr))
+
+            wal_data_copy.time_data[0] += 1
+            self.assertEqual(wal_data_copy.data[0][0], original.time_data[0] + 1)
+            self.assertFalse(np.array_equal(wal_data_copy.time_data, original.time_data))
+
+            # a snapshot shares the original's buffers but can't write to them
+            snapshot = original.copy(snapshot=True)
+            self.assertTrue(np.shares_memory(snapshot.time_data, original.byte_arr))
+            self.assertTrue(np.array_equal(snapshot.value_data, original.value_data))
+            with self.assertRaises(ValueError):
+                snapshot.time_data[0] += 1
+
+    def test_interpret_parallel(self):
+        num_messages = 10 ** 3
+        for enum_mode in list(ValueMode):
+            for wal_data in generate_wal_data_arr(enum_mode.value, num_messages, 5):
+                # also check the variable size interval layout and files that were cut off part way through a message
+                readline_copy = wal_data.copy()
+                readline_copy.header.samples_per_message = 0
+                for source in (wal_data, readline_copy):
+                    source.prepare_byte_array()
+                    for cut in (0, 1, 7):
+                        byte_arr = source.byte_arr[:source.byte_arr.size - cut]
+                        serial = WALData(byte_arr=byte_arr)
+                        serial.interpret_byte_array()
+                        parallel = WALData(byte_arr=byte_arr)
+                        parallel.interpret_parallel(4)
+
+                        for attr in ("time_data", "server_time_data", "value_data", "message_sizes", "null_offsets"):
+                            serial_column, parallel_column = getattr(serial, attr), getattr(parallel, attr)
+                            self.assertEqual(serial_column is None, parallel_column is None)
+                            if serial_column is not None:
+                                self.assertTrue(np.array_equal(serial_column, parallel_column), attr)
+                                self.assertEqual(serial_column.dtype, parallel_column.dtype)
+
     @staticmethod
     def _generate_wal_data_matrix(mode, num_messages, wal_matrix_size):
         headers = [generate_random_header_dict(mode=mode) for _ in range(wal_matrix_size)]
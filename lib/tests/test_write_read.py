@@ -29,6 +29,7 @@ from wal.io.data import NANO, WALData
 from wal.io.enums import ValueMode, ValueType, ScaleType
 from wal.io.reader import WALReader
 from wal.io.writer import WALWriter
+from wal.io.header_structure import WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR
 from tests.wal_data_generator import generate_test_data
 
 
@@ -149,6 +150,230 @@ class TestNData(unittest.TestCase):
         self.assertTrue(np.array_equal(v, data.value_data), "values num messages {} - Arr: {} - Dtype: {}".format(
             num_messages, data.value_data, data.value_data.dtype))
 
+    def test_append(self):
+        num_messages = 100
+        samples_per_message = 256
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['INT32'].value, num_messages,
+                               ValueMode.INTERVALS.value, 500 * NANO, samples_per_message,
+                               np.array([12.0, 0.0012, 0.0, 0.0], dtype=np.dtype("<f8")), ScaleType.LINEAR.value,
+                               int(time.time()) * NANO, ValueType['FLOAT64'].value, 1, bytes("MDC_RESP", 'utf-8'),
+                               bytes("MDC_DIM_X_OHM", 'utf-8'))
+        t = times[::samples_per_message]
+        s_t = server_times[::samples_per_message]
+        v = values.reshape((num_messages, samples_per_message))
+
+        # write the first half, close the file, then reopen it in append mode and write the rest
+        writer = WALWriter.from_metadata(".", header_dict)
+        filename = writer.filename
+        writer.write_header(header_dict)
+        for message_i in range(num_messages // 2):
+            writer.write_interval_message(int(t[message_i]), int(s_t[message_i]), v[message_i])
+        writer.close()
+
+        writer = WALWriter(".", os.path.basename(filename), append=True)
+        writer.load_header(header_dict)
+        for message_i in range(num_messages // 2, num_messages):
+            writer.write_interval_message(int(t[message_i]), int(s_t[message_i]), v[message_i])
+        writer.close()
+
+        data = WALReader(filename).read_all()
+        os.remove(filename)
+        data.interpret_byte_array()
+
+        self.assertTrue(np.array_equal(t, data.time_data))
+        self.assertTrue(np.array_equal(s_t, data.server_time_data))
+        self.assertTrue(np.array_equal(v, data.value_data))
+
+    def test_compressed(self):
+        num_messages = 100
+        samples_per_message = 256
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['INT32'].value, num_messages,
+                               ValueMode.INTERVALS.value, 500 * NANO, samples_per_message,
+                               np.array([12.0, 0.0012, 0.0, 0.0], dtype=np.dtype("<f8")), ScaleType.LINEAR.value,
+                               int(time.time()) * NANO, ValueType['FLOAT64'].value, 2, bytes("MDC_RESP", 'utf-8'),
+                               bytes("MDC_DIM_X_OHM", 'utf-8'))
+        header_dict['flags'] = WAL_FLAG_ZSTD
+        header_dict['frame_size'] = 8
+        t = times[::samples_per_message]
+        s_t = server_times[::samples_per_message]
+        v = values.reshape((num_messages, samples_per_message))
+
+        writer = WALWriter.from_metadata(".", header_dict)
+        filename = writer.filename
+        writer.write_header(header_dict)
+        for message_i in range(num_messages):
+            writer.write_interval_message(int(t[message_i]), int(s_t[message_i]), v[message_i])
+        writer.close()
+
+        data = WALReader(filename).read_all()
+        data.interpret_byte_array()
+        self.assertTrue(np.array_equal(t, data.time_data))
+        self.assertTrue(np.array_equal(s_t, data.server_time_data))
+        self.assertTrue(np.array_equal(v, data.value_data))
+
+        # the frames can also be decompressed in parallel
+        data = WALReader(filename).read_all()
+        data.interpret_parallel(4)
+        self.assertTrue(np.array_equal(t, data.time_data))
+        self.assertTrue(np.array_equal(v, data.value_data))
+
+        # cut the file off part way through the last frame, only the messages in that frame should be lost
+        with open(filename, 'r+b') as f:
+            f.truncate(os.path.getsize(filename) - 10)
+
+        data = WALReader(filename).read_all()
+        os.remove(filename)
+        data.interpret_byte_array()
+        num_complete = (num_messages // 8) * 8
+        self.assertTrue(np.array_equal(t[:num_complete], data.time_data))
+        self.assertTrue(np.array_equal(v[:num_complete], data.value_data))
+
+    def test_compressed_frame_callbacks(self):
+        num_messages = 3
+        samples_per_message = 256
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['INT32'].value, num_messages,
+                               ValueMode.INTERVALS.value, 500 * NANO, samples_per_message,
+                               np.array([12.0, 0.0012, 0.0, 0.0], dtype=np.dtype("<f8")), ScaleType.LINEAR.value,
+                               int(time.time()) * NANO, ValueType['FLOAT64'].value, 2, bytes("MDC_RESP", 'utf-8'),
+                               bytes("MDC_DIM_X_OHM", 'utf-8'))
+        header_dict['flags'] = WAL_FLAG_ZSTD
+        header_dict['frame_size'] = 8
+        t = times[::samples_per_message]
+        s_t = server_times[::samples_per_message]
+        v = values.reshape((num_messages, samples_per_message))
+
+        writer = WALWriter.from_metadata(".", header_dict)
+        filename = writer.filename
+        writer.write_header(header_dict)
+        self.assertEqual(writer.frame_age(), 0)
+
+        written = []
+        for message_i in range(num_messages):
+            writer.write_interval_message(int(t[message_i]), int(s_t[message_i]), v[message_i],
+                                          on_written=written.append)
+        # the frame isn't full so nothing is on disk yet
+        self.assertEqual(written, [])
+        self.assertGreater(writer.frame_age(), 0)
+
+        # a partial frame can be written early and its messages are reported as written
+        writer.write_frame()
+        self.assertEqual(written, [None] * num_messages)
+        self.assertEqual(writer.frame_age(), 0)
+
+        data = WALReader(filename).read_all()
+        data.interpret_byte_array()
+        self.assertTrue(np.array_equal(t, data.time_data))
+        self.assertTrue(np.array_equal(v, data.value_data))
+
+        # if the frame can't be written its messages get the error instead
+        failed = []
+        writer.write_interval_message(int(t[0]), int(s_t[0]), v[0], on_written=failed.append)
+        writer.current_file_pointer.close()
+        with self.assertRaises(ValueError):
+            writer.write_frame()
+        os.remove(filename)
+        self.assertEqual(len(failed), 1)
+        self.assertIsInstance(failed[0], ValueError)
+        self.assertEqual(writer.frame_age(), 0)
+
+    def test_columnar(self):
+        num_messages = 100
+        samples_per_message = 256
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['INT32'].value, num_messages,
+                               ValueMode.INTERVALS.value, 500 * NANO, samples_per_message,
+                               np.array([12.0, 0.0012, 0.0, 0.0], dtype=np.dtype("<f8")), ScaleType.LINEAR.value,
+                               int(time.time()) * NANO, ValueType['FLOAT64'].value, 2, bytes("MDC_RESP", 'utf-8'),
+                               bytes("MDC_DIM_X_OHM", 'utf-8'))
+        header_dict['samples_per_message'] = 0
+        header_dict['flags'] = WAL_FLAG_COLUMNAR
+        header_dict['frame_size'] = 8
+        t = times[::samples_per_message]
+        s_t = server_times[::samples_per_message]
+        v = values.reshape((num_messages, samples_per_message))
+
+        writer = WALWriter.from_metadata(".", header_dict)
+        filename = writer.filename
+        writer.write_header(header_dict)
+        for message_i in range(num_messages):
+            writer.write_interval_message(int(t[message_i]), int(s_t[message_i]), v[message_i])
+        writer.close()
+
+        data = WALReader(filename).read_all()
+        data.interpret_byte_array()
+        self.assertTrue(np.array_equal(t, data.time_data))
+        self.assertTrue(np.array_equal(s_t, data.server_time_data))
+        self.assertTrue(np.array_equal(values, data.value_data))
+        self.assertTrue(np.all(data.message_sizes == samples_per_message))
+        self.assertTrue(data.time_data.flags['C_CONTIGUOUS'] and data.value_data.flags['C_CONTIGUOUS'])
+
+        # cut the file off part way through the last chunk, only the messages in that chunk should be lost
+        with open(filename, 'r+b') as f:
+            f.truncate(os.path.getsize(filename) - 10)
+
+        data = WALReader(filename).read_all()
+        os.remove(filename)
+        data.interpret_byte_array()
+        num_complete = (num_messages // 8) * 8
+        self.assertTrue(np.array_equal(t[:num_complete], data.time_data))
+        self.assertTrue(np.array_equal(values[:num_complete * samples_per_message], data.value_data))
+
+    def test_columnar_chunk_callbacks(self):
+        num_messages = 3
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['FLOAT64'].value, num_messages,
+                               ValueMode.TIME_VALUE_PAIRS.value, 500 * NANO, 1,
+                               np.array([0.0, 0.0, 0.0, 0.0], dtype=np.dtype("<f8")), ScaleType.NONE.value,
+                               int(time.time()) * NANO, ValueType['FLOAT64'].value, 2, bytes("MDC_HR", 'utf-8'),
+                               bytes("BPM", 'utf-8'))
+        header_dict['flags'] = WAL_FLAG_COLUMNAR
+        header_dict['frame_size'] = 8
+
+        writer = WALWriter.from_metadata(".", header_dict)
+        filename = writer.filename
+        writer.write_header(header_dict)
+
+        written = []
+        for message_i in range(num_messages):
+            writer.write_time_value_pair_message(int(times[message_i]), int(server_times[message_i]),
+                                                 values[message_i], on_written=written.append)
+        # the messages are only reported once the partial chunk is written
+        self.assertEqual(written, [])
+        self.assertGreater(writer.frame_age(), 0)
+        writer.write_frame()
+        self.assertEqual(written, [None] * num_messages)
+        writer.close()
+
+        data = WALReader(filename).read_all()
+        os.remove(filename)
+        data.interpret_byte_array()
+        self.assertTrue(np.array_equal(times, data.time_data))
+        self.assertTrue(np.array_equal(values, data.value_data))
+
+    def test_columnar_prepared(self):
+        num_messages = 50
+        header_dict, times, server_times, values = \
+            generate_test_data(bytes("104", 'utf-8'), ValueType['FLOAT64'].value, num_messages,
+                               ValueMode.TIME_VALUE_PAIRS.value, 500 * NANO, 1,
+                               np.array([0.0, 0.0, 0.0, 0.0], dtype=np.dtype("<f8")), ScaleType.NONE.value,
+                               int(time.time()) * NANO, ValueType['FLOAT64'].value, 2, bytes("MDC_HR", 'utf-8'),
+                               bytes("BPM", 'utf-8'))
+        header_dict['flags'] = WAL_FLAG_COLUMNAR
+        wal_data = WALData.from_time_value_data(header_dict, times, server_times, values)
+        wal_data.prepare_byte_array()
+
+        # a single chunk is read without copying any of the columns
+        data = WALData(byte_arr=wal_data.byte_arr)
+        data.interpret_byte_array()
+        self.assertTrue(np.shares_memory(data.time_data, data.byte_arr))
+        self.assertTrue(np.shares_memory(data.value_data, data.byte_arr))
+        self.assertTrue(np.array_equal(times, data.time_data))
+        self.assertTrue(np.array_equal(server_times, data.server_time_data))
+        self.assertTrue(np.array_equal(values, data.value_data))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -21,10 +21,11 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 from .io.data import WALData
-from .io.header_structure import WALHeaderStructure
+from .io.header_structure import WALHeaderStructure, WALHeaderStructureV2, WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR
 from .io.reader import WALReader
 from .io.writer import WALWriter, get_null_header_dictionary
 from .io.enums import ValueMode, ValueType, ScaleType
+from .io.recovery import find_valid_length, repair_file
 
 from .batch import WALBatch
 from .read_process import read_batch
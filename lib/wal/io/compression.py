@@ -0,0 +1,97 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import struct
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# every frame starts with its compressed size and uncompressed size, so a reader can skip to the next frame and tell
+# when the last one was cut off
+frame_header_struct = struct.Struct('<II')
+frame_header_size = frame_header_struct.size
+
+
+def _check_zstandard():
+    if zstandard is None:
+        raise RuntimeError("Compressed WAL files need the zstandard package, install atriumdb-server-lib[zstd]")
+
+
+def get_compressor(level=3):
+    _check_zstandard()
+    return zstandard.ZstdCompressor(level=level)
+
+
+def get_decompressor():
+    _check_zstandard()
+    return zstandard.ZstdDecompressor()
+
+
+def compress_frame(compressor, body):
+    compressed = compressor.compress(body)
+    return frame_header_struct.pack(len(compressed), len(body)) + compressed
+
+
+def iter_frames(body_arr):
+    """Yields (start, end, uncompressed_size) of each complete frame, stopping at a frame that was cut off"""
+    cursor = 0
+    while cursor + frame_header_size <= body_arr.size:
+        compressed_size, uncompressed_size = frame_header_struct.unpack_from(body_arr, offset=cursor)
+        end = cursor + frame_header_size + compressed_size
+        if end > body_arr.size:
+            break
+        yield cursor, end, uncompressed_size
+        cursor = end
+
+
+def decompress_frame(decompressor, body_arr, start, end, uncompressed_size):
+    """Returns the frame's bytes or None if it's corrupt"""
+    try:
+        frame = decompressor.decompress(body_arr[start + frame_header_size:end], max_output_size=uncompressed_size)
+    except zstandard.ZstdError:
+        return None
+    return frame if len(frame) == uncompressed_size else None
+
+
+def decompress_frames(body_arr, executor=None):
+    """Decompresses a body made of zstd frames. Like an uncompressed WAL file, a frame cut off at the end of the file
+    (or a corrupt one) and everything after it is dropped. If an executor is passed the frames are decompressed in
+    parallel on it"""
+    if executor is None:
+        decompressor = get_decompressor()
+        decoded = (decompress_frame(decompressor, body_arr, *frame) for frame in iter_frames(body_arr))
+    else:
+        # decompressors can't be shared between threads so each frame gets its own
+        decoded = executor.map(lambda frame: decompress_frame(get_decompressor(), body_arr, *frame),
+                               list(iter_frames(body_arr)))
+
+    frames = []
+    for frame in decoded:
+        if frame is None:
+            break
+        frames.append(frame)
+
+    return np.frombuffer(b''.join(frames), dtype=np.uint8)
@@ -23,12 +23,14 @@
 import ctypes
 import struct
 import copy
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 from wal.io.enums import ValueMode
 from wal.io.header_structure import WALHeaderStructure, get_header_structure_from_dict, \
-    get_wal_header_struct_size
+    get_wal_header_struct_size, get_header_structure_class, WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR
+from wal.io.compression import decompress_frames, get_compressor, compress_frame
 
 NANO = 10 ** 9
 
@@ -44,8 +46,77 @@ data_type_byte = np.uint8
 header_size = ctypes.sizeof(WALHeaderStructure)
 interval_message_struct_types = '<qqII'
 interval_message_header_size = struct.calcsize(interval_message_struct_types)
-
-supported_versions = [1]
+interval_message_header_data_type = np.dtype([("start_time_nominal", time_data_data_type),
+                                              ("start_time_server", time_data_data_type),
+                                              ("num_values", value_metadata_data_type),
+                                              ("null_offset", value_metadata_data_type)])
+
+# every columnar chunk starts with the number of messages and number of values in it. Then come the nominal times,
+# the server times, the num_values and null_offsets of each message (intervals only) and then all the values
+columnar_chunk_struct = struct.Struct('<II')
+columnar_chunk_header_size = columnar_chunk_struct.size
+
+supported_versions = [1, 2]
+
+
+def pack_columnar_chunk(mode, value_dtype, nominal_times, server_times, values, message_sizes=None,
+                        null_offsets=None):
+    values = np.asarray(values, dtype=value_dtype).reshape(-1)
+    columns = [np.asarray(nominal_times, dtype=time_data_data_type), np.asarray(server_times, dtype=time_data_data_type)]
+    if mode == ValueMode.INTERVALS.value:
+        columns.append(np.asarray(message_sizes, dtype=value_metadata_data_type))
+        columns.append(np.asarray(null_offsets, dtype=value_metadata_data_type))
+    columns.append(values)
+
+    return columnar_chunk_struct.pack(columns[0].size, values.size) + b''.join(column.tobytes() for column in columns)
+
+
+def read_columnar_chunk(mode, value_dtype, body_arr, offset):
+    """Returns the chunk's columns as views of body_arr and where the next chunk starts, or (None, offset) if the
+    chunk was cut off"""
+    if offset + columnar_chunk_header_size > body_arr.size:
+        return None, offset
+    num_messages, num_values = columnar_chunk_struct.unpack_from(body_arr, offset=offset)
+
+    column_types = [("nominal_time", time_data_data_type, num_messages),
+                    ("server_time", time_data_data_type, num_messages)]
+    if mode == ValueMode.INTERVALS.value:
+        column_types.append(("num_values", value_metadata_data_type, num_messages))
+        column_types.append(("null_offset", value_metadata_data_type, num_messages))
+    column_types.append(("value", value_dtype, num_values))
+
+    end = offset + columnar_chunk_header_size + sum(dtype.itemsize * count for _, dtype, count in column_types)
+    if end > body_arr.size:
+        return None, offset
+
+    columns = {}
+    cursor = offset + columnar_chunk_header_size
+    for name, dtype, count in column_types:
+        columns[name] = np.frombuffer(body_arr, dtype=dtype, count=count, offset=cursor)
+        cursor += dtype.itemsize * count
+    return columns, end
+
+
+def _scan_message_boundaries(body_arr, value_size):
+    """Finds where each message of a variable size interval file starts by hopping from header to header. A message
+    whose values were cut off is kept with a size of 0 the same way interpret_byte_array does"""
+    offsets, message_sizes = [], []
+    cursor = 0
+    while cursor + interval_message_header_size < body_arr.size:
+        num_values = struct.unpack_from(interval_message_struct_types, body_arr, offset=cursor)[2]
+        message_end = cursor + interval_message_header_size + num_values * value_size
+        offsets.append(cursor)
+        if message_end > body_arr.size:
+            message_sizes.append(0)
+            break
+        message_sizes.append(num_values)
+        cursor = message_end
+    return np.array(offsets, dtype=np.int64), np.array(message_sizes, dtype=value_metadata_data_type)
+
+
+def _split_range(size, parts):
+    bounds = np.linspace(0, size, parts + 1).astype(np.int64)
+    return bounds[:-1], bounds[1:]
 
 
 class WALData:
@@ -122,10 +193,15 @@ class WALData:
         return bytearray(b_1) == bytearray(b_2)
 
     def interpret_byte_array(self):
-        self.header = WALHeaderStructure.from_buffer(self.byte_arr)
-        assert self.header.version in supported_versions
+        # the first byte of every header is its version, which decides how big the rest of the header is
+        version = int(self.byte_arr[0]) if self.byte_arr.size > 0 else 1
+        assert version in supported_versions
+        self.header = get_header_structure_class(version).from_buffer(self.byte_arr)
 
-        if self.header.mode == ValueMode.TIME_VALUE_PAIRS.value:
+        if self._is_columnar():
+            self._interpret_columnar()
+
+        elif self.header.mode == ValueMode.TIME_VALUE_PAIRS.value:
             # Time-Value Pair
             self._interpret_time_value_pairs()
 
@@ -139,25 +215,61 @@ class WALData:
         else:
             raise ValueError("{} mode not in {}".format(self.header.mode, list(ValueMode)))
 
+    def interpret_parallel(self, n_workers):
+        """
+        Same as interpret_byte_array but splits the body into n_workers pieces that are decoded on a thread pool and
+        stitched back together. Numpy releases the GIL while copying so big files are decoded on more than one core.
+        Unlike interpret_byte_array the columns are always contiguous arrays instead of views of byte_arr.
+        """
+        if n_workers <= 1:
+            self.interpret_byte_array()
+            return
+
+        version = int(self.byte_arr[0]) if self.byte_arr.size > 0 else 1
+        assert version in supported_versions
+        self.header = get_header_structure_class(version).from_buffer(self.byte_arr)
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            body_arr = self._get_body(executor)
+
+            if self._is_columnar():
+                # chunks are already contiguous columns so there's nothing left to split up
+                self._interpret_columnar(body_arr)
+
+            elif self.header.mode == ValueMode.INTERVALS.value and self.header.samples_per_message == 0:
+                self._interpret_intervals_line_by_line_parallel(executor, n_workers, body_arr)
+
+            elif self.header.mode in (ValueMode.TIME_VALUE_PAIRS.value, ValueMode.INTERVALS.value):
+                self._interpret_fixed_size_parallel(executor, n_workers, body_arr)
+
+            else:
+                raise ValueError("{} mode not in {}".format(self.header.mode, list(ValueMode)))
+
     def prepare_byte_array(self):
+        if self._is_columnar():
+            self._prepare_columnar()
+            return
+
         if self.header.mode == ValueMode.INTERVALS.value and self.header.samples_per_message == 0:
             self._prepare_interval_data_line_by_line()
             return
 
         data_type = self._get_prepared_data_type()
 
-        bytearray_size = get_wal_header_struct_size() + (data_type.itemsize * self.time_data.size)
+        header_size = ctypes.sizeof(self.header)
+        bytearray_size = header_size + (data_type.itemsize * self.time_data.size)
 
         self.byte_arr = np.empty(bytearray_size, dtype=data_type_byte)
-        self.byte_arr[:get_wal_header_struct_size()] = np.frombuffer(bytearray(self.header), dtype=data_type_byte)
+        self.byte_arr[:header_size] = np.frombuffer(bytearray(self.header), dtype=data_type_byte)
 
-        self.data = self.byte_arr[get_wal_header_struct_size():].view(dtype=data_type)
+        self.data = self.byte_arr[header_size:].view(dtype=data_type)
 
         self._prepare_data()
+        self._compress_body()
 
     def _prepare_interval_data_line_by_line(self):
         # Determine the total size of the byte array
-        header_size = get_wal_header_struct_size()
+        header_size = ctypes.sizeof(self.header)
         value_dtype = value_data_type_dict[self.header.input_value_type]
         total_size = header_size
 
@@ -190,6 +302,54 @@ class WALData:
             offset += values_size
             value_offset += self.message_sizes[i]
 
+        self._compress_body()
+
+    def _prepare_columnar(self):
+        # everything goes in one chunk
+        value_dtype = value_data_type_dict[self.header.input_value_type]
+        if self.header.mode == ValueMode.TIME_VALUE_PAIRS.value:
+            chunk = pack_columnar_chunk(self.header.mode, value_dtype, self.time_data, self.server_time_data,
+                                        self.value_data)
+
+        elif self.header.mode == ValueMode.INTERVALS.value:
+            if self.header.samples_per_message == 0:
+                values = np.concatenate([v[:self.message_sizes[i]] for i, v in enumerate(self.value_data)], axis=None)
+            else:
+                values = self.value_data
+            chunk = pack_columnar_chunk(self.header.mode, value_dtype, self.time_data, self.server_time_data, values,
+                                        self.message_sizes, self.null_offsets)
+
+        else:
+            raise ValueError("{} mode not in {}".format(self.header.mode, list(ValueMode)))
+
+        header_size = ctypes.sizeof(self.header)
+        self.byte_arr = np.empty(header_size + len(chunk), dtype=data_type_byte)
+        self.byte_arr[:header_size] = np.frombuffer(bytearray(self.header), dtype=data_type_byte)
+        self.byte_arr[header_size:] = np.frombuffer(chunk, dtype=data_type_byte)
+
+        self._compress_body()
+
+    def _compress_body(self):
+        # a compressed header means the body has to be written as zstd frames, put it all in one frame
+        if not self._is_compressed():
+            return
+
+        header_size = ctypes.sizeof(self.header)
+        frame = compress_frame(get_compressor(), self.byte_arr[header_size:].tobytes())
+        self.byte_arr = np.concatenate([self.byte_arr[:header_size], np.frombuffer(frame, dtype=data_type_byte)])
+
+    def _is_compressed(self):
+        return getattr(self.header, "flags", 0) & WAL_FLAG_ZSTD != 0
+
+    def _is_columnar(self):
+        return getattr(self.header, "flags", 0) & WAL_FLAG_COLUMNAR != 0
+
+    def _get_body(self, executor=None):
+        body_arr = self.byte_arr[ctypes.sizeof(self.header):]
+        if self._is_compressed():
+            body_arr = decompress_frames(body_arr, executor)
+        return body_arr
+
     def _get_prepared_data_type(self):
         if self.header.mode == ValueMode.TIME_VALUE_PAIRS.value:
             data_type = self._get_time_value_data_type()
@@ -222,7 +382,7 @@ class WALData:
     def _interpret_time_value_pairs(self):
         data_type = self._get_time_value_data_type()
 
-        body_arr = self.byte_arr[header_size:]
+        body_arr = self._get_body()
         # Truncate files that ended mid message.
         data_remainder = body_arr.size % data_type.itemsize
         if data_remainder != 0:
@@ -245,7 +405,7 @@ class WALData:
     def _interpret_intervals(self):
         data_type = self._get_interval_data_type()
 
-        body_arr = self.byte_arr[header_size:]
+        body_arr = self._get_body()
         # Truncate files that ended mid message.
         data_remainder = body_arr.size % data_type.itemsize
         if data_remainder != 0:
@@ -261,9 +421,41 @@ class WALData:
         self.message_sizes = self.data["num_values"]
         self.null_offsets = self.data["null_offset"]
 
+    def _interpret_columnar(self, body_arr=None):
+        body_arr = self._get_body() if body_arr is None else body_arr
+        value_dtype = value_data_type_dict[self.header.input_value_type]
+
+        # Read chunks until the end of the file or one that was cut off.
+        chunks = []
+        cursor = 0
+        while True:
+            columns, cursor = read_columnar_chunk(self.header.mode, value_dtype, body_arr, cursor)
+            if columns is None:
+                break
+            chunks.append(columns)
+
+        def column(name, dtype):
+            # a file with one chunk (like one made by prepare_byte_array) is used in place, otherwise each column is
+            # joined into one contiguous array
+            if len(chunks) == 1:
+                return chunks[0][name]
+            if len(chunks) == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate([chunk[name] for chunk in chunks])
+
+        self.time_data = column("nominal_time", time_data_data_type)
+        self.server_time_data = column("server_time", time_data_data_type)
+        self.value_data = column("value", value_dtype)
+
+        if self.header.mode == ValueMode.INTERVALS.value:
+            self.message_sizes = column("num_values", value_metadata_data_type)
+            self.null_offsets = column("null_offset", value_metadata_data_type)
+            if self.header.samples_per_message != 0:
+                # fixed size messages keep the same shape as the row layout
+                self.value_data = self.value_data.reshape((-1, self.header.samples_per_message))
+
     def _interpret_intervals_line_by_line(self):
-        header_size = ctypes.sizeof(WALHeaderStructure)
-        body_arr = self.byte_arr[header_size:]
+        body_arr = self._get_body()
 
         # Prepare lists to hold parsed data
         time_data = []
@@ -308,6 +500,67 @@ class WALData:
         self.message_sizes = np.array(message_sizes, dtype=np.uint32)
         self.null_offsets = np.array(null_offsets, dtype=np.uint32)
 
+    def _interpret_fixed_size_parallel(self, executor, n_workers, body_arr):
+        data_type = self._get_prepared_data_type()
+
+        # Truncate files that ended mid message.
+        num_messages = body_arr.size // data_type.itemsize
+        self.data = np.frombuffer(body_arr[:num_messages * data_type.itemsize], dtype=data_type)
+
+        if self.header.mode == ValueMode.TIME_VALUE_PAIRS.value:
+            fields = {"time_data": "nominal_time", "server_time_data": "server_time", "value_data": "value"}
+        else:
+            fields = {"time_data": "start_time_nominal", "server_time_data": "start_time_server",
+                      "value_data": "values", "message_sizes": "num_values", "null_offsets": "null_offset"}
+
+        # gather each field out of the records into its own contiguous array, every worker doing a range of messages
+        columns = {attr: np.empty(self.data[field].shape, dtype=self.data[field].dtype) for attr, field in fields.items()}
+
+        def copy_messages(start, end):
+            for attr, field in fields.items():
+                columns[attr][start:end] = self.data[field][start:end]
+
+        starts, ends = _split_range(num_messages, n_workers)
+        list(executor.map(copy_messages, starts, ends))
+
+        for attr, column in columns.items():
+            setattr(self, attr, column)
+
+    def _interpret_intervals_line_by_line_parallel(self, executor, n_workers, body_arr):
+        value_dtype = value_data_type_dict[self.header.input_value_type]
+        offsets, message_sizes = _scan_message_boundaries(body_arr, value_dtype.itemsize)
+        # where each message's values go in value_data
+        value_offsets = np.zeros(message_sizes.size + 1, dtype=np.int64)
+        np.cumsum(message_sizes, out=value_offsets[1:])
+
+        header_data = np.empty(offsets.size, dtype=interval_message_header_data_type)
+        value_bytes = np.empty(int(value_offsets[-1]) * value_dtype.itemsize, dtype=data_type_byte)
+        header_byte_index = np.arange(interval_message_header_size)
+
+        def decode_messages(start, end):
+            if start == end:
+                return
+            # messages are back to back so the values of a range of messages are its bytes minus the message headers
+            first_byte = offsets[start]
+            last_byte = offsets[end - 1] + interval_message_header_size + message_sizes[end - 1] * value_dtype.itemsize
+            segment = body_arr[first_byte:last_byte]
+            header_index = (offsets[start:end] - first_byte)[:, None] + header_byte_index
+
+            header_data[start:end] = segment[header_index].view(interval_message_header_data_type).reshape(-1)
+            is_value = np.ones(segment.size, dtype=bool)
+            is_value[header_index] = False
+            value_bytes[value_offsets[start] * value_dtype.itemsize:value_offsets[end] * value_dtype.itemsize] = \
+                segment[is_value]
+
+        starts, ends = _split_range(offsets.size, n_workers)
+        list(executor.map(decode_messages, starts, ends))
+
+        self.time_data = header_data["start_time_nominal"].copy()
+        self.server_time_data = header_data["start_time_server"].copy()
+        self.value_data = value_bytes.view(value_dtype)
+        self.message_sizes = message_sizes
+        self.null_offsets = header_data["null_offset"].copy()
+
     def _get_interval_data_type(self):
         data_type = np.dtype([("start_time_nominal", time_data_data_type),
                               ("start_time_server", time_data_data_type),
@@ -326,24 +579,57 @@ class WALData:
         result = np.zeros(self.value_data.shape[0], dtype=value_metadata_data_type)
         return result
 
-    def copy(self):
-        # Create a new instance of WALData without initializing its attributes
+    def copy(self, snapshot=False):
+        """
+        Copies the WALData. byte_arr is copied once and any arrays that are views of it (like the columns after
+        interpret_byte_array) are rebuilt as views of the copy instead of being copied again. With snapshot=True nothing
+        is copied, the result shares its buffers with this WALData but they are read-only so it can't change them.
+        """
         new_copy = WALData()
 
-        # Copy each attribute
-        new_copy.data = copy.deepcopy(self.data)
-        new_copy.time_data = copy.deepcopy(self.time_data)
-        new_copy.server_time_data = copy.deepcopy(self.server_time_data)
-        new_copy.value_data = copy.deepcopy(self.value_data)
-        new_copy.message_sizes = copy.deepcopy(self.message_sizes)
-        new_copy.null_offsets = copy.deepcopy(self.null_offsets)
-
-        if self.byte_arr is not None:
-            new_copy.byte_arr = copy.deepcopy(self.byte_arr)
+        # copy the buffers first so the other arrays can be rebuilt on top of them
+        buffer_copies = []
+        for name in ("byte_arr", "data"):
+            arr = getattr(self, name)
+            if arr is None:
+                continue
+            new_arr = self._copy_array(arr, buffer_copies, snapshot)
+            setattr(new_copy, name, new_arr)
+            if arr.flags['C_CONTIGUOUS']:
+                buffer_copies.append((arr, new_arr))
+
+        for name in ("time_data", "server_time_data", "value_data", "message_sizes", "null_offsets"):
+            arr = getattr(self, name)
+            if arr is not None:
+                setattr(new_copy, name, self._copy_array(arr, buffer_copies, snapshot))
 
         # For the header, which is a ctypes.Structure, create a new instance and copy the fields
         if self.header is not None:
-            new_copy.header = WALHeaderStructure()
+            new_copy.header = type(self.header)()
             ctypes.pointer(new_copy.header)[0] = copy.deepcopy(ctypes.pointer(self.header)[0])
 
         return new_copy
+
+    @staticmethod
+    def _copy_array(arr, buffer_copies, snapshot):
+        if snapshot:
+            result = arr.view()
+            result.flags.writeable = False
+            return result
+
+        for buffer, new_buffer in buffer_copies:
+            offset = _view_offset(arr, buffer)
+            if offset is not None:
+                return np.ndarray(arr.shape, dtype=arr.dtype, buffer=new_buffer, offset=offset, strides=arr.strides)
+        return arr.copy()
+
+
+def _view_offset(arr, buffer):
+    """Returns where arr starts in buffer (which has to be contiguous) in bytes if arr is a view into it, else None"""
+    if arr.size == 0 or any(stride < 0 for stride in arr.strides):
+        return None
+    offset = arr.__array_interface__['data'][0] - buffer.__array_interface__['data'][0]
+    end = offset + sum((dim - 1) * stride for dim, stride in zip(arr.shape, arr.strides)) + arr.itemsize
+    if offset < 0 or end > buffer.nbytes:
+        return None
+    return offset
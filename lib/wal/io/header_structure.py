@@ -42,16 +42,36 @@ class WALHeaderStructure(ctypes.Structure):
                 ("measure_units", ctypes.c_char * 64)]
 
 
+# version 2 adds flags for how the body is stored, everything before that is laid out the same as version 1
+class WALHeaderStructureV2(WALHeaderStructure):
+    _pack_ = 1
+    _fields_ = [("flags", ctypes.c_uint8),
+                # number of messages in each compressed frame or columnar chunk
+                ("frame_size", ctypes.c_uint32)]
+
+
+# the body is a series of independently decodable zstd frames
+WAL_FLAG_ZSTD = 1
+# the body is a series of chunks that each store their messages column by column instead of message by message
+WAL_FLAG_COLUMNAR = 2
+
+header_structure_versions = {1: WALHeaderStructure, 2: WALHeaderStructureV2}
 
 header_attribute_list = [var_name for var_name, var_type in WALHeaderStructure._fields_]
 
 
-def get_wal_header_struct_size():
-    return ctypes.sizeof(WALHeaderStructure)
+def get_wal_header_struct_size(version=1):
+    return ctypes.sizeof(header_structure_versions[version])
+
+
+def get_header_structure_class(version):
+    if version not in header_structure_versions:
+        raise ValueError("WAL header version {} not in {}".format(version, list(header_structure_versions)))
+    return header_structure_versions[version]
 
 
 def get_header_structure_from_dict(header_dict):
-    result = WALHeaderStructure()
+    result = get_header_structure_class(header_dict.get("version") or 1)()
 
     for key, value in header_dict.items():
         setattr(result, key, value)
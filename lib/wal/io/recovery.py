@@ -0,0 +1,143 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import ctypes
+import os
+import struct
+
+import numpy as np
+
+from wal.io.enums import ValueMode
+from wal.io.data import value_data_type_dict, time_data_data_type, value_metadata_data_type, supported_versions, \
+    interval_message_struct_types, interval_message_header_size, data_type_byte, read_columnar_chunk
+from wal.io.header_structure import get_header_structure_class, WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR
+from wal.io.compression import iter_frames, decompress_frame, get_decompressor
+
+
+def find_valid_length(byte_arr):
+    """Returns the length of the part of a WAL file made of complete messages (or complete frames for compressed
+    files), anything after that is a torn tail left by a crash part way through a write. Files that are too short to
+    have a header or that have an unknown header are left as they are"""
+    header = _read_header(byte_arr)
+    if header is None:
+        return byte_arr.size
+
+    header_size = ctypes.sizeof(header)
+    body_arr = byte_arr[header_size:]
+
+    if _is_compressed(header):
+        return header_size + _valid_frames_length(body_arr)
+
+    if getattr(header, "flags", 0) & WAL_FLAG_COLUMNAR:
+        return header_size + _valid_chunks_length(header, body_arr)
+
+    message_size = get_fixed_message_size(header)
+    if message_size is not None:
+        return header_size + body_arr.size - (body_arr.size % message_size)
+
+    return header_size + _valid_line_by_line_length(header, body_arr)
+
+
+def repair_file(path):
+    """Truncates a WAL file in place to its last complete message, returns the number of bytes removed"""
+    with open(path, 'rb') as f:
+        header = _read_header(np.frombuffer(f.read(ctypes.sizeof(get_header_structure_class(max(supported_versions)))),
+                                            dtype=data_type_byte))
+    if header is None:
+        return 0
+
+    file_size = os.path.getsize(path)
+    message_size = get_fixed_message_size(header)
+    if message_size is not None and not _is_compressed(header):
+        # fixed size messages only need the file size, no need to read the whole file
+        header_size = ctypes.sizeof(header)
+        valid_length = file_size - (max(0, file_size - header_size) % message_size)
+    else:
+        valid_length = find_valid_length(np.fromfile(path, dtype=data_type_byte))
+
+    if valid_length < file_size:
+        os.truncate(path, valid_length)
+    return file_size - valid_length
+
+
+def get_fixed_message_size(header):
+    """The size in bytes of each message if they are all the same size, None for variable sized messages"""
+    if getattr(header, "flags", 0) & WAL_FLAG_COLUMNAR:
+        return None
+
+    value_dtype = value_data_type_dict[header.input_value_type]
+    if header.mode == ValueMode.TIME_VALUE_PAIRS.value:
+        return 2 * time_data_data_type.itemsize + value_dtype.itemsize
+    if header.mode == ValueMode.INTERVALS.value and header.samples_per_message != 0:
+        return 2 * time_data_data_type.itemsize + 2 * value_metadata_data_type.itemsize + \
+            header.samples_per_message * value_dtype.itemsize
+    return None
+
+
+def _read_header(byte_arr):
+    if byte_arr.size == 0 or int(byte_arr[0]) not in supported_versions:
+        return None
+
+    header_class = get_header_structure_class(int(byte_arr[0]))
+    if byte_arr.size < ctypes.sizeof(header_class):
+        return None
+
+    header = header_class.from_buffer_copy(byte_arr[:ctypes.sizeof(header_class)].tobytes())
+    if header.input_value_type not in value_data_type_dict or not ValueMode.has_value(header.mode):
+        return None
+    return header
+
+
+def _is_compressed(header):
+    return getattr(header, "flags", 0) & WAL_FLAG_ZSTD != 0
+
+
+def _valid_line_by_line_length(header, body_arr):
+    value_size = value_data_type_dict[header.input_value_type].itemsize
+    cursor = 0
+    while cursor + interval_message_header_size <= body_arr.size:
+        num_values = struct.unpack_from(interval_message_struct_types, body_arr, offset=cursor)[2]
+        message_end = cursor + interval_message_header_size + num_values * value_size
+        if message_end > body_arr.size:
+            break
+        cursor = message_end
+    return cursor
+
+
+def _valid_chunks_length(header, body_arr):
+    value_dtype = value_data_type_dict[header.input_value_type]
+    cursor = 0
+    while True:
+        columns, cursor = read_columnar_chunk(header.mode, value_dtype, body_arr, cursor)
+        if columns is None:
+            return cursor
+
+
+def _valid_frames_length(body_arr):
+    decompressor = get_decompressor()
+    valid_length = 0
+    for start, end, uncompressed_size in iter_frames(body_arr):
+        # a frame that was fully written but can't be decompressed is treated like a torn one
+        if decompress_frame(decompressor, body_arr, start, end, uncompressed_size) is None:
+            break
+        valid_length = end
+    return valid_length
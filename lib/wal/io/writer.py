@@ -23,6 +23,7 @@
 from typing import Union
 import hashlib
 import random
+import time
 
 import numpy as np
 import struct
@@ -30,21 +31,40 @@ import orjson
 import os.path
 
 from wal.io.data import value_data_type_dict, value_struct_char_dict, supported_versions, WALData, \
-    value_py_type_dict
+    value_py_type_dict, pack_columnar_chunk
 from wal.io.header_structure import header_attribute_list, get_header_structure_from_dict, \
-    WALHeaderStructure
+    WALHeaderStructure, WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR
+from wal.io.compression import get_compressor, compress_frame
+from wal.io.enums import ValueMode
 
 
 class WALWriter:
 
-    def __init__(self, directory, filename):
+    def __init__(self, directory, filename, append=False, compression_level=3):
         self.directory = os.path.abspath(directory)
         self.value_dtype = None
         self.value_struct_char = None
         self.value_py_type = None
         self.samples_per_message = None
+        # only used when the header has the zstd or columnar flag set, messages are held in frame_buffer (or
+        # column_buffer for columnar files) until frame_size of them have been written and then written out as one
+        # compressed frame or columnar chunk
+        self.compression_level = compression_level
+        self.compressor = None
+        self.mode = None
+        self.columnar = False
+        self.frame_size = None
+        self.frame_buffer = bytearray()
+        self.column_buffer = self._empty_column_buffer()
+        self.frame_messages = 0
+        # called with None once the frame holding their message is written and flushed, or with the exception if
+        # writing it failed
+        self.frame_callbacks = []
+        # time.monotonic() when the first message of the buffered frame arrived
+        self.frame_started = None
         self.filename = '/'.join((self.directory, filename))
-        self.current_file_pointer = open(self.filename, 'wb')
+        # in append mode the file already has a header, call load_header() instead of write_header()
+        self.current_file_pointer = open(self.filename, 'ab' if append else 'wb')
 
     @classmethod
     def from_metadata(cls, directory, metadata, suffix=None):
@@ -64,10 +84,20 @@ class WALWriter:
 
     def close(self):
         if not self.current_file_pointer.closed:
-            self.current_file_pointer.close()
+            try:
+                self.write_frame()
+            finally:
+                self.current_file_pointer.close()
 
     def write_header(self, header):
-        if type(header) is WALHeaderStructure:
+        header = self.load_header(header)
+
+        self.current_file_pointer.write(bytearray(header))
+        self.current_file_pointer.flush()
+
+    # sets up the value types for the messages without writing the header, used when appending to an existing file
+    def load_header(self, header):
+        if isinstance(header, WALHeaderStructure):
             pass
         elif type(header) is dict:
             header = get_header_structure_from_dict(header)
@@ -80,27 +110,124 @@ class WALWriter:
         self.value_struct_char = value_struct_char_dict[header.input_value_type]
         self.value_py_type = value_py_type_dict[header.input_value_type]
         self.samples_per_message = header.samples_per_message
-
-        self.current_file_pointer.write(bytearray(header))
-        self.current_file_pointer.flush()
-
+        self.mode = header.mode
+
+        flags = getattr(header, "flags", 0)
+        if flags & WAL_FLAG_ZSTD:
+            self.compressor = get_compressor(self.compression_level)
+        self.columnar = flags & WAL_FLAG_COLUMNAR != 0
+        if flags & (WAL_FLAG_ZSTD | WAL_FLAG_COLUMNAR):
+            self.frame_size = max(1, header.frame_size)
+        return header
+
+    # on_written is called with None once the message is written and flushed, for compressed files that's when the
+    # frame holding it is written, which may be on a later call or from another thread
     def write_interval_message(self, start_time_nominal: int, start_time_server: int, values: np.ndarray,
-                               num_values: int = None, null_offset: int = 0):
+                               num_values: int = None, null_offset: int = 0, on_written=None):
         assert values.dtype == self.value_dtype
 
         num_values = int(values.size) if num_values is None else int(num_values)
 
-        self.current_file_pointer.write(
-            struct.pack("<qqII", int(start_time_nominal), int(start_time_server), int(num_values), int(null_offset)))
+        if self.columnar:
+            self._buffer_columns(start_time_nominal, start_time_server, values, num_values, null_offset,
+                                 on_written=on_written)
+            return
+
+        message_header = struct.pack("<qqII", int(start_time_nominal), int(start_time_server), int(num_values),
+                                     int(null_offset))
+        if self.compressor is not None:
+            self._buffer_message(message_header, values.tobytes(), on_written=on_written)
+            return
+
+        self.current_file_pointer.write(message_header)
         self.current_file_pointer.write(values.tobytes())
         self.current_file_pointer.flush()
+        if on_written is not None:
+            on_written(None)
 
-    def write_time_value_pair_message(self, time_nominal: int, time_server: int, value: Union[int, float]):
+    def write_time_value_pair_message(self, time_nominal: int, time_server: int, value: Union[int, float],
+                                      on_written=None):
         assert self.value_struct_char is not None
-        self.current_file_pointer.write(
-            struct.pack("<qq" + self.value_struct_char,
-                        int(time_nominal), int(time_server), self.value_py_type(value)))
+        if self.columnar:
+            self._buffer_columns(time_nominal, time_server, self.value_py_type(value), on_written=on_written)
+            return
+
+        message = struct.pack("<qq" + self.value_struct_char,
+                              int(time_nominal), int(time_server), self.value_py_type(value))
+        if self.compressor is not None:
+            self._buffer_message(message, on_written=on_written)
+            return
+
+        self.current_file_pointer.write(message)
         self.current_file_pointer.flush()
+        if on_written is not None:
+            on_written(None)
+
+    def _buffer_message(self, *parts, on_written=None):
+        self._start_frame_message(on_written)
+        for part in parts:
+            self.frame_buffer += part
+        self.frame_messages += 1
+        if self.frame_messages >= self.frame_size:
+            self.write_frame()
+
+    def _start_frame_message(self, on_written):
+        if self.frame_messages == 0:
+            self.frame_started = time.monotonic()
+        if on_written is not None:
+            self.frame_callbacks.append(on_written)
+
+    # how many seconds the oldest message in the buffered frame has been waiting to be written
+    def frame_age(self) -> float:
+        return 0 if self.frame_started is None else time.monotonic() - self.frame_started
+
+    def _buffer_columns(self, time_nominal, time_server, values, num_values=None, null_offset=None, on_written=None):
+        self._start_frame_message(on_written)
+        self.column_buffer["nominal_time"].append(int(time_nominal))
+        self.column_buffer["server_time"].append(int(time_server))
+        self.column_buffer["value"].append(values)
+        self.column_buffer["num_values"].append(num_values)
+        self.column_buffer["null_offset"].append(null_offset)
+        self.frame_messages += 1
+        if self.frame_messages >= self.frame_size:
+            self.write_frame()
+
+    @staticmethod
+    def _empty_column_buffer():
+        return {"nominal_time": [], "server_time": [], "value": [], "num_values": [], "null_offset": []}
+
+    # writes any buffered messages as a frame or chunk (compressing it if the file is compressed). Frames and chunks
+    # can hold any number of messages so this can be called early, for example before closing the file
+    def write_frame(self):
+        if self.frame_size is None or self.frame_messages == 0:
+            return
+
+        # the buffered messages are dropped even if the write fails, their callbacks get the error so they can be
+        # retried instead of being written twice
+        callbacks = self.frame_callbacks
+        columns, frame_buffer = self.column_buffer, self.frame_buffer
+        self.frame_callbacks, self.frame_started, self.frame_messages = [], None, 0
+        self.column_buffer, self.frame_buffer = self._empty_column_buffer(), bytearray()
+
+        try:
+            if self.columnar:
+                values = np.concatenate(columns["value"], axis=None) if self.mode == ValueMode.INTERVALS.value else columns["value"]
+                body = pack_columnar_chunk(self.mode, self.value_dtype, columns["nominal_time"], columns["server_time"],
+                                           values, columns["num_values"], columns["null_offset"])
+            else:
+                body = bytes(frame_buffer)
+
+            if self.compressor is not None:
+                body = compress_frame(self.compressor, body)
+            self.current_file_pointer.write(body)
+            self.current_file_pointer.flush()
+        except Exception as e:
+            for callback in callbacks:
+                callback(e)
+            raise
+
+        for callback in callbacks:
+            callback(None)
 
     def write_wal_data(self, wal_data: WALData):
         self.current_file_pointer.write(wal_data.byte_arr.tobytes())
@@ -0,0 +1,140 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import os
+import numpy as np
+from wal import ValueMode
+from helpers.metrics import (get_metric,
+                             TSCGENERATOR_AUTOTUNE_RESIZES,
+                             TSCGENERATOR_AUTOTUNE_WORKERS,
+                             TSCGENERATOR_AUTOTUNE_THREADS)
+
+# the load average per core above which the pool is treated as oversubscribed
+OVERLOADED_LOAD_PER_CORE = 1.25
+# once files take this fraction of wal_file_timeout each worker is given another compression thread
+SLOW_FILE_TIMEOUT_FRACTION = 0.5
+# weight of the newest round in the moving average of per file latency
+LATENCY_SMOOTHING = 0.2
+
+
+class WorkerAutotuner:
+    """
+    Picks the number of worker processes and the number of compression threads each worker's sdk gets from what is
+    waiting to be ingested. A queue of mostly small metric files is ingested fastest by many workers with one thread
+    each, a queue of big waveform files by fewer workers with more compression threads. Every
+    large_file_bytes of a typical big waveform file adds a thread, up to max_compression_threads, and the workers fill
+    the rest of max_cores. Workers are also given another thread when files start taking a large part of the WAL
+    file timeout, and the pool shrinks when the load average shows it's using more cpu than there is.
+
+    A new size is only used once it has been picked stable_rounds ingest rounds in a row so the pool isn't restarted
+    over one odd batch of files.
+    """
+
+    def __init__(self, workers: int, threads: int, max_cores: int = None, max_compression_threads: int = 4,
+                 large_file_bytes: int = 16 * 1024 * 1024, file_timeout: float = 120, stable_rounds: int = 3):
+        self._LOGGER = logging.getLogger(__name__)
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        # by default stay within the cores the configured pool uses
+        self.max_cores = max_cores or self.workers * self.threads
+        self.max_compression_threads = max(1, max_compression_threads)
+        self.large_file_bytes = large_file_bytes
+        self.file_timeout = file_timeout
+        self.stable_rounds = stable_rounds
+
+        self.latency = None
+        self.queue = []
+        self.proposal = None
+        self.proposal_rounds = 0
+
+        self.resize_counter = get_metric(TSCGENERATOR_AUTOTUNE_RESIZES)
+        self.workers_gauge = get_metric(TSCGENERATOR_AUTOTUNE_WORKERS)
+        self.threads_gauge = get_metric(TSCGENERATOR_AUTOTUNE_THREADS)
+        self.workers_gauge.add(self.workers)
+        self.threads_gauge.add(self.threads)
+
+    def observe_file(self, size_bytes: int, mode: int):
+        self.queue.append((size_bytes, mode))
+
+    def observe_round(self, elapsed: float, num_files: int):
+        """Records how long the files submitted this round took to ingest."""
+        if num_files == 0:
+            return
+        # the workers run side by side so this is about how long one file took, without the time spent queued
+        seconds = elapsed * min(self.workers, num_files) / num_files
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def propose(self):
+        """Returns (workers, threads, reason) for the files seen this round."""
+        sizes = np.array([size for size, _ in self.queue], dtype=np.int64)
+        waveforms = np.array([mode == ValueMode.INTERVALS.value for _, mode in self.queue], dtype=bool)
+        large = waveforms & (sizes >= self.large_file_bytes)
+
+        threads, reason = 1, "small_files"
+        if large.sum() * 2 >= sizes.size:
+            threads = int(np.median(sizes[large]) // self.large_file_bytes) + 1
+            reason = "large_files"
+
+        if self.latency is not None and self.latency > SLOW_FILE_TIMEOUT_FRACTION * self.file_timeout:
+            threads = max(threads, self.threads + 1)
+            reason = "slow_files"
+        threads = min(threads, self.max_compression_threads, self.max_cores)
+
+        cores = self.max_cores
+        load_per_core = os.getloadavg()[0] / self.max_cores if hasattr(os, "getloadavg") else 0
+        if load_per_core > OVERLOADED_LOAD_PER_CORE:
+            # take a core away from what is running now
+            cores = max(1, min(cores, self.workers * self.threads - 1))
+            reason = "cpu_overloaded"
+        return max(1, cores // threads), min(threads, cores), reason
+
+    def end_round(self):
+        """
+        Call after every ingest round. Returns the new (workers, threads) if the pool should be resized, otherwise
+        None.
+        """
+        if len(self.queue) == 0:
+            return None
+        workers, threads, reason = self.propose()
+        self.queue = []
+
+        if (workers, threads) == (self.workers, self.threads):
+            self.proposal, self.proposal_rounds = None, 0
+            return None
+        if (workers, threads) != self.proposal:
+            self.proposal, self.proposal_rounds = (workers, threads), 0
+        self.proposal_rounds += 1
+        if self.proposal_rounds < self.stable_rounds:
+            return None
+
+        self._LOGGER.info(f"Resizing ingest pool from {self.workers} workers x {self.threads} compression threads to "
+                          f"{workers} x {threads} ({reason})")
+        self.resize_counter.add(1, {"reason": reason})
+        self.workers_gauge.add(workers - self.workers)
+        self.threads_gauge.add(threads - self.threads)
+        self.workers, self.threads = workers, threads
+        self.proposal, self.proposal_rounds = None, 0
+        return workers, threads
@@ -0,0 +1,187 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from atriumdb import AtriumSDK
+from config import config
+from helpers import sql_functions
+from optimizer import merge_small_tsc_files, delete_unreferenced_tsc_files
+from helpers.metrics import (get_metric,
+                             TSCGENERATOR_ERRORS,
+                             TSCGENERATOR_OPT_TIMEOUT_ERRORS,
+                             TSCGENERATOR_COMPACTION_BYTES,
+                             TSCGENERATOR_COMPACTION_PAUSES)
+
+# a merge reads the small files, writes the new one and then reads it back to check it
+IO_PER_MERGED_BYTE = 3
+
+
+class CompactionScheduler:
+    """
+    Merges small tsc files in the background while WAL files are being ingested instead of in one big nightly run. It
+    works through the device measures with the most small files first, one merge at a time on its own process, and
+    sleeps after each merge so it stays within io_budget_mb_s of disk I/O and cpu_share of a core. While more than
+    max_backlog WAL files are waiting to be ingested it pauses so it never slows down ingestion. The merged small files
+    are deleted once no WAL files are waiting.
+
+    The device measure being merged is added to the same locked set the ingest loop uses so a WAL file is never
+    ingested into a device measure while its blocks are being moved.
+    """
+
+    def __init__(self, locked_device_measures: set, lock: threading.Lock, io_budget_mb_s: float, cpu_share: float,
+                 max_backlog: int, batch_size: int = 100, idle_wait: float = 300, recheck_wait: float = 10):
+        self._LOGGER = logging.getLogger(__name__)
+        self.locked_device_measures = locked_device_measures
+        self.lock = lock
+        self.io_budget_mb_s = io_budget_mb_s
+        self.cpu_share = min(max(cpu_share, 0.01), 1.0)
+        self.max_backlog = max_backlog
+        # how many device measures to pick each round before looking for the most fragmented ones again
+        self.batch_size = batch_size
+        # how long to wait before looking again when there's nothing to merge
+        self.idle_wait = idle_wait
+        # how often to check if the ingest backlog has cleared
+        self.recheck_wait = recheck_wait
+
+        self.backlog = 0
+        # set once a merge has left small files behind that haven't been deleted yet
+        self.delete_pending = False
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.exception_counter = get_metric(TSCGENERATOR_ERRORS)
+        self.timeout_counter = get_metric(TSCGENERATOR_OPT_TIMEOUT_ERRORS)
+        self.bytes_counter = get_metric(TSCGENERATOR_COMPACTION_BYTES)
+        self.pause_counter = get_metric(TSCGENERATOR_COMPACTION_PAUSES)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="compaction", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def set_backlog(self, num_wal_files: int):
+        self.backlog = num_wal_files
+
+    def _run(self):
+        self._LOGGER.info("Background tsc file compaction started")
+        while not self.stop_event.is_set():
+            try:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    self._compact(executor)
+            except Exception:
+                # keep compacting, an error with one device measure shouldn't stop it for good
+                self._LOGGER.error("Error occurred during background tsc file compaction", exc_info=True)
+                self.exception_counter.add(1)
+                self.stop_event.wait(self.idle_wait)
+        self._LOGGER.info("Background tsc file compaction stopped")
+
+    def _compact(self, executor):
+        sdk = AtriumSDK(dataset_location=config.dataset_location,
+                        metadata_connection_type=config.svc_tsc_gen['metadb_connection']['type'],
+                        connection_params=config.CONNECTION_PARAMS)
+        try:
+            while not self.stop_event.is_set():
+                # pick up any ingested files whose stats weren't recorded because the tsc generator stopped
+                sql_functions.reconcile_file_stats(sdk)
+                device_measures = sql_functions.find_most_fragmented_device_measures(
+                    sdk, config.svc_tsc_gen['target_tsc_file_size'], self.batch_size)
+                if len(device_measures) == 0:
+                    self._delete_merged_files(sdk)
+                    self.stop_event.wait(self.idle_wait)
+                    continue
+
+                for measure_id, device_id in device_measures:
+                    if self._wait_for_ingest():
+                        break
+                    self._merge(sdk, executor, device_id, measure_id)
+                    self.delete_pending = True
+
+                self._delete_merged_files(sdk)
+        finally:
+            sdk.close()
+
+    def _delete_merged_files(self, sdk):
+        # deletes the small files merged so far, but only while there's no ingest backlog. Ingestion adds a tsc file to
+        # the file_index in the same transaction as its blocks so it's never seen as unreferenced, but the delete scans
+        # the whole file_index and removes files from disk so it waits for a quiet moment like the nightly run does
+        if not self.delete_pending or self.backlog > 0:
+            return
+        delete_unreferenced_tsc_files(sdk)
+        self.delete_pending = False
+
+    def _merge(self, sdk, executor, device_id, measure_id):
+        device_measure = self._get_device_measure(sdk, device_id, measure_id)
+        with self.lock:
+            # a WAL file for this device measure is being ingested, it'll get picked again next round
+            if device_measure in self.locked_device_measures:
+                return
+            self.locked_device_measures.add(device_measure)
+
+        start = time.perf_counter()
+        try:
+            future = executor.submit(merge_small_tsc_files, device_id, measure_id)
+            try:
+                num_bytes = future.result(timeout=config.svc_tsc_gen['tsc_file_optimization_timeout'])
+            except TimeoutError:
+                self._LOGGER.warning(f"Compacting tsc files for device_id={device_id}, measure_id={measure_id} is taking "
+                                     f"longer than tsc_file_optimization_timeout, waiting for it to finish")
+                self.timeout_counter.add(1)
+                # the device measure has to stay locked until the merge is really done
+                num_bytes = future.result()
+        finally:
+            with self.lock:
+                self.locked_device_measures.discard(device_measure)
+
+        num_bytes = num_bytes or 0
+        self.bytes_counter.add(num_bytes)
+        self.stop_event.wait(self._get_throttle_time(num_bytes, time.perf_counter() - start))
+
+    def _get_throttle_time(self, num_bytes, duration):
+        # sleep long enough that the average I/O rate stays under the budget
+        io_wait = (num_bytes * IO_PER_MERGED_BYTE) / (self.io_budget_mb_s * 1_000_000) - duration \
+            if self.io_budget_mb_s else 0
+        # and long enough that the time spent merging is only cpu_share of the total
+        cpu_wait = duration * (1 / self.cpu_share - 1)
+        return max(io_wait, cpu_wait, 0)
+
+    def _wait_for_ingest(self):
+        # returns True if compaction was stopped while waiting
+        if self.backlog > self.max_backlog and not self.stop_event.is_set():
+            self._LOGGER.debug(f"{self.backlog} WAL files waiting to be ingested, pausing compaction")
+            self.pause_counter.add(1)
+            while self.backlog > self.max_backlog and not self.stop_event.is_set():
+                self.stop_event.wait(self.recheck_wait)
+        return self.stop_event.is_set()
+
+    @staticmethod
+    def _get_device_measure(sdk, device_id, measure_id):
+        # the same (device tag, measure tag, freq, units) tuple the ingest loop builds from the WAL headers
+        device_info = sdk.get_device_info(device_id)
+        measure_info = sdk.get_measure_info(measure_id)
+        return device_info['tag'], measure_info['tag'], measure_info['freq_nhz'], measure_info['unit']
@@ -20,9 +20,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
+import os
 import yaml
 from pathlib import Path
 
+# the config and secrets files are mounted at the root of the container, this lets tools like the benchmark point
+# somewhere else
+CONFIG_DIR = os.environ.get("TSCGEN_CONFIG_DIR", "/")
+
 
 class Config:
     def __init__(self):
@@ -58,7 +63,7 @@ class Config:
                                       'port': self.svc_tsc_gen['metadb_connection']['port']}
 
     def load_config(self, file_name):
-        stream = open(f"/{file_name}", 'r')
+        stream = open(Path(CONFIG_DIR) / file_name, 'r')
         data = yaml.load(stream, Loader=yaml.FullLoader)
         config_keys = data.keys()
         # keys (k) will be the non-indented headers such as metadb, svc_tsc_gen ect
@@ -81,6 +81,12 @@ TSCGENERATOR_WAL_FILE_EMPTY = METRIC + "empty.wal.files"
 TSCGENERATOR_DUPLICATE_WAL_FILE = METRIC + "duplicate.wal.files"
 TSCGENERATOR_DEVICES_INSERTED = METRIC + "devices.inserted"
 TSCGENERATOR_MEASURES_INSERTED = METRIC + "measures.inserted"
+TSCGENERATOR_COMPACTION_BYTES = METRIC + "compaction.bytes"
+TSCGENERATOR_COMPACTION_PAUSES = METRIC + "compaction.pauses"
+TSCGENERATOR_AUTOTUNE_RESIZES = METRIC + "autotune.resizes"
+TSCGENERATOR_AUTOTUNE_WORKERS = METRIC + "autotune.workers"
+TSCGENERATOR_AUTOTUNE_THREADS = METRIC + "autotune.compression.threads"
+TSCGENERATOR_INGEST_LAG = METRIC + "wal.ingest.lag"
 
 # Set global Metrics module values
 EXPORT_INTERVAL = os.environ.get("OTEL_METRIC_EXPORT_INTERVAL", 5_000)
@@ -150,6 +156,32 @@ def _init_metrics(meter: Meter):
             TSCGENERATOR_MEASURES_INSERTED,
             description="number of measures inserted (should be 0)"
         )
+        compaction_bytes_counter = meter.create_counter(
+            TSCGENERATOR_COMPACTION_BYTES,
+            unit="By",
+            description="number of bytes of small tsc files merged by the background compaction"
+        )
+        compaction_pause_counter = meter.create_counter(
+            TSCGENERATOR_COMPACTION_PAUSES,
+            description="number of times the background compaction paused to let ingestion catch up"
+        )
+        autotune_resize_counter = meter.create_counter(
+            TSCGENERATOR_AUTOTUNE_RESIZES,
+            description="number of times the autotuner resized the ingest pool, labeled with the reason"
+        )
+        autotune_workers_counter = meter.create_up_down_counter(
+            TSCGENERATOR_AUTOTUNE_WORKERS,
+            description="number of ingest worker processes picked by the autotuner"
+        )
+        autotune_threads_counter = meter.create_up_down_counter(
+            TSCGENERATOR_AUTOTUNE_THREADS,
+            description="number of compression threads per ingest worker picked by the autotuner"
+        )
+        ingest_lag_histogram = meter.create_histogram(
+            TSCGENERATOR_INGEST_LAG,
+            unit="s",
+            description="seconds from a wal file being closed to its data being ingested"
+        )
 
         adapter_metrics = {
             TSCGENERATOR_ERRORS: exception_counter,
@@ -161,6 +193,12 @@ def _init_metrics(meter: Meter):
             TSCGENERATOR_DUPLICATE_WAL_FILE: duplicate_wal_file_counter,
             TSCGENERATOR_DEVICES_INSERTED: devices_inserted_counter,
             TSCGENERATOR_MEASURES_INSERTED: measures_inserted_counter,
+            TSCGENERATOR_COMPACTION_BYTES: compaction_bytes_counter,
+            TSCGENERATOR_COMPACTION_PAUSES: compaction_pause_counter,
+            TSCGENERATOR_AUTOTUNE_RESIZES: autotune_resize_counter,
+            TSCGENERATOR_AUTOTUNE_WORKERS: autotune_workers_counter,
+            TSCGENERATOR_AUTOTUNE_THREADS: autotune_threads_counter,
+            TSCGENERATOR_INGEST_LAG: ingest_lag_histogram,
         }
 
         _ADAPTER_METRICS = adapter_metrics
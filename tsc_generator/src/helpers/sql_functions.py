@@ -20,55 +20,239 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
-import math
 from typing import List, Dict
 import os
 
+# the most ids or rows to put in one statement. Deleting or inserting thousands of rows in a few statements is much faster
+# than one statement per row, but it has to stay under the database's limit on the number of placeholders
+SQL_CHUNK_SIZE = 1000
+
+
+# file_index only stores the tsc file's name, this keeps the measure and device directory each file the optimizer has
+# touched is in so it can be found on disk after all of its blocks are gone
+def create_file_location_table(sdk):
+    with sdk.sql_handler.connection() as (conn, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS tsc_file_location (file_id INTEGER PRIMARY KEY, "
+                       "measure_id INTEGER NOT NULL, device_id INTEGER NOT NULL)")
+
+
+# size and time range of every tsc file that has blocks, kept up to date by ingest and the optimizer so finding small
+# files doesn't need to aggregate the whole block_index
+def create_file_stats_table(sdk):
+    with sdk.sql_handler.connection() as (conn, cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS file_stats (file_id INTEGER PRIMARY KEY, measure_id INTEGER NOT NULL, "
+                       "device_id INTEGER NOT NULL, total_bytes BIGINT NOT NULL, num_blocks INTEGER NOT NULL, "
+                       "min_time_n BIGINT NOT NULL, max_time_n BIGINT NOT NULL)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS file_stats_size_idx ON file_stats (total_bytes)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS file_stats_device_measure_idx ON file_stats (measure_id, device_id, total_bytes)")
+
+        # fill it the first time, this is the only time the whole block_index is aggregated
+        cursor.execute("SELECT COUNT(*) FROM file_stats")
+        if cursor.fetchone()[0] == 0:
+            cursor.execute("INSERT INTO file_stats (file_id, measure_id, device_id, total_bytes, num_blocks, min_time_n, max_time_n) "
+                           "SELECT file_id, MIN(measure_id), MIN(device_id), SUM(num_bytes), COUNT(*), MIN(start_time_n), MAX(end_time_n) "
+                           "FROM block_index GROUP BY file_id")
+
+
+def refresh_file_stats(sdk, measure_id, device_id, file_ids: List[int]):
+    with sdk.sql_handler.connection(begin=True) as (conn, cursor):
+        _refresh_file_stats(cursor, measure_id, device_id, file_ids)
+
+
+# recomputes the stats of some files of a device measure from their blocks, files with no blocks left are removed
+def _refresh_file_stats(cursor, measure_id, device_id, file_ids: List[int]):
+    file_ids = list(set(file_ids))
+    _delete_in(cursor, "file_stats", "file_id", file_ids)
+    for chunk in _chunks(file_ids):
+        # measure_id and device_id let this use the block_index's device measure index
+        cursor.execute("INSERT INTO file_stats (file_id, measure_id, device_id, total_bytes, num_blocks, min_time_n, max_time_n) "
+                       "SELECT file_id, measure_id, device_id, SUM(num_bytes), COUNT(*), MIN(start_time_n), MAX(end_time_n) "
+                       "FROM block_index WHERE measure_id = ? AND device_id = ? AND file_id IN ({}) "
+                       "GROUP BY file_id, measure_id, device_id".format(_placeholders(len(chunk))), (measure_id, device_id, *chunk))
+
+
+def refresh_small_file_stats(sdk, measure_id, device_id, target_tsc_file_size):
+    with sdk.sql_handler.connection(begin=True) as (conn, cursor):
+        cursor.execute("SELECT file_id FROM file_stats WHERE measure_id = ? AND device_id = ? AND total_bytes < ?",
+                       (measure_id, device_id, target_tsc_file_size))
+        _refresh_file_stats(cursor, measure_id, device_id, [row[0] for row in cursor.fetchall()])
+
+
+# updates the stats for a file that was just written by ingest. The sdk writes the blocks in its own transaction so
+# this runs right after it, if the tsc generator stops in between reconcile_file_stats fixes it up later
+def record_ingested_file_stats(sdk, measure_id, device_id, file_name):
+    with sdk.sql_handler.connection(begin=True) as (conn, cursor):
+        cursor.execute("SELECT id FROM file_index WHERE path = ?", (file_name,))
+        _record_written_files(cursor, measure_id, device_id, [row[0] for row in cursor.fetchall()])
+
+
+# finds files ingest wrote whose stats were never recorded and records them. Cheap enough to run before every optimizer
+# pass since it only looks at the file_index and the blocks of the files that are missing
+def reconcile_file_stats(sdk):
+    with sdk.sql_handler.connection(begin=True) as (conn, cursor):
+        # unreferenced files waiting to be deleted have no stats either, they just have no blocks to look up
+        cursor.execute("SELECT t1.id FROM file_index t1 LEFT JOIN file_stats t2 ON t1.id = t2.file_id WHERE t2.file_id IS NULL")
+        missing = [row[0] for row in cursor.fetchall()]
+
+        written = {}
+        for chunk in _chunks(missing):
+            cursor.execute("SELECT DISTINCT file_id, measure_id, device_id FROM block_index WHERE file_id IN ({})"
+                           .format(_placeholders(len(chunk))), tuple(chunk))
+            for file_id, measure_id, device_id in cursor.fetchall():
+                written.setdefault((measure_id, device_id), []).append(file_id)
+
+        for (measure_id, device_id), file_ids in written.items():
+            _record_written_files(cursor, measure_id, device_id, file_ids)
+        return sum(len(file_ids) for file_ids in written.values())
+
+
+def _record_written_files(cursor, measure_id, device_id, file_ids: List[int]):
+    # remember where the new files are so they can be deleted directly once the optimizer has merged their blocks away
+    _delete_in(cursor, "tsc_file_location", "file_id", file_ids)
+    _insert_rows(cursor, "INSERT INTO tsc_file_location (file_id, measure_id, device_id) VALUES ",
+                 [(file_id, measure_id, device_id) for file_id in file_ids])
+
+    # when a small write is merged with an existing block the new block covers that block's time range, so any file
+    # that overlaps the new files in time may have lost a block
+    old_file_ids = []
+    for chunk in _chunks(file_ids):
+        cursor.execute("SELECT MIN(start_time_n), MAX(end_time_n) FROM block_index WHERE measure_id = ? AND device_id = ? "
+                       "AND file_id IN ({})".format(_placeholders(len(chunk))), (measure_id, device_id, *chunk))
+        start_time_n, end_time_n = cursor.fetchone()
+        if start_time_n is None:
+            continue
+        cursor.execute("SELECT file_id FROM file_stats WHERE measure_id = ? AND device_id = ? AND min_time_n <= ? "
+                       "AND max_time_n >= ?", (measure_id, device_id, end_time_n, start_time_n))
+        old_file_ids.extend(row[0] for row in cursor.fetchall())
+
+    # the sdk deletes a file itself if the merge took its last block, so forget where it was too
+    for chunk in _chunks(old_file_ids):
+        cursor.execute("DELETE FROM tsc_file_location WHERE file_id IN ({}) AND file_id NOT IN (SELECT id FROM file_index)"
+                       .format(_placeholders(len(chunk))), tuple(chunk))
+    _refresh_file_stats(cursor, measure_id, device_id, file_ids + old_file_ids)
+
 
 def find_unreferenced_tsc_files(sdk):
     with sdk.sql_handler.connection() as (conn, cursor):
-        cursor.execute("SELECT t1.id, t1.path FROM file_index t1 LEFT JOIN (SELECT DISTINCT file_id FROM block_index) t2 "
-                       "ON t1.id = t2.file_id WHERE t2.file_id IS NULL")
+        # measure_id and device_id are null if the file's location wasn't recorded
+        cursor.execute("SELECT t1.id, t1.path, t3.measure_id, t3.device_id FROM file_index t1 LEFT JOIN "
+                       "(SELECT DISTINCT file_id FROM block_index) t2 ON t1.id = t2.file_id "
+                       "LEFT JOIN tsc_file_location t3 ON t1.id = t3.file_id WHERE t2.file_id IS NULL")
         return cursor.fetchall()
 
 
 def find_devices_measures_with_small_tsc_files(sdk, target_tsc_file_size):
     with sdk.sql_handler.connection() as (conn, cursor):
-        cursor.execute("SELECT bi1.measure_id, bi1.device_id FROM block_index bi1 JOIN "
-                       "(SELECT file_id FROM block_index GROUP BY file_id HAVING SUM(num_bytes) < ?) bi2 "
-                       "ON bi1.file_id = bi2.file_id GROUP BY bi1.measure_id, bi1.device_id HAVING COUNT(DISTINCT bi1.file_id) >= 2",
+        cursor.execute("SELECT measure_id, device_id FROM file_stats WHERE total_bytes < ? "
+                       "GROUP BY measure_id, device_id HAVING COUNT(*) >= 2",
                        (target_tsc_file_size,))
         return cursor.fetchall()
 
 
+# same as above but ordered with the device measures that have the most small tsc files first
+def find_most_fragmented_device_measures(sdk, target_tsc_file_size, limit):
+    with sdk.sql_handler.connection() as (conn, cursor):
+        cursor.execute("SELECT measure_id, device_id, COUNT(*) AS num_files FROM file_stats WHERE total_bytes < ? "
+                       "GROUP BY measure_id, device_id HAVING COUNT(*) >= 2 ORDER BY num_files DESC LIMIT ?",
+                       (target_tsc_file_size, limit))
+        return [(row[0], row[1]) for row in cursor.fetchall()]
+
+
 def find_small_tsc_files(sdk, device_id, measure_id, target_tsc_file_size):
     with sdk.sql_handler.connection() as (conn, cursor):
         # order by start and end time so the blocks are rewritten in order
         cursor.execute("SELECT id, measure_id, device_id, file_id, start_byte, num_bytes, start_time_n, end_time_n, num_values"
                        " FROM block_index WHERE measure_id = ? AND device_id = ? AND file_id IN "
-                       "(SELECT file_id FROM block_index WHERE measure_id = ? AND device_id = ? GROUP BY file_id HAVING SUM(num_bytes) < ?) "
+                       "(SELECT file_id FROM file_stats WHERE measure_id = ? AND device_id = ? AND total_bytes < ?) "
                        "ORDER BY start_time_n ASC, end_time_n ASC, id ASC", (measure_id, device_id, measure_id, device_id, target_tsc_file_size))
         return cursor.fetchall()
 
 
+# all the blocks of a device measure that overlap a time range, in the same order as find_small_tsc_files
+def select_blocks_in_time_range(sdk, measure_id, device_id, start_time_n, end_time_n):
+    with sdk.sql_handler.connection() as (conn, cursor):
+        cursor.execute("SELECT id, measure_id, device_id, file_id, start_byte, num_bytes, start_time_n, end_time_n, num_values"
+                       " FROM block_index WHERE measure_id = ? AND device_id = ? AND start_time_n <= ? AND end_time_n >= ? "
+                       "ORDER BY start_time_n ASC, end_time_n ASC, id ASC", (measure_id, device_id, end_time_n, start_time_n))
+        return cursor.fetchall()
+
+
 # this one is for when you delete blocks then insert new ones
 def update_block_tsc_data(sdk, file_names: List[str], blocks_old: List[Dict], block_batch_slices, start_byte_array):
     with sdk.sql_handler.connection(begin=True) as (conn, cursor):
+        new_file_ids = []
         for i, file_name in enumerate(file_names):
             # insert file_path into file_index and get id
             cursor.execute("INSERT INTO file_index (path) VALUES (?);", (file_name,))
             file_id = cursor.lastrowid
+            new_file_ids.append(file_id)
 
             blocks = blocks_old[block_batch_slices[i][0]:block_batch_slices[i][1]]
             start_bytes = start_byte_array[block_batch_slices[i][0]:block_batch_slices[i][1]]
 
             # insert into block_index
             block_tuples = [(block[1], block[2], file_id, start_byte, block[5], block[6], block[7], block[8]) for start_byte, block in zip(start_bytes, blocks)]
+            _insert_blocks(cursor, block_tuples)
+
+        _replace_old_blocks(cursor, new_file_ids, blocks_old)
+
+
+# this one is for when runs of small blocks were decoded and re-encoded into full sized blocks in a new tsc file
+def reblock_tsc_data(sdk, file_name, block_data: List[Dict], blocks_old: List[tuple]):
+    with sdk.sql_handler.connection(begin=True) as (conn, cursor):
+        cursor.execute("INSERT INTO file_index (path) VALUES (?);", (file_name,))
+        file_id = cursor.lastrowid
+
+        block_tuples = [(block["measure_id"], block["device_id"], file_id, block["start_byte"], block["num_bytes"],
+                         block["start_time_n"], block["end_time_n"], block["num_values"]) for block in block_data]
+        _insert_blocks(cursor, block_tuples)
+
+        _replace_old_blocks(cursor, [file_id], blocks_old)
+
+
+def _replace_old_blocks(cursor, new_file_ids: List[int], blocks_old):
+    # remember where the old files and the new ones are so they can be deleted without searching for them
+    locations = {row[3]: (row[3], row[1], row[2]) for row in blocks_old}
+    for file_id in new_file_ids:
+        locations[file_id] = (file_id, blocks_old[0][1], blocks_old[0][2])
+    _delete_in(cursor, "tsc_file_location", "file_id", list(locations))
+    _insert_rows(cursor, "INSERT INTO tsc_file_location (file_id, measure_id, device_id) VALUES ", list(locations.values()))
+
+    _delete_in(cursor, "block_index", "id", [row[0] for row in blocks_old])
 
-            cursor.executemany("INSERT INTO block_index (measure_id, device_id, file_id, start_byte, num_bytes, start_time_n, end_time_n, num_values) "
-                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?);", block_tuples)
+    # the new files have all their blocks now and the old ones have lost some or all of theirs
+    _refresh_file_stats(cursor, blocks_old[0][1], blocks_old[0][2], list(locations))
 
-        cursor.executemany("DELETE FROM block_index WHERE id = ?;", [(row[0],) for row in blocks_old])
+
+def _chunks(items):
+    for i in range(0, len(items), SQL_CHUNK_SIZE):
+        yield items[i:i + SQL_CHUNK_SIZE]
+
+
+def _placeholders(num):
+    return ','.join(['?'] * num)
+
+
+def _delete_in(cursor, table, column, ids):
+    for chunk in _chunks(ids):
+        cursor.execute("DELETE FROM {} WHERE {} IN ({})".format(table, column, _placeholders(len(chunk))), tuple(chunk))
+
+
+# inserts rows with multi row INSERT statements, insert is everything before the VALUES lists
+def _insert_rows(cursor, insert, rows):
+    for chunk in _chunks(rows):
+        values = ','.join(["({})".format(_placeholders(len(row))) for row in chunk])
+        cursor.execute(insert + values, tuple(value for row in chunk for value in row))
+
+
+# sqlite spells it INSERT OR IGNORE, mariadb and mysql INSERT IGNORE
+def _insert_ignore(sdk):
+    return "INSERT OR IGNORE" if sdk.metadata_connection_type == "sqlite" else "INSERT IGNORE"
+
+
+def _insert_blocks(cursor, block_tuples):
+    _insert_rows(cursor, "INSERT INTO block_index (measure_id, device_id, file_id, start_byte, num_bytes, start_time_n, "
+                         "end_time_n, num_values) VALUES ", block_tuples)
 
 
 def select_blocks_by_file(sdk, file_names: List[str]):
@@ -84,12 +268,12 @@ def select_blocks_by_file(sdk, file_names: List[str]):
 
 
 def delete_tsc_files(sdk, file_ids_to_delete: List[tuple]):
+    file_ids = [row[0] for row in file_ids_to_delete]
     with sdk.sql_handler.connection(begin=False) as (conn, cursor):
-
-        # if you put too many rows in the delete statement mariadb will fail. So we split it up
-        for i in range(math.ceil(len(file_ids_to_delete)/100_000)):
-            # delete old tsc files
-            cursor.executemany("DELETE FROM file_index WHERE id = ?;", file_ids_to_delete[i*100_000:(i+1)*100_000])
+        # delete old tsc files
+        _delete_in(cursor, "file_index", "id", file_ids)
+        _delete_in(cursor, "tsc_file_location", "file_id", file_ids)
+        _delete_in(cursor, "file_stats", "file_id", file_ids)
 
 
 # this one is for when you delete blocks then insert new ones
@@ -98,16 +282,27 @@ def undo_changes(sdk, filename_list, original_block_list):
     # possible. Its also faster so less chance of it being interrupted
     with sdk.sql_handler.connection(begin=False) as (conn, cursor):
         # reinsert the original blocks that were deleted to the block index. The blocks may not have been deleted yet so use insert ignore
-        cursor.executemany("INSERT IGNORE INTO block_index (id, measure_id, device_id, file_id, start_byte, num_bytes, start_time_n, end_time_n, num_values) "
-                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);", original_block_list)
+        _insert_rows(cursor, _insert_ignore(sdk) + " INTO block_index (id, measure_id, device_id, file_id, start_byte, "
+                             "num_bytes, start_time_n, end_time_n, num_values) VALUES ", original_block_list)
+
+        # look up the ids of the new files once instead of in every statement
+        new_file_ids = []
+        for chunk in _chunks(filename_list):
+            cursor.execute("SELECT id FROM file_index WHERE path IN ({})".format(_placeholders(len(chunk))), tuple(chunk))
+            new_file_ids.extend(row[0] for row in cursor.fetchall())
 
         # delete the new optimized blocks that were added
-        filename_tuples = [(row,) for row in filename_list]
-        cursor.executemany("DELETE FROM block_index WHERE file_id = (SELECT id FROM file_index WHERE path = ?)", filename_tuples)
+        _delete_in(cursor, "block_index", "file_id", new_file_ids)
+
+        # put the stats of the original files back and remove the new ones
+        _delete_in(cursor, "file_stats", "file_id", new_file_ids)
+        _refresh_file_stats(cursor, original_block_list[0][1], original_block_list[0][2],
+                            [row[3] for row in original_block_list])
 
         # delete the tsc files from disk
         for file in filename_list:
             os.remove(sdk.file_api.to_abs_path(filename=file, measure_id=original_block_list[0][1], device_id=original_block_list[0][2]))
 
         # remove tsc files from the file index
-        cursor.executemany("DELETE FROM file_index WHERE path = ?", filename_tuples)
\ No newline at end of file
+        _delete_in(cursor, "tsc_file_location", "file_id", new_file_ids)
+        _delete_in(cursor, "file_index", "id", new_file_ids)
\ No newline at end of file
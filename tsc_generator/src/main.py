@@ -21,6 +21,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 import sys
+import ctypes
 import signal
 import time
 import numpy as np
@@ -29,10 +30,14 @@ from atriumdb import AtriumSDK
 from wal import WALHeaderStructure
 from helpers import sql_functions
 from directory import get_file_iter
+import tsc_gen_process
 from tsc_gen_process import tsc_generator_process
 from optimizer import delete_unreferenced_tsc_files, merge_small_tsc_files
+from compaction import CompactionScheduler
+from autotune import WorkerAutotuner
+from scheduling import WalScheduler
 from config import config
-from threading import Event
+from threading import Event, Lock
 from logging import getLogger, Formatter, StreamHandler
 from concurrent.futures import ProcessPoolExecutor, TimeoutError
 from helpers.metrics import (get_metric,
@@ -42,11 +47,15 @@ from helpers.metrics import (get_metric,
                              TSCGENERATOR_CORRUPTED_WAL_FILE,
                              TSCGENERATOR_PROCESSED_WAL_FILE,
                              TSCGENERATOR_WAL_FILE_EMPTY,
-                             TSCGENERATOR_DUPLICATE_WAL_FILE)
+                             TSCGENERATOR_DUPLICATE_WAL_FILE,
+                             TSCGENERATOR_INGEST_LAG)
 
 # stop event for graceful exit of the tsc generator
 EXIT_EVENT = Event()
 
+# only the header is needed to schedule a WAL file
+WAL_HEADER_SIZE = ctypes.sizeof(WALHeaderStructure)
+
 # set up logging
 _LOGGER = getLogger()
 fmt = Formatter(fmt="%(asctime)s  %(name)s - %(levelname)s %(threadName)s - %(message)s")
@@ -64,6 +73,15 @@ def run_tsc_generator():
                                  database_type=config.svc_tsc_gen['metadb_connection']['type'],
                                  connection_params=config.CONNECTION_PARAMS, overwrite='ignore')
 
+    # create the tables the tsc generator keeps alongside the sdk's before any workers start
+    sdk = AtriumSDK(dataset_location=config.dataset_location,
+                    metadata_connection_type=config.svc_tsc_gen['metadb_connection']['type'],
+                    connection_params=config.CONNECTION_PARAMS)
+    sql_functions.create_file_location_table(sdk)
+    sql_functions.create_file_stats_table(sdk)
+    sql_functions.reconcile_file_stats(sdk)
+    sdk.close()
+
     # Set up open telemetry metrics
     counter_dict = {-4: get_metric(TSCGENERATOR_WAL_TIMEOUT_ERRORS),
                     -3: get_metric(TSCGENERATOR_OPT_TIMEOUT_ERRORS),
@@ -75,44 +93,104 @@ def run_tsc_generator():
 
     _LOGGER.info("TSC generator started")
 
+    # this will contain the measure device combinations that are currently being ingested or compacted
+    locked_device_measures = set()
+    # the compaction scheduler uses the locked set from its own thread
+    device_measure_lock = Lock()
+
+    # "nightly" runs the tsc file optimizer once a day at tsc_optimizer_run_time, "continuous" compacts in the background
+    compaction_scheduler = None
+    if config.svc_tsc_gen.get('compaction_mode', 'nightly') == 'continuous':
+        compaction_scheduler = CompactionScheduler(
+            locked_device_measures, device_measure_lock,
+            io_budget_mb_s=config.svc_tsc_gen.get('compaction_io_budget_mb_s', 50),
+            cpu_share=config.svc_tsc_gen.get('compaction_cpu_share', 0.25),
+            max_backlog=config.svc_tsc_gen.get('compaction_max_backlog', 100),
+            recheck_wait=config.svc_tsc_gen['wait_recheck_time'])
+        compaction_scheduler.start()
+
+    try:
+        _ingest_loop(counter_dict, locked_device_measures, device_measure_lock, compaction_scheduler)
+    finally:
+        if compaction_scheduler is not None:
+            compaction_scheduler.stop()
+
+
+def _new_executor(max_workers, num_compression_threads):
+    return ProcessPoolExecutor(max_workers=max_workers, initializer=tsc_gen_process.init_worker,
+                               initargs=(num_compression_threads,))
+
+
+def _ingest_loop(counter_dict, locked_device_measures, device_measure_lock, compaction_scheduler):
     # need this since if the optimizer finishes within an hour of starting it may try run again
     opt_ran_today = False
 
-    with ProcessPoolExecutor(max_workers=config.svc_tsc_gen['max_workers']) as executor:
-        # this will contain the measure device combinations that are currently being ingested
-        locked_device_measures = set()
-
+    # resizes the worker pool and the compression threads each worker uses to suit the WAL files waiting
+    autotuner = None
+    if config.svc_tsc_gen.get('autotune_workers', False):
+        autotuner = WorkerAutotuner(
+            config.svc_tsc_gen['max_workers'], config.svc_tsc_gen['num_compression_threads'],
+            max_cores=config.svc_tsc_gen.get('autotune_max_cores'),
+            max_compression_threads=config.svc_tsc_gen.get('autotune_max_compression_threads', 4),
+            large_file_bytes=config.svc_tsc_gen.get('autotune_large_file_bytes', 16 * 1024 * 1024),
+            file_timeout=config.svc_tsc_gen['wal_file_timeout'])
+
+    # the order this round's WAL files are handed to the workers in
+    scheduling_policy = config.svc_tsc_gen.get('scheduling_policy', 'fifo')
+    lag_histogram = get_metric(TSCGENERATOR_INGEST_LAG)
+
+    executor = _new_executor(config.svc_tsc_gen['max_workers'], config.svc_tsc_gen['num_compression_threads'])
+    try:
         while not EXIT_EVENT.is_set():
             futures = []
             file_iter = get_file_iter(config.svc_wal_writer['wal_folder_path'])
+            num_wal_files = 0
+            scheduler = WalScheduler(scheduling_policy)
 
             for wal_path in file_iter:
+                num_wal_files += 1
                 # decode the wal header only so we can get device and measure information
-                wal_header = WALHeaderStructure.from_buffer(np.fromfile(wal_path, dtype=np.uint8))
+                wal_header = WALHeaderStructure.from_buffer(np.fromfile(wal_path, dtype=np.uint8, count=WAL_HEADER_SIZE))
+                wal_stat = wal_path.stat()
+                if autotuner is not None:
+                    autotuner.observe_file(wal_stat.st_size, wal_header.mode)
 
                 # extract the measure and device information from the header then make it into a tuple
                 device_measure = (wal_header.device_name.decode('utf-8'), wal_header.measure_name.decode('utf-8'),
                                   wal_header.sample_freq, wal_header.measure_units.decode('utf-8'))
+                scheduler.push(wal_path, device_measure, wal_stat.st_size, wal_stat.st_mtime, wal_header.file_start_time)
+
+            # the autotuner only wants how long the submitted files took, not the header scan above
+            submit_start = time.perf_counter()
+            for wal_file in scheduler:
+                wal_path, device_measure = wal_file['path'], wal_file['device_measure']
 
                 # if a wal file containing this measure device combination is not being already ingested then ingest it
                 # This is to avoid a race condition in the block merging code where if two processes try to work on the
                 # the same measure device combo they could both read the block information perform their respective merges
                 # then add two blocks back to the block index where only one should be (creating a ton of duplication)
-                if device_measure not in locked_device_measures:
-                    # lock this measure device combo by adding it to the locked set
-                    locked_device_measures.add(device_measure)
+                with device_measure_lock:
+                    is_locked = device_measure in locked_device_measures
+                    if not is_locked:
+                        # lock this measure device combo by adding it to the locked set
+                        locked_device_measures.add(device_measure)
 
+                if not is_locked:
                     future = executor.submit(tsc_generator_process, wal_path, device_measure)
-                    futures.append(future)
+                    futures.append((future, wal_file['mtime']))
 
-            for future in futures:
+            for future, wal_mtime in futures:
                 try:
                     response_code, device_measure = future.result(timeout=config.svc_tsc_gen['wal_file_timeout'])
                     # use dictionary to avoid large if-else block
                     counter_dict[response_code].add(1)
+                    if response_code == 0:
+                        # how long the data sat in the WAL folder after the file was closed
+                        lag_histogram.record(time.time() - wal_mtime)
 
                     # remove the measure device combo from the locked set so other wal file with this combo can be ingested
-                    locked_device_measures.remove(device_measure)
+                    with device_measure_lock:
+                        locked_device_measures.remove(device_measure)
 
                     # if there is some kind of error saving the data to atriumdb exit the program
                     if response_code == -2:
@@ -124,12 +202,24 @@ def run_tsc_generator():
                     counter_dict[-4].add(1)
                     EXIT_EVENT.set()
 
+            # let background compaction know how far behind ingestion is
+            if compaction_scheduler is not None:
+                compaction_scheduler.set_backlog(num_wal_files)
+
+            if autotuner is not None:
+                autotuner.observe_round(time.perf_counter() - submit_start, len(futures))
+                new_size = autotuner.end_round()
+                if new_size is not None and not EXIT_EVENT.is_set():
+                    # all of this round's files are done so the old workers can be replaced
+                    executor.shutdown(wait=True)
+                    executor = _new_executor(*new_size)
+
             # If there are no wal files that need to be ingested wait before rechecking
             if len(futures) == 0:
                 EXIT_EVENT.wait(config.svc_tsc_gen['wait_recheck_time'])
 
             # check if it's time to run the tsc file optimizer
-            if not opt_ran_today and dt.datetime.now().hour == config.svc_tsc_gen['tsc_optimizer_run_time']:
+            if compaction_scheduler is None and not opt_ran_today and dt.datetime.now().hour == config.svc_tsc_gen['tsc_optimizer_run_time']:
                 futures = []
                 sdk = AtriumSDK(dataset_location=config.dataset_location,
                                 metadata_connection_type=config.svc_tsc_gen['metadb_connection']['type'],
@@ -137,6 +227,8 @@ def run_tsc_generator():
 
                 tik = time.perf_counter()
                 _LOGGER.info("Starting TSC file optimization. Finding device measures with small tsc...")
+                # pick up any ingested files whose stats weren't recorded because the tsc generator stopped
+                sql_functions.reconcile_file_stats(sdk)
                 # find the measure device combinations that have undersized tsc files
                 device_measures_small_tsc = sql_functions.find_devices_measures_with_small_tsc_files(sdk, config.svc_tsc_gen['target_tsc_file_size'])
                 _LOGGER.debug(f"Finding device measures with small tsc files took {time.perf_counter() - tik} s")
@@ -175,6 +267,8 @@ def run_tsc_generator():
             if opt_ran_today and (dt.datetime.now().hour == config.svc_tsc_gen['tsc_optimizer_run_time'] - 1 or
                                   (config.svc_tsc_gen['tsc_optimizer_run_time'] == 0 and dt.datetime.now().hour == 23)):
                 opt_ran_today = False
+    finally:
+        executor.shutdown(wait=True)
 
 
 def signal_handler(signo, _frame):
@@ -25,13 +25,22 @@ import logging
 import time
 import xxhash
 import os
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from config import config
 from atriumdb import AtriumSDK, adb_functions
 from helpers import sql_functions
+from helpers.metrics import get_metric, TSCGENERATOR_ERRORS
+from write_tsc import T_TYPE_TIMESTAMP_ARRAY_INT64_NANO, T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO
 
 
 # the max number of blocks to optimize for a run
 MAX_BLOCKS_PER_RUN = 100_000
+# size of each read when copying blocks into new tsc files and when verifying the checksum of the new tsc files
+READ_SIZE = 8 * 1024 * 1024
+# the most full sized blocks worth of small blocks to decode at one time when re-blocking, this bounds the memory used
+REBLOCK_MAX_RUN_BLOCKS = 64
 sdk = None
 
 _LOGGER = logging.getLogger(__name__)
@@ -51,6 +60,22 @@ def merge_small_tsc_files(device_id, measure_id):
                                                     target_tsc_file_size=config.svc_tsc_gen['target_tsc_file_size'])
     _LOGGER.debug(f"Finding small tsc files took {time.perf_counter() - tik} s, for device_id={device_id}, measure_id={measure_id}")
 
+    # rewrite runs of small blocks into full sized ones first, the new file is merged below like any other small file
+    reblocked_bytes, reblock_failed = 0, False
+    if config.svc_tsc_gen.get('reblock_small_blocks', False) and len(block_list) > 0:
+        try:
+            reblocked_bytes = reblock_small_blocks(sdk, device_id, measure_id, block_list[:MAX_BLOCKS_PER_RUN])
+        except Exception:
+            # re-blocking is only an improvement, if it fails the files still get merged with the blocks as they are
+            _LOGGER.error(f"Error occurred while re-blocking small blocks for device_id={device_id}, measure_id={measure_id}, "
+                          f"merging the blocks as they are", exc_info=True)
+            get_metric(TSCGENERATOR_ERRORS).add(1)
+            reblock_failed = True
+        # runs finished before an error are in a new file too, so look the blocks up again either way
+        if reblocked_bytes > 0 or reblock_failed:
+            block_list = sql_functions.find_small_tsc_files(sdk=sdk, device_id=device_id, measure_id=measure_id,
+                                                            target_tsc_file_size=config.svc_tsc_gen['target_tsc_file_size'])
+
     # we need to make sure that 100_000 blocks is not smaller than the target_tsc_file_size because if it is than
     # the optimizer will never reach the desired file size and will get stuck optimizing the same data over and over
     bytes_total, idx = 0, 0
@@ -73,13 +98,13 @@ def merge_small_tsc_files(device_id, measure_id):
     # if there is only one tsc file then don't optimize since there is only one partly full tsc file
     num_tsc_fles = len(set([block[3] for block in block_list]))
     if num_tsc_fles < 2:
-        return 0
-
-    tik = time.perf_counter()
-    # checksum data to ensure before and after data are the same
-    checksum_before = checksum_data(sdk, block_list)
+        # the file stats said there was more than one small file, they must be out of date so fix them
+        sql_functions.refresh_small_file_stats(sdk, measure_id, device_id, config.svc_tsc_gen['target_tsc_file_size'])
+        return reblocked_bytes
 
-    _LOGGER.debug(f"Check summing took {time.perf_counter() - tik} s, for device_id={device_id}, measure_id={measure_id}")
+    # checksum the data as it's read for the merge to ensure before and after data are the same. The batches cover the
+    # whole block list in order so this is the same as reading all the blocks up front
+    checksum_before = xxhash.xxh3_128()
 
     _LOGGER.debug(f"Merging {num_tsc_fles} tsc files for device_id={device_id}, measure_id={measure_id}")
 
@@ -90,17 +115,23 @@ def merge_small_tsc_files(device_id, measure_id):
     filenames = []
     try:
         tik = time.perf_counter()
-        for block_batch_idxs in block_batch_slices:
-            # make read list as small as possible to speed up process
-            read_list = adb_functions.condense_byte_read_list(block_list[block_batch_idxs[0]:block_batch_idxs[1]])
-            # extract file ids from condensed read list and get the tsc file names they map to
-            file_id_list = [row[2] for row in read_list]
-            filename_dict = sdk.get_filename_dict(file_id_list)
-
-            # get encoded bytes from small tsc files
-            encoded_bytes = sdk.file_api.read_file_list(read_list, filename_dict)
-            # write the new tsc file to disk that contains the info
-            filenames.append(sdk.file_api.write_bytes(measure_id, device_id, encoded_bytes))
+        num_threads = config.svc_tsc_gen.get('merge_read_threads', 4)
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for block_batch_idxs in block_batch_slices:
+                # make read list as small as possible to speed up process
+                read_list = adb_functions.condense_byte_read_list(block_list[block_batch_idxs[0]:block_batch_idxs[1]])
+                # extract file ids from condensed read list and get the tsc file names they map to
+                file_id_list = [row[2] for row in read_list]
+                filename_dict = sdk.get_filename_dict(file_id_list)
+
+                # stream the encoded bytes from the small tsc files into the new one, the next pieces are read while
+                # the current one is being written
+                filename = sdk.file_api.generate_tsc_filename(measure_id, device_id)
+                with open(sdk.file_api.to_abs_path(filename, measure_id, device_id), 'wb') as file:
+                    filenames.append(filename)
+                    for piece in read_pipelined(sdk, read_list, filename_dict, executor, 2 * num_threads):
+                        checksum_before.update(piece)
+                        file.write(piece)
 
         # insert the new filenames and their associated blocks. Then delete the old blocks in one transaction
         sql_functions.update_block_tsc_data(sdk, filenames, block_list, block_batch_slices, start_byte_array)
@@ -113,9 +144,9 @@ def merge_small_tsc_files(device_id, measure_id):
         # checksum the new blocks
         checksum_after = checksum_data(sdk, new_blocks)
 
-        _LOGGER.debug(f"Second check summing took {time.perf_counter() - tik} s, for device_id={device_id}, measure_id={measure_id}")
+        _LOGGER.debug(f"Check summing took {time.perf_counter() - tik} s, for device_id={device_id}, measure_id={measure_id}")
         # make sure checksums match
-        assert checksum_after == checksum_before
+        assert checksum_after == checksum_before.hexdigest()
 
     # If checksums do not equal each other or there is another error undo the changes
     except AssertionError as e:
@@ -126,6 +157,8 @@ def merge_small_tsc_files(device_id, measure_id):
         sql_functions.undo_changes(sdk, filenames, original_block_list=block_list)
 
     _LOGGER.debug(f"Finished merging tsc files for device_id={device_id}, measure_id={measure_id}")
+    # the number of bytes merged, used to keep background compaction within its I/O budget
+    return reblocked_bytes + sum(block[5] for block in block_list)
 
 
 def make_optimal_tsc_files(block_list):
@@ -150,26 +183,244 @@ def make_optimal_tsc_files(block_list):
     return start_byte_array, block_batch_slices
 
 
-# This function is used to confirm that the data before the optimization is the same as the data after the optimization
+# merging files copies the encoded blocks as they are, so this decodes runs of neighbouring blocks that are smaller than
+# optimal_block_num_values and encodes them again as full sized blocks. Returns the number of bytes that were rewritten
+def reblock_small_blocks(sdk, device_id, measure_id, block_list):
+    block_size = sdk.block.block_size
+    # the blocks in bigger files are needed too, a run can't be joined across a block that sits between them in time
+    all_blocks = sql_functions.select_blocks_in_time_range(sdk, measure_id, device_id, block_list[0][6],
+                                                           max(block[7] for block in block_list))
+    runs = find_small_block_runs(all_blocks, block_size)
+    if len(runs) == 0:
+        return 0
+
+    _LOGGER.debug(f"Re-blocking {sum(len(run) for run in runs)} small blocks in {len(runs)} runs for device_id={device_id}, measure_id={measure_id}")
+    # aperiodic signals are written with a frequency of 1 nHz
+    freq_nhz = sdk.get_measure_info(measure_id)['freq_nhz'] or 1
+
+    rewritten_bytes = 0
+    # the re-encoded runs are collected into tsc files of about the target size
+    pending = []
+    for run in runs:
+        rewritten_bytes += sum(block[5] for block in run)
+        pending.extend(reblock_run(sdk, run, freq_nhz))
+
+        if sum(encoded_bytes.size for _, encoded_bytes, _ in pending) >= config.svc_tsc_gen['target_tsc_file_size']:
+            write_reblocked_file(sdk, device_id, measure_id, pending)
+            pending = []
+
+    if len(pending) > 0:
+        write_reblocked_file(sdk, device_id, measure_id, pending)
+
+    return rewritten_bytes
+
+
+# splits the ordered blocks of a device measure into runs of small blocks that don't overlap in time and would fit in
+# fewer blocks if they were encoded together
+def find_small_block_runs(blocks, block_size):
+    runs, run = [], []
+    max_run_values = REBLOCK_MAX_RUN_BLOCKS * block_size
+
+    for block in blocks:
+        if block[8] < block_size and len(run) > 0 and run[-1][7] < block[6] and \
+                sum(b[8] for b in run) + block[8] <= max_run_values:
+            run.append(block)
+            continue
+
+        runs.append(run)
+        run = [block] if block[8] < block_size else []
+    runs.append(run)
+
+    return [run for run in runs if math.ceil(sum(block[8] for block in run) / block_size) < len(run)]
+
+
+# decodes a run of blocks and encodes it again at the sdk's block size. Returns (old blocks, encoded bytes, headers)
+# for each part of the run that was re-encoded, parts with blocks that were encoded differently are done separately
+def reblock_run(sdk, run, freq_nhz):
+    read_list = adb_functions.condense_byte_read_list(run)
+    filename_dict = sdk.get_filename_dict([row[2] for row in read_list])
+    encoded_bytes = sdk.file_api.read_file_list(read_list, filename_dict)
+
+    num_bytes = np.array([block[5] for block in run], dtype=np.uint64)
+    byte_start_array = np.concatenate([np.array([0], dtype=np.uint64), np.cumsum(num_bytes, dtype=np.uint64)[:-1]])
+    headers = sdk.block.decode_headers(encoded_bytes, byte_start_array)
+
+    # blocks can only be encoded together if they were written the same way
+    keys = [(h.t_raw_type, h.t_encoded_type, h.v_raw_type, h.v_encoded_type, h.scale_m, h.scale_b, h.t_compression,
+             h.t_compression_level, h.v_compression, h.v_compression_level) for h in headers]
+
+    results, start = [], 0
+    for i in range(1, len(run) + 1):
+        if i < len(run) and keys[i] == keys[start]:
+            continue
+
+        part = run[start:i]
+        if keys[start][0] in (T_TYPE_TIMESTAMP_ARRAY_INT64_NANO, T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO) and \
+                math.ceil(sum(block[8] for block in part) / sdk.block.block_size) < len(part):
+            part_bytes = encoded_bytes[int(byte_start_array[start]):int(byte_start_array[i - 1] + num_bytes[i - 1])]
+            result = reencode_blocks(sdk, part, part_bytes, headers[start:i], freq_nhz)
+            if result is not None:
+                results.append(result)
+        start = i
+
+    return results
+
+
+def reencode_blocks(sdk, blocks, encoded_bytes, headers, freq_nhz):
+    num_bytes_list = [block[5] for block in blocks]
+    h = headers[0]
+    t_raw_type, t_encoded_type, v_raw_type, v_encoded_type = h.t_raw_type, h.t_encoded_type, h.v_raw_type, h.v_encoded_type
+    scale_m, scale_b, start_n = h.scale_m, h.scale_b, int(h.start_n)
+    # decode_blocks edits the headers in the bytes it's given so copy the values needed before decoding
+    block_info = [(int(h.start_n), int(h.num_vals), int(h.num_gaps)) for h in headers]
+
+    # asking for the time type the blocks were written with leaves their times as they are, gap arrays stay gap arrays
+    times, values, _ = sdk.block.decode_blocks(encoded_bytes.copy(), num_bytes_list, analog=False, time_type=t_raw_type)
+    if t_raw_type == T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO:
+        times = join_gap_arrays(times, block_info, freq_nhz)
+
+    # use the same compression the blocks were written with (aperiodic signals compress their times)
+    old_compression = (sdk.block.t_compression, sdk.block.t_compression_level, sdk.block.v_compression, sdk.block.v_compression_level)
+    sdk.block.t_compression, sdk.block.t_compression_level = h.t_compression, h.t_compression_level
+    sdk.block.v_compression, sdk.block.v_compression_level = h.v_compression, h.v_compression_level
+    try:
+        new_bytes, new_headers, new_byte_starts = sdk.block.encode_blocks(
+            times=times, values=values, freq_nhz=freq_nhz, start_ns=start_n, raw_time_type=t_raw_type,
+            raw_value_type=v_raw_type, encoded_time_type=t_encoded_type, encoded_value_type=v_encoded_type,
+            scale_m=scale_m, scale_b=scale_b)
+    finally:
+        sdk.block.t_compression, sdk.block.t_compression_level, sdk.block.v_compression, sdk.block.v_compression_level = old_compression
+
+    # make sure the new blocks decode to exactly the same timestamps and values as the old ones
+    times_before, values_before, _ = sdk.block.decode_blocks(encoded_bytes.copy(), num_bytes_list, analog=False, time_type=1)
+    new_num_bytes = [nh.meta_num_bytes + nh.t_num_bytes + nh.v_num_bytes for nh in new_headers]
+    times_after, values_after, _ = sdk.block.decode_blocks(new_bytes.copy(), new_num_bytes, analog=False, time_type=1)
+    if not (np.array_equal(times_before, times_after) and np.array_equal(values_before, values_after, equal_nan=True)):
+        _LOGGER.warning(f"Re-encoded blocks don't match the originals for blocks {blocks[0][0]}-{blocks[-1][0]} of "
+                        f"device_id={blocks[0][2]}, measure_id={blocks[0][1]}, leaving them as they are")
+        return None
+
+    return blocks, new_bytes, (new_headers, new_byte_starts)
+
+
+# the gap arrays of decoded blocks each start counting from their own first value, this joins them into one gap array
+# for all the values adding a gap between blocks where the next block doesn't start right after the last one ended
+def join_gap_arrays(gap_data, block_info, freq_nhz):
+    joined, offset, value_offset, end_time = [], 0, 0, None
+    for start_n, num_vals, num_gaps in block_info:
+        gaps = gap_data[offset:offset + 2 * num_gaps].reshape(-1, 2).copy()
+        offset += 2 * num_gaps
+
+        if end_time is not None and start_n != end_time:
+            joined.append(np.array([[value_offset, start_n - end_time]], dtype=np.int64))
+        gaps[:, 0] += value_offset
+        joined.append(gaps)
+
+        # same as how the sdk finds the end of gap data when it merges it
+        end_time = start_n + (num_vals * (10 ** 18)) // freq_nhz + int(np.sum(gaps[:, 1]))
+        value_offset += num_vals
+
+    return np.concatenate(joined, axis=None).astype(np.int64)
+
+
+def write_reblocked_file(sdk, device_id, measure_id, reencoded):
+    blocks_old, block_data, byte_arrays, start_byte = [], [], [], 0
+    for blocks, encoded_bytes, (headers, byte_start_array) in reencoded:
+        new_block_data, _ = adb_functions.get_block_and_interval_data(
+            measure_id, device_id, headers, np.asarray(byte_start_array, dtype=np.uint64) + np.uint64(start_byte), [])
+        block_data.extend(new_block_data)
+        blocks_old.extend(blocks)
+        byte_arrays.append(encoded_bytes)
+        start_byte += encoded_bytes.size
+    encoded_bytes = np.concatenate(byte_arrays, axis=None)
+
+    filename = None
+    try:
+        filename = sdk.file_api.write_bytes(measure_id, device_id, encoded_bytes)
+        # add the new blocks and delete the ones they replace in one transaction
+        sql_functions.reblock_tsc_data(sdk, filename, block_data, blocks_old)
+
+        # make sure what was written to disk is what was encoded
+        new_blocks = sql_functions.select_blocks_by_file(sdk, [filename])
+        assert checksum_data(sdk, new_blocks) == xxhash.xxh3_128(encoded_bytes).hexdigest()
+        _LOGGER.debug(f"Re-blocked {len(blocks_old)} blocks into {len(block_data)} for device_id={device_id}, measure_id={measure_id}")
+    except Exception:
+        _LOGGER.error(f"Error occurred while re-blocking for device_id={device_id}, measure_id={measure_id}, restoring old blocks and deleting new ones", exc_info=True, stack_info=True)
+        if filename is not None:
+            sql_functions.undo_changes(sdk, [filename], original_block_list=blocks_old)
+
+
+# This function is used to confirm that the data after the optimization is the same as the data before the optimization
 def checksum_data(sdk, block_list):
     num_chunks = math.ceil(len(block_list) / config.svc_tsc_gen['num_blocks_checksum'])
+    num_threads = config.svc_tsc_gen.get('checksum_read_threads', 4)
     checksum = xxhash.xxh3_128()
 
-    for i in range(num_chunks):
-        # make read list as small as possible to speed up process
-        read_list = adb_functions.condense_byte_read_list(block_list[i * config.svc_tsc_gen['num_blocks_checksum']:(i + 1) * config.svc_tsc_gen['num_blocks_checksum']])
-        # extract file ids from condensed read list and get the tsc file names they map to
-        file_id_list = [row[2] for row in read_list]
-        filename_dict = sdk.get_filename_dict(file_id_list)
-        # get encoded bytes from tsc files
-        encoded_bytes = sdk.file_api.read_file_list(read_list, filename_dict)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for i in range(num_chunks):
+            # make read list as small as possible to speed up process
+            read_list = adb_functions.condense_byte_read_list(block_list[i * config.svc_tsc_gen['num_blocks_checksum']:(i + 1) * config.svc_tsc_gen['num_blocks_checksum']])
+            # extract file ids from condensed read list and get the tsc file names they map to
+            file_id_list = [row[2] for row in read_list]
+            filename_dict = sdk.get_filename_dict(file_id_list)
 
-        # update the checksum
-        checksum.update(encoded_bytes)
+            for piece in read_pipelined(sdk, read_list, filename_dict, executor, 2 * num_threads):
+                checksum.update(piece)
 
     return checksum.hexdigest()
 
 
+# reads the bytes of a condensed read list in order. The reads run on the executor ahead of the caller into a fixed number
+# of buffers that are reused, so reading overlaps with whatever the caller does with the bytes and memory use is bounded.
+# Each piece yielded is only valid until the next one is asked for
+def read_pipelined(sdk, read_list, filename_dict, executor, num_buffers):
+    open_files, reads, pending = {}, [], deque()
+    try:
+        for measure_id, device_id, file_id, start_byte, num_bytes in read_list:
+            if file_id not in open_files:
+                open_files[file_id] = os.open(sdk.file_api.to_abs_path(filename_dict[file_id], measure_id, device_id), os.O_RDONLY)
+            fd = open_files[file_id]
+            # let the kernel start reading ahead before the threads ask for the bytes
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, start_byte, num_bytes, os.POSIX_FADV_WILLNEED)
+            # split big reads up so one file is read by more than one thread
+            for offset in range(start_byte, start_byte + num_bytes, READ_SIZE):
+                reads.append((fd, offset, min(READ_SIZE, start_byte + num_bytes - offset)))
+
+        # small reads don't need full sized buffers
+        buffer_size = max([size for _, _, size in reads], default=0)
+        free_buffers = [bytearray(buffer_size) for _ in range(min(num_buffers, len(reads)))]
+        reads = iter(reads)
+
+        def submit_next_read():
+            read = next(reads, None)
+            if read is not None:
+                fd, offset, size = read
+                buffer = free_buffers.pop()
+                pending.append((executor.submit(_read_into, fd, memoryview(buffer)[:size], offset), buffer))
+
+        for _ in range(num_buffers):
+            submit_next_read()
+
+        while pending:
+            future, buffer = pending.popleft()
+            yield future.result()
+            # the caller is done with the buffer so it can be read into again
+            free_buffers.append(buffer)
+            submit_next_read()
+    finally:
+        # don't close the files out from under reads that are still running if something went wrong
+        wait([future for future, _ in pending])
+        for fd in open_files.values():
+            os.close(fd)
+
+
+def _read_into(fd, view, offset):
+    if os.preadv(fd, [view], offset) != len(view):
+        raise OSError(f"Short read of {len(view)} bytes at offset {offset} from a tsc file")
+    return view
+
+
 def delete_unreferenced_tsc_files(sdk):
     _LOGGER.info("Starting removal of unreferenced tsc files")
     # find tsc files in the file_index that have no references to them in the block_index
@@ -180,27 +431,50 @@ def delete_unreferenced_tsc_files(sdk):
         _LOGGER.info("No unreferenced tsc files to remove")
         return
 
-    # extract file names from files and make it a set so we can do a set intersection later
-    file_names = {file[1] for file in files}
+    # files the optimizer has recorded the location of can be deleted directly, the rest have to be searched for
+    paths = [sdk.file_api.to_abs_path(file[1], file[2], file[3]) for file in files if file[2] is not None]
+    unresolved_names = {file[1] for file in files if file[2] is None}
     # extract the ids and put them in a tuple so we can remove them from the sql table later
     file_ids = [(file[0],) for file in files]
 
-    # walk the tsc directory looking for files to delete (walk is a generator for memory efficiency)
-    for root, dir_names, files in os.walk(sdk.file_api.top_level_dir):
-        # remove any dirs that are not digits (device_id or measure_id) so walk doesn't traverse those directories
-        dir_names[:] = [d for d in dir_names if d.isdigit()]
-
-        # check if there is a match between any of the tsc file names to be deleted and files in the current directory
-        matches = set(files) & file_names
-
-        # if you find a match remove the file from disk
-        for m in matches:
-            _LOGGER.debug(f"Deleting tsc file {m} from disk")
-            os.remove(os.path.join(root, m))
-
-    # free up memory
-    del file_names
+    if len(unresolved_names) > 0:
+        _LOGGER.info(f"Searching the tsc directory for {len(unresolved_names)} tsc files with no recorded location")
+        # walk the tsc directory looking for files to delete (walk is a generator for memory efficiency)
+        for root, dir_names, dir_files in os.walk(sdk.file_api.top_level_dir):
+            # remove any dirs that are not digits (device_id or measure_id) so walk doesn't traverse those directories
+            dir_names[:] = [d for d in dir_names if d.isdigit()]
+
+            # check if there is a match between any of the tsc file names to be deleted and files in the current directory
+            matches = set(dir_files) & unresolved_names
+            paths.extend(os.path.join(root, m) for m in matches)
+            unresolved_names -= matches
+
+            # stop as soon as they have all been found
+            if len(unresolved_names) == 0:
+                break
+
+    # delete the files in batches on a thread pool since each delete mostly waits on the file system
+    batch_size = 1000
+    batches = [paths[i:i + batch_size] for i in range(0, len(paths), batch_size)]
+    num_deleted = 0
+    with ThreadPoolExecutor(max_workers=config.svc_tsc_gen.get('delete_threads', 8)) as executor:
+        for deleted in executor.map(_delete_files, batches):
+            num_deleted += deleted
+            _LOGGER.info(f"Deleted {num_deleted}/{len(paths)} unreferenced tsc files from disk")
 
     # remove them from the file_index
     sql_functions.delete_tsc_files(sdk, file_ids)
-    _LOGGER.info("Completed removal of unreferenced tsc files")
\ No newline at end of file
+    _LOGGER.info("Completed removal of unreferenced tsc files")
+
+
+def _delete_files(paths):
+    deleted = 0
+    for path in paths:
+        _LOGGER.debug(f"Deleting tsc file {path} from disk")
+        try:
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            # already gone, nothing to do
+            pass
+    return deleted
@@ -21,6 +21,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 from wal import WALReader, WALHeaderStructure
+from config import config
 import ctypes
 
 
@@ -28,5 +29,11 @@ def read_wal_file(wal_path):
     wal_data = WALReader(wal_path).read_all()
     if wal_data.byte_arr.size < ctypes.sizeof(WALHeaderStructure):
         return None
-    wal_data.interpret_byte_array()
+
+    # big files (usually from catching up on a backlog) are decoded on several threads
+    decode_threads = config.svc_tsc_gen.get('wal_decode_threads', 1)
+    if decode_threads > 1 and wal_data.byte_arr.size >= config.svc_tsc_gen.get('parallel_decode_min_bytes', 67108864):
+        wal_data.interpret_parallel(decode_threads)
+    else:
+        wal_data.interpret_byte_array()
     return wal_data
@@ -0,0 +1,95 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import heapq
+import logging
+from collections import defaultdict
+
+
+def _fifo(wal_file, device_files):
+    return wal_file['mtime']
+
+
+def _shortest_job_first(wal_file, device_files):
+    return wal_file['size'], wal_file['mtime']
+
+
+def _deadline(wal_file, device_files):
+    # the data that was recorded longest ago has been waiting the longest to show up in atriumdb
+    return wal_file['file_start_time'], wal_file['mtime']
+
+
+def _fair(wal_file, device_files):
+    # take turns between devices so one device with a lot of measures can't fill up all the workers
+    return device_files, wal_file['mtime']
+
+
+# each policy turns a WAL file (and how many files of its device are already queued) into a sort key, smallest first
+SCHEDULING_POLICIES = {"fifo": _fifo, "sjf": _shortest_job_first, "deadline": _deadline, "fair": _fair}
+
+
+class WalScheduler:
+    """
+    Orders the WAL files found in one pass over the WAL folder. Only the oldest file of each device measure is queued,
+    its other files are left for later rounds so a device measure's data is always ingested in the order it was
+    written and two workers never work on the same device measure. The oldest files are then handed out in the order
+    of the scheduling policy:
+
+    - fifo: oldest modified first
+    - sjf: smallest first, so big catch up files don't hold up the small ones behind them
+    - deadline: earliest file_start_time first
+    - fair: one device measure from each device at a time, oldest first
+    """
+
+    def __init__(self, policy: str = "fifo"):
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError("scheduling_policy {} not in {}".format(policy, list(SCHEDULING_POLICIES)))
+        self._LOGGER = logging.getLogger(__name__)
+        self.policy = policy
+        self.priority = SCHEDULING_POLICIES[policy]
+        self.heap = []
+        self.queued_device_measures = set()
+        self.device_files = defaultdict(int)
+
+    def push(self, wal_path, device_measure, size: int, mtime: float, file_start_time: int):
+        # files arrive oldest first so anything after the first one for a device measure has to wait
+        if device_measure in self.queued_device_measures:
+            return
+        self.queued_device_measures.add(device_measure)
+
+        wal_file = {'path': wal_path, 'device_measure': device_measure, 'size': size, 'mtime': mtime,
+                    'file_start_time': file_start_time}
+        device_name = device_measure[0]
+        key = self.priority(wal_file, self.device_files[device_name])
+        self.device_files[device_name] += 1
+        # the counter keeps the heap from comparing the dictionaries when two keys are the same
+        heapq.heappush(self.heap, (key, len(self.queued_device_measures), wal_file))
+
+    def __len__(self):
+        return len(self.heap)
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def __iter__(self):
+        while self.heap:
+            yield self.pop()
@@ -28,6 +28,13 @@ from write_tsc import write_wal_data_to_sdk
 
 _LOGGER = logging.getLogger(__name__)
 atrium_sdk = None
+# set by init_worker when the pool is sized by the autotuner
+num_compression_threads = None
+
+
+def init_worker(compression_threads):
+    global num_compression_threads
+    num_compression_threads = compression_threads
 
 
 def tsc_generator_process(wal_path, device_measure):
@@ -35,7 +42,8 @@ def tsc_generator_process(wal_path, device_measure):
 
     if atrium_sdk is None:
         atrium_sdk = AtriumSDK(dataset_location=config.dataset_location, metadata_connection_type=config.svc_tsc_gen['metadb_connection']['type'],
-                               connection_params=config.CONNECTION_PARAMS, num_threads=config.svc_tsc_gen['num_compression_threads'])
+                               connection_params=config.CONNECTION_PARAMS,
+                               num_threads=num_compression_threads or config.svc_tsc_gen['num_compression_threads'])
         atrium_sdk.block.block_size = config.svc_tsc_gen['optimal_block_num_values']
 
     wal_data = read_wal_file(wal_path)
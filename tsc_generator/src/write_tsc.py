@@ -25,6 +25,7 @@ import logging
 from atriumdb import create_gap_arr
 from wal import ValueMode
 from config import config
+from helpers import sql_functions
 from helpers.metrics import (get_metric,
                              TSCGENERATOR_DEVICES_INSERTED,
                              TSCGENERATOR_MEASURES_INSERTED)
@@ -110,6 +111,8 @@ def write_wal_data_to_sdk(wal_data, sdk):
         raise ValueError("{} not in {}.".format(h.mode, list(ValueMode)))
 
     if np.issubdtype(value_data.dtype, np.integer):
+        # the wal writer may store ints in a narrower type to save space, the sdk expects int64
+        value_data = value_data.astype(np.int64, copy=False)
         raw_v_t = V_TYPE_INT64
         encoded_v_t = V_TYPE_DELTA_INT64
     else:
@@ -136,7 +139,7 @@ def write_wal_data_to_sdk(wal_data, sdk):
         raise NotImplementedError("Aperiodic mode (freq=0) has not been implemented for gap arrays yet")
 
 
-    sdk.write_data(
+    _, _, _, file_name = sdk.write_data(
         measure_id, device_id, time_arr, value_data, h.sample_freq, int(wal_data.time_data[0]),
         raw_time_type=t_t, raw_value_type=raw_v_t, encoded_time_type=t_t, encoded_value_type=encoded_v_t,
         scale_b=h.scale_0, scale_m=h.scale_1, interval_index_mode=config.svc_tsc_gen['interval_index_mode'],
@@ -146,6 +149,9 @@ def write_wal_data_to_sdk(wal_data, sdk):
     sdk.block.t_compression = 1
     sdk.block.t_compression_level = 0
 
+    # keep the tsc file sizes the optimizer plans with up to date
+    sql_functions.record_ingested_file_stats(sdk, measure_id, device_id, file_name)
+
     return 0
 
 
@@ -0,0 +1,269 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+import orjson
+
+# ********************************************************************************************************************
+# Runs generated WAL files through the TSC generator's ingest loop and tsc_generator_process in process, no docker or
+# MariaDB needed. Each combination of max_workers and num_compression_threads ingests the same WAL files into its own
+# throwaway sqlite dataset built from deploy/config_example.yaml. Needs the requirements in requirements.txt installed
+# (including open telemetry, the tsc generator imports it). Run from anywhere with:
+#   python tsc_generator/test/benchmark.py --devices 20 --files-per-signal 5 --max-workers 1,2,4
+# ********************************************************************************************************************
+
+TSC_GENERATOR_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(TSC_GENERATOR_DIR.parent / "lib"))
+
+from wal import ValueMode, WALData
+from wal.io.data import supported_versions
+from tests.wal_data_generator import generate_header_dict, generate_time_data_from_header, generate_value_data_from_header
+from tests.benchmark_helpers import StageTimer, write_config, import_service_main, peak_rss_mb
+
+PHASES = ("read", "interpret", "gap_array", "write_data", "metadata", "total")
+# the worker processes append the phase times of each WAL file here
+TIMINGS_ENV = "TSCGEN_BENCH_TIMINGS"
+REQUIRED_MODULES = ("atriumdb", "opentelemetry")
+
+# set up in each worker process the first time it's given a WAL file
+_timer = None
+_timed_process = None
+
+
+def _instrument_worker():
+    """Wraps the pieces of tsc_generator_process in the worker process so each phase can be timed."""
+    global _timer, _timed_process
+    if _timer is not None:
+        return
+    import read_wal
+    import write_tsc
+    import tsc_gen_process
+    from atriumdb import AtriumSDK
+    from helpers import sql_functions
+
+    _timer = StageTimer()
+    read_wal.WALReader.read_all = _timer.wrap("read", read_wal.WALReader.read_all)
+    WALData.interpret_byte_array = _timer.wrap("interpret", WALData.interpret_byte_array)
+    WALData.interpret_parallel = _timer.wrap("interpret", WALData.interpret_parallel)
+    write_tsc.create_gap_arr = _timer.wrap("gap_array", write_tsc.create_gap_arr)
+    write_tsc.create_gap_arr_from_variable_messages = _timer.wrap("gap_array", write_tsc.create_gap_arr_from_variable_messages)
+    AtriumSDK.write_data = _timer.wrap("write_data", AtriumSDK.write_data)
+    for func in ('get_measure_id', 'get_device_id', 'insert_measure', 'insert_device'):
+        setattr(AtriumSDK, func, _timer.wrap("metadata", getattr(AtriumSDK, func)))
+    sql_functions.record_ingested_file_stats = _timer.wrap("metadata", sql_functions.record_ingested_file_stats)
+    _timed_process = _timer.wrap("total", tsc_gen_process.tsc_generator_process)
+
+
+def timed_tsc_generator_process(wal_path, device_measure):
+    """Runs tsc_generator_process and records how long each phase took and the worker's peak RSS."""
+    _instrument_worker()
+    _timer.clear()
+    response = _timed_process(wal_path, device_measure)
+
+    record = {"phases": _timer.totals(), "max_rss_mb": peak_rss_mb(), "end": time.time()}
+    fd = os.open(os.environ[TIMINGS_ENV], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, orjson.dumps(record) + b"\n")
+    finally:
+        os.close(fd)
+    return response
+
+
+class ResponseCounter:
+    """Stands in for the open telemetry counters, stops the ingest loop once every WAL file has a response."""
+
+    def __init__(self, counts: dict, response_code: int, num_files: int, exit_event):
+        self.counts = counts
+        self.response_code = response_code
+        self.num_files = num_files
+        self.exit_event = exit_event
+
+    def add(self, amount):
+        self.counts[self.response_code] = self.counts.get(self.response_code, 0) + amount
+        if sum(self.counts.values()) >= self.num_files:
+            self.exit_event.set()
+
+
+def write_run_config(config_dir: Path, run_dir: Path, max_workers: int, compression_threads: int, args):
+    write_config(config_dir, run_dir / "dataset", {
+        'svc_wal_writer': {'wal_folder_path': str(run_dir / "wal")},
+        'svc_tsc_gen': {'metadb_connection': "bench_metadb", 'max_workers': max_workers,
+                        'num_compression_threads': compression_threads, 'create_dataset': True,
+                        'default_wait_close_time': 0, 'wait_recheck_time': 0.1, 'tsc_optimizer_run_time': -1,
+                        'compaction_mode': "nightly", 'wal_decode_threads': args.decode_threads,
+                        'autotune_workers': args.autotune, 'scheduling_policy': args.scheduling_policy}})
+
+
+def generate_wal_files(wal_dir: Path, args):
+    """Writes WAL files shaped like the WAL writer's, returns the number of samples in them."""
+    wal_dir.mkdir(parents=True, exist_ok=True)
+    intervals = args.mode == "intervals"
+    samples_per_message = args.samples_per_message if intervals else 1
+    sample_freq = int(args.sample_rate * 10 ** 9)
+    message_period = (samples_per_message * (10 ** 18)) // sample_freq
+    # the wal writer stores waveforms in variable sized messages (samples_per_message=0) as int16 with scale factors
+    scale_fs = np.array([-0.4, 0.0003907204, 0.0, 0.0], dtype=np.dtype("<f8"))
+
+    rng = np.random.default_rng(42)
+    num_samples, paths = 0, []
+    start_times = {}
+    for file_i in range(args.files_per_signal):
+        for device in range(args.devices):
+            for measure in range(args.measures_per_device):
+                signal = (device, measure)
+                start_time = start_times.get(signal, 1_700_000_000 * 10 ** 9)
+                header = generate_header_dict(
+                    "bench-device-{}".format(device).encode(), 3, ValueMode.INTERVALS.value if intervals else ValueMode.TIME_VALUE_PAIRS.value,
+                    sample_freq, samples_per_message, scale_fs, 1, start_time, 1, max(supported_versions),
+                    "BENCH_WAVE_{}".format(measure).encode(), b"mV")
+
+                # the generator shapes the times and values from the samples per message in the header
+                nominal_times, server_times = generate_time_data_from_header(header, args.messages_per_file)
+                values = generate_value_data_from_header(header, args.messages_per_file)
+                # its values are random bytes which don't compress at all, real waveforms are much smoother
+                value_arr = values[0] if intervals else values
+                value_arr = (np.sin(np.arange(value_arr.size) / 20) * 1000 + rng.normal(0, 20, value_arr.size)).astype(
+                    value_arr.dtype).reshape(value_arr.shape)
+                if intervals:
+                    header['samples_per_message'] = 0
+                    wal_data = WALData.from_interval_data(header, nominal_times, server_times, value_arr, *values[1:])
+                else:
+                    wal_data = WALData.from_time_value_data(header, nominal_times, server_times, value_arr)
+                wal_data.prepare_byte_array()
+
+                path = wal_dir / "{:04d}-{:04d}-{:04d}.wal".format(file_i, device, measure)
+                wal_data.byte_arr.tofile(path)
+                paths.append(path)
+                num_samples += args.messages_per_file * samples_per_message
+                start_times[signal] = int(nominal_times[-1]) + message_period
+
+    # the tsc generator ingests the oldest files first so give them increasing modified times
+    now = time.time() - len(paths)
+    for i, path in enumerate(paths):
+        os.utime(path, (now + i, now + i))
+    return num_samples, len(paths)
+
+
+def run_benchmark(main, config, source_dir: Path, run_dir: Path, num_files: int):
+    from atriumdb import AtriumSDK
+    from helpers import sql_functions
+
+    shutil.copytree(source_dir, run_dir / "wal", copy_function=shutil.copy2)
+    AtriumSDK.create_dataset(dataset_location=config.dataset_location, database_type="sqlite", overwrite='ignore')
+    sdk = AtriumSDK(dataset_location=config.dataset_location, metadata_connection_type="sqlite")
+    sql_functions.create_file_location_table(sdk)
+    sql_functions.create_file_stats_table(sdk)
+    sdk.close()
+
+    timings_path = run_dir / "timings.jsonl"
+    os.environ[TIMINGS_ENV] = str(timings_path)
+    main.tsc_generator_process = timed_tsc_generator_process
+    main.EXIT_EVENT.clear()
+
+    counts = {}
+    counter_dict = {code: ResponseCounter(counts, code, num_files, main.EXIT_EVENT) for code in (-4, -3, -2, -1, 0, 1, 2)}
+
+    start_time = time.time()
+    start = time.perf_counter()
+    main._ingest_loop(counter_dict, set(), Lock(), None)
+    elapsed = time.perf_counter() - start
+
+    records = [orjson.loads(line) for line in timings_path.read_bytes().splitlines()] if timings_path.exists() else []
+    timer = StageTimer()
+    for record in records:
+        for phase, seconds in record["phases"].items():
+            timer.add(phase, seconds)
+        # every file is waiting when the run starts so this is how long each one took to catch up on
+        timer.add("lag", record["end"] - start_time)
+    peak_rss = max([record["max_rss_mb"] for record in records] + [peak_rss_mb()])
+    return elapsed, counts, timer, peak_rss
+
+
+def report(elapsed, counts, timer, peak_rss, num_files, num_samples, max_workers, compression_threads):
+    print("max_workers={} num_compression_threads={}".format(max_workers, compression_threads))
+    print("  Elapsed: {:.2f}s  Files: {:.1f} files/s  Samples: {:.0f} samples/s".format(
+        elapsed, num_files / elapsed, num_samples / elapsed))
+    print("  Responses: {}".format(counts))
+    print("  Time per WAL file in each phase, and the ingest lag of each file:")
+    timer.report(PHASES + ("lag",))
+    print("  Peak RSS of one process: {:.1f} MB".format(peak_rss))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="In process throughput benchmark for the TSC generator")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--measures-per-device", type=int, default=2)
+    parser.add_argument("--files-per-signal", type=int, default=5, help="WAL files written for each device measure")
+    parser.add_argument("--messages-per-file", type=int, default=1_000)
+    parser.add_argument("--samples-per-message", type=int, default=256)
+    parser.add_argument("--sample-rate", type=float, default=500, help="sample rate in Hz")
+    parser.add_argument("--mode", choices=["intervals", "tvp"], default="intervals",
+                        help="waveforms (intervals) or metrics (time value pairs)")
+    parser.add_argument("--max-workers", type=str, default="1,2,4", help="comma separated values to try")
+    parser.add_argument("--compression-threads", type=str, default="1", help="comma separated values to try")
+    parser.add_argument("--decode-threads", type=int, default=1, help="wal_decode_threads")
+    parser.add_argument("--autotune", action="store_true", help="let the autotuner resize the pool during each run")
+    parser.add_argument("--scheduling-policy", type=str, default="fifo", help="fifo, sjf, deadline or fair")
+    parser.add_argument("--work-dir", type=str, default=None, help="defaults to a new temporary directory")
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="tscgen-bench-")).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    source_dir = work_dir / "source"
+    num_samples, num_files = generate_wal_files(source_dir, args)
+
+    runs = [(int(w), int(c)) for w in args.max_workers.split(",") for c in args.compression_threads.split(",")]
+
+    write_run_config(work_dir, work_dir / "run-0", *runs[0], args)
+    main = import_service_main(TSC_GENERATOR_DIR / "src", "TSCGEN_CONFIG_DIR", work_dir, REQUIRED_MODULES)
+    from config import config
+
+    print("Work dir: {}".format(work_dir))
+    print("WAL files: {} ({:.1f} MB, {} samples, {})".format(
+        num_files, sum(f.stat().st_size for f in source_dir.glob("*.wal")) / 2 ** 20, num_samples, args.mode))
+
+    for i, (max_workers, compression_threads) in enumerate(runs):
+        run_dir = work_dir / "run-{}".format(i)
+        # workers started with spawn load the config file again so keep it in step with the loaded config
+        write_run_config(work_dir, run_dir, max_workers, compression_threads, args)
+        config.dataset_location = str(run_dir / "dataset")
+        config.svc_wal_writer['wal_folder_path'] = str(run_dir / "wal")
+        config.svc_tsc_gen['max_workers'] = max_workers
+        config.svc_tsc_gen['num_compression_threads'] = compression_threads
+        config.svc_tsc_gen['autotune_workers'] = args.autotune
+        config.svc_tsc_gen['scheduling_policy'] = args.scheduling_policy
+
+        elapsed, counts, timer, peak_rss = run_benchmark(main, config, source_dir, run_dir, num_files)
+        report(elapsed, counts, timer, peak_rss, num_files, num_samples, max_workers, compression_threads)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,118 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from unittest import mock
+import autotune
+from autotune import WorkerAutotuner
+from wal import ValueMode
+
+# run from the tsc_generator/src directory with the service's requirements and config, for example:
+#   TSCGEN_CONFIG_DIR=/path/to/config python -m pytest ../test/test_autotune.py
+
+MB = 1024 * 1024
+
+
+def make_tuner(stable_rounds=3):
+    return WorkerAutotuner(workers=8, threads=1, max_cores=8, max_compression_threads=4, large_file_bytes=16 * MB,
+                           file_timeout=120, stable_rounds=stable_rounds)
+
+
+def observe(tuner, num_files, size_bytes, mode):
+    for _ in range(num_files):
+        tuner.observe_file(size_bytes, mode)
+
+
+class TestWorkerAutotuner(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(autotune.os, "getloadavg", return_value=(1.0, 1.0, 1.0))
+        self.getloadavg = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_small_files(self):
+        tuner = make_tuner()
+        observe(tuner, 10, 64 * 1024, ValueMode.TIME_VALUE_PAIRS.value)
+        # big metric files are still metric files
+        observe(tuner, 2, 64 * MB, ValueMode.TIME_VALUE_PAIRS.value)
+        self.assertEqual(tuner.propose(), (8, 1, "small_files"))
+
+    def test_large_files(self):
+        tuner = make_tuner()
+        observe(tuner, 10, 40 * MB, ValueMode.INTERVALS.value)
+        # a typical 40 MB file gets 3 threads, which leaves room for 2 workers in 8 cores
+        self.assertEqual(tuner.propose(), (2, 3, "large_files"))
+
+        # as long as they are at least half the queue
+        observe(tuner, 11, 64 * 1024, ValueMode.TIME_VALUE_PAIRS.value)
+        self.assertEqual(tuner.propose(), (8, 1, "small_files"))
+
+    def test_threads_capped(self):
+        tuner = make_tuner()
+        observe(tuner, 4, 1024 * MB, ValueMode.INTERVALS.value)
+        self.assertEqual(tuner.propose(), (2, 4, "large_files"))
+
+    def test_slow_files(self):
+        tuner = make_tuner()
+        observe(tuner, 10, 64 * 1024, ValueMode.TIME_VALUE_PAIRS.value)
+        # 8 files taking 100 s side by side on 8 workers is 100 s a file, more than half the 120 s timeout
+        tuner.observe_round(100, 8)
+        self.assertEqual(tuner.propose(), (4, 2, "slow_files"))
+
+    def test_latency_smoothing(self):
+        tuner = make_tuner()
+        tuner.observe_round(10, 0)
+        self.assertIsNone(tuner.latency)
+        # 16 files on 8 workers in 20 s is 10 s a file
+        tuner.observe_round(20, 16)
+        self.assertAlmostEqual(tuner.latency, 10)
+        tuner.observe_round(20, 1)
+        self.assertAlmostEqual(tuner.latency, 12)
+
+    def test_cpu_overloaded(self):
+        tuner = make_tuner()
+        observe(tuner, 10, 64 * 1024, ValueMode.TIME_VALUE_PAIRS.value)
+        self.getloadavg.return_value = (20.0, 20.0, 20.0)
+        # a core is taken away from the 8 workers x 1 thread running now
+        self.assertEqual(tuner.propose(), (7, 1, "cpu_overloaded"))
+
+    def test_stable_rounds(self):
+        tuner = make_tuner()
+        for _ in range(2):
+            observe(tuner, 10, 40 * MB, ValueMode.INTERVALS.value)
+            self.assertIsNone(tuner.end_round())
+        # a round that agrees with the current size starts the count over
+        observe(tuner, 10, 64 * 1024, ValueMode.TIME_VALUE_PAIRS.value)
+        self.assertIsNone(tuner.end_round())
+        for _ in range(2):
+            observe(tuner, 10, 40 * MB, ValueMode.INTERVALS.value)
+            self.assertIsNone(tuner.end_round())
+
+        observe(tuner, 10, 40 * MB, ValueMode.INTERVALS.value)
+        self.assertEqual(tuner.end_round(), (2, 3))
+        self.assertEqual((tuner.workers, tuner.threads), (2, 3))
+        # rounds with no files don't count either way
+        self.assertIsNone(tuner.end_round())
+
+
+if __name__ == '__main__':
+    unittest.main()
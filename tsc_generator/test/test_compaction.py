@@ -0,0 +1,105 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import threading
+import unittest
+from unittest import mock
+import compaction
+from compaction import CompactionScheduler
+
+# run from the tsc_generator/src directory with the service's requirements and config, for example:
+#   TSCGEN_CONFIG_DIR=/path/to/config python -m pytest ../test/test_compaction.py
+
+
+class FakeCounter:
+    def __init__(self):
+        self.value = 0
+
+    def add(self, amount, attributes=None):
+        self.value += amount
+
+
+def make_scheduler(io_budget_mb_s=10, cpu_share=0.5, max_backlog=5):
+    scheduler = CompactionScheduler(set(), threading.Lock(), io_budget_mb_s=io_budget_mb_s, cpu_share=cpu_share,
+                                    max_backlog=max_backlog, recheck_wait=0.01)
+    scheduler.pause_counter = FakeCounter()
+    return scheduler
+
+
+class TestCompactionScheduler(unittest.TestCase):
+
+    def test_throttle_io_budget(self):
+        # 10 MB merged is 30 MB of I/O, 3 seconds at 10 MB/s of which 1 second was already spent merging
+        self.assertAlmostEqual(make_scheduler()._get_throttle_time(10_000_000, 1), 2)
+
+    def test_throttle_cpu_share(self):
+        # with half a core the scheduler sleeps as long as the merge took
+        self.assertAlmostEqual(make_scheduler()._get_throttle_time(1000, 1), 1)
+        # no I/O budget means only the cpu share limits it
+        self.assertAlmostEqual(make_scheduler(io_budget_mb_s=0, cpu_share=0.25)._get_throttle_time(10_000_000, 1), 3)
+        # the cpu share is clamped so a full core never sleeps
+        self.assertEqual(make_scheduler(io_budget_mb_s=0, cpu_share=2)._get_throttle_time(1000, 1), 0)
+
+    def test_no_wait_under_backlog(self):
+        scheduler = make_scheduler()
+        scheduler.set_backlog(5)
+        self.assertFalse(scheduler._wait_for_ingest())
+        self.assertEqual(scheduler.pause_counter.value, 0)
+
+    def test_wait_until_backlog_clears(self):
+        scheduler = make_scheduler()
+        scheduler.set_backlog(6)
+        timer = threading.Timer(0.05, scheduler.set_backlog, args=(0,))
+        timer.start()
+        self.assertFalse(scheduler._wait_for_ingest())
+        timer.join()
+        self.assertEqual(scheduler.backlog, 0)
+        self.assertEqual(scheduler.pause_counter.value, 1)
+
+    def test_wait_stopped(self):
+        scheduler = make_scheduler()
+        scheduler.set_backlog(6)
+        timer = threading.Timer(0.05, scheduler.stop_event.set)
+        timer.start()
+        self.assertTrue(scheduler._wait_for_ingest())
+        timer.join()
+
+    def test_delete_waits_for_empty_backlog(self):
+        scheduler = make_scheduler()
+        with mock.patch.object(compaction, "delete_unreferenced_tsc_files") as delete:
+            # nothing merged yet
+            scheduler._delete_merged_files(None)
+            delete.assert_not_called()
+
+            scheduler.delete_pending = True
+            scheduler.set_backlog(1)
+            scheduler._delete_merged_files(None)
+            delete.assert_not_called()
+
+            scheduler.set_backlog(0)
+            scheduler._delete_merged_files(None)
+            delete.assert_called_once_with(None)
+            self.assertFalse(scheduler.delete_pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from atriumdb import AtriumSDK
+import optimizer
+from config import config
+from helpers import sql_functions
+from write_tsc import (T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO, V_TYPE_INT64, V_TYPE_DELTA_INT64, V_TYPE_DOUBLE)
+
+# run from the tsc_generator/src directory with the service's requirements and config, for example:
+#   TSCGEN_CONFIG_DIR=/path/to/config python -m pytest ../test/test_reblock.py
+
+FREQ_NHZ = 500 * 10 ** 9
+PERIOD_NS = 10 ** 18 // FREQ_NHZ
+BLOCK_SIZE = 100
+VALUES_PER_WRITE = 30
+START_NS = 1_700_000_000 * 10 ** 9
+
+
+class TestReblock(unittest.TestCase):
+
+    def setUp(self):
+        self.dataset_dir = tempfile.mkdtemp()
+        self.sdk = AtriumSDK.create_dataset(dataset_location=self.dataset_dir, database_type="sqlite")
+        sql_functions.create_file_location_table(self.sdk)
+        sql_functions.create_file_stats_table(self.sdk)
+        self.sdk.block.block_size = BLOCK_SIZE
+        self.measure_id = self.sdk.insert_measure("TEST_WAVE", FREQ_NHZ, "mV", freq_units="nHz")
+        self.device_id = self.sdk.insert_device("test-device")
+
+    def tearDown(self):
+        self.sdk.close()
+        shutil.rmtree(self.dataset_dir)
+
+    def write_small_blocks(self, value_types):
+        """Writes one small block per value type, each in its own tsc file like separate WAL files would be."""
+        all_times, all_values, start = [], [], START_NS
+        for i, value_type in enumerate(value_types):
+            # one gap inside every block, and a gap right at the start of the fourth block so it doesn't start where
+            # the one before it ended
+            if i == 3:
+                start += 1_000_000_000
+            gap_array = np.array([10, 2 * PERIOD_NS], dtype=np.int64)
+            times = start + np.arange(VALUES_PER_WRITE, dtype=np.int64) * PERIOD_NS
+            times[10:] += 2 * PERIOD_NS
+            start = int(times[-1]) + PERIOD_NS
+
+            if value_type == V_TYPE_INT64:
+                values = np.arange(i * VALUES_PER_WRITE, (i + 1) * VALUES_PER_WRITE, dtype=np.int64)
+                encoded_value_type = V_TYPE_DELTA_INT64
+            else:
+                values = np.linspace(i, i + 1, VALUES_PER_WRITE)
+                encoded_value_type = V_TYPE_DOUBLE
+
+            _, _, _, file_name = self.sdk.write_data(
+                self.measure_id, self.device_id, gap_array, values, FREQ_NHZ, int(times[0]),
+                raw_time_type=T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO, raw_value_type=value_type,
+                encoded_time_type=T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO, encoded_value_type=encoded_value_type,
+                merge_blocks=False)
+            sql_functions.record_ingested_file_stats(self.sdk, self.measure_id, self.device_id, file_name)
+            all_times.append(times)
+            all_values.append(values)
+        return np.concatenate(all_times), np.concatenate(all_values)
+
+    def blocks(self):
+        return sql_functions.select_blocks_in_time_range(self.sdk, self.measure_id, self.device_id, 0, 2 ** 62)
+
+    def reblock(self):
+        block_list = sql_functions.find_small_tsc_files(self.sdk, self.device_id, self.measure_id, 2 ** 62)
+        return optimizer.reblock_small_blocks(self.sdk, self.device_id, self.measure_id, block_list)
+
+    def assert_data(self, times, values):
+        _, read_times, read_values = self.sdk.get_data(self.measure_id, START_NS, int(times[-1]) + 1,
+                                                       device_id=self.device_id, analog=False)
+        self.assertTrue(np.array_equal(times, read_times))
+        self.assertTrue(np.array_equal(values, read_values))
+
+    def test_join_gap_arrays(self):
+        # two blocks of 4 values, the first has a gap after its second value and the second starts 1 s late
+        gap_data = np.array([2, 50, 1, 20], dtype=np.int64)
+        block_info = [(0, 4, 1), (4 * PERIOD_NS + 50 + 1_000_000_000, 4, 1)]
+        joined = optimizer.join_gap_arrays(gap_data, block_info, FREQ_NHZ)
+        self.assertTrue(np.array_equal(joined, [2, 50, 4, 1_000_000_000, 5, 20]))
+
+        # blocks that follow on exactly don't get a gap between them
+        block_info = [(0, 4, 1), (4 * PERIOD_NS + 50, 4, 1)]
+        joined = optimizer.join_gap_arrays(gap_data, block_info, FREQ_NHZ)
+        self.assertTrue(np.array_equal(joined, [2, 50, 5, 20]))
+
+    def test_reblock_gap_arrays(self):
+        times, values = self.write_small_blocks([V_TYPE_INT64] * 6)
+        self.assertEqual(len(self.blocks()), 6)
+
+        self.assertGreater(self.reblock(), 0)
+
+        # 180 values fit in at most two blocks (the sdk may fold a short last block into the one before it), and the
+        # gaps inside and between the old blocks are kept
+        blocks = self.blocks()
+        self.assertLessEqual(len(blocks), 2)
+        self.assertEqual(sum(block[8] for block in blocks), 180)
+        self.assertEqual(len({block[3] for block in blocks}), 1)
+        self.assert_data(times, values)
+
+    def test_reblock_mixed_value_types(self):
+        times, values = self.write_small_blocks([V_TYPE_INT64] * 3 + [V_TYPE_DOUBLE] * 3)
+
+        self.assertGreater(self.reblock(), 0)
+
+        # blocks encoded differently are re-encoded separately so each half becomes one block
+        self.assertEqual([block[8] for block in self.blocks()], [90, 90])
+        self.assert_data(times, values)
+
+    def test_reblock_undo(self):
+        times, values = self.write_small_blocks([V_TYPE_INT64] * 6)
+        blocks_before = self.blocks()
+        files_before = set(os.listdir(self.sdk.file_api.to_abs_path("", self.measure_id, self.device_id)))
+
+        # a checksum that doesn't match after the new file is written puts the old blocks back
+        with mock.patch.object(optimizer, "checksum_data", return_value="mismatch"):
+            self.reblock()
+
+        self.assertEqual(self.blocks(), blocks_before)
+        files_after = set(os.listdir(self.sdk.file_api.to_abs_path("", self.measure_id, self.device_id)))
+        self.assertEqual(files_after, files_before)
+        self.assert_data(times, values)
+
+    def test_merge_after_reblock_error(self):
+        times, values = self.write_small_blocks([V_TYPE_INT64] * 6)
+
+        # an error while re-blocking still leaves the small files to be merged with their blocks as they are
+        settings = {'reblock_small_blocks': True, 'target_tsc_file_size': 2 ** 62}
+        with mock.patch.dict(config.svc_tsc_gen, settings), mock.patch.object(optimizer, "sdk", self.sdk), \
+                mock.patch.object(optimizer, "reblock_run", side_effect=RuntimeError("bad block")):
+            optimizer.merge_small_tsc_files(self.device_id, self.measure_id)
+
+        blocks = self.blocks()
+        self.assertEqual(len(blocks), 6)
+        self.assertEqual(len({block[3] for block in blocks}), 1)
+        self.assert_data(times, values)
+
+    def test_ingest_records_file_locations(self):
+        self.write_small_blocks([V_TYPE_INT64] * 3)
+
+        # every ingested file's directory is known so it can be deleted without searching the tsc directory once
+        # the optimizer has merged it
+        with self.sdk.sql_handler.connection() as (conn, cursor):
+            cursor.execute("SELECT t1.id, t2.measure_id, t2.device_id FROM file_index t1 "
+                           "LEFT JOIN tsc_file_location t2 ON t1.id = t2.file_id")
+            rows = cursor.fetchall()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(all(row[1:] == (self.measure_id, self.device_id) for row in rows))
+    def file_stats(self):
+        with self.sdk.sql_handler.connection() as (conn, cursor):
+            cursor.execute("SELECT file_id, total_bytes, num_blocks, min_time_n, max_time_n FROM file_stats ORDER BY file_id")
+            stats = cursor.fetchall()
+            cursor.execute("SELECT file_id, SUM(num_bytes), COUNT(*), MIN(start_time_n), MAX(end_time_n) FROM block_index "
+                           "GROUP BY file_id ORDER BY file_id")
+            return stats, cursor.fetchall()
+
+    def write_into_gap(self, record_stats=True):
+        # a few values in the gap before the fourth block, the sdk merges them into the third block instead of the newest
+        values = np.arange(10, dtype=np.int64)
+        start_time_n = self.blocks()[2][7] + 5 * PERIOD_NS
+        _, _, _, file_name = self.sdk.write_data(
+            self.measure_id, self.device_id, np.array([], dtype=np.int64), values, FREQ_NHZ, start_time_n,
+            raw_time_type=T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO, raw_value_type=V_TYPE_INT64,
+            encoded_time_type=T_TYPE_GAP_ARRAY_INT64_INDEX_DURATION_NANO, encoded_value_type=V_TYPE_DELTA_INT64,
+            scale_m=1.0, scale_b=0.0)
+        if record_stats:
+            sql_functions.record_ingested_file_stats(self.sdk, self.measure_id, self.device_id, file_name)
+
+    def test_ingest_merge_into_older_block(self):
+        self.write_small_blocks([V_TYPE_INT64] * 4)
+        merged_file_id = self.blocks()[2][3]
+
+        self.write_into_gap()
+
+        # the third file lost its only block so the sdk deleted it, its stats have to go too
+        self.assertEqual(len(self.blocks()), 4)
+        self.assertNotIn(merged_file_id, {block[3] for block in self.blocks()})
+        stats, expected = self.file_stats()
+        self.assertEqual(stats, expected)
+
+    def test_reconcile_file_stats(self):
+        self.write_small_blocks([V_TYPE_INT64] * 4)
+        # the tsc generator stopped before the stats of this write were recorded
+        self.write_into_gap(record_stats=False)
+        stats, expected = self.file_stats()
+        self.assertNotEqual(stats, expected)
+
+        self.assertEqual(sql_functions.reconcile_file_stats(self.sdk), 1)
+        stats, expected = self.file_stats()
+        self.assertEqual(stats, expected)
+        # nothing is left to do the next time
+        self.assertEqual(sql_functions.reconcile_file_stats(self.sdk), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
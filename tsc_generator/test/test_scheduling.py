@@ -0,0 +1,81 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+from scheduling import WalScheduler
+
+# run from the tsc_generator/src directory: python -m pytest ../test/test_scheduling.py
+
+
+def device_measure(device, measure):
+    return device, measure, 500_000_000_000, "mV"
+
+
+# (path, device_measure, size, mtime, file_start_time), in the order the WAL folder is read (oldest first)
+WAL_FILES = [
+    ("a1", device_measure("dev-a", "ECG"), 4000, 1.0, 40),
+    ("a2", device_measure("dev-a", "ECG"), 100, 2.0, 10),
+    ("a3", device_measure("dev-a", "HR"), 2000, 3.0, 20),
+    ("a4", device_measure("dev-a", "SPO2"), 1000, 4.0, 10),
+    ("b1", device_measure("dev-b", "ECG"), 500, 5.0, 30),
+]
+
+
+def schedule(policy):
+    scheduler = WalScheduler(policy)
+    for wal_file in WAL_FILES:
+        scheduler.push(*wal_file)
+    return [wal_file['path'] for wal_file in scheduler]
+
+
+class TestWalScheduler(unittest.TestCase):
+
+    def test_one_file_per_device_measure(self):
+        scheduler = WalScheduler("sjf")
+        for wal_file in WAL_FILES:
+            scheduler.push(*wal_file)
+        self.assertEqual(len(scheduler), 4)
+        # a2 is the smallest file but a1 holds older data for the same device measure, so a2 waits for the next round
+        paths = [wal_file['path'] for wal_file in scheduler]
+        self.assertNotIn("a2", paths)
+        self.assertEqual(len(scheduler), 0)
+
+    def test_fifo(self):
+        self.assertEqual(schedule("fifo"), ["a1", "a3", "a4", "b1"])
+
+    def test_shortest_job_first(self):
+        self.assertEqual(schedule("sjf"), ["b1", "a4", "a3", "a1"])
+
+    def test_deadline(self):
+        self.assertEqual(schedule("deadline"), ["a4", "a3", "b1", "a1"])
+
+    def test_fair(self):
+        # dev-b's only file goes right after dev-a's first one instead of waiting behind all of dev-a's
+        self.assertEqual(schedule("fair"), ["a1", "b1", "a3", "a4"])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            WalScheduler("lifo")
+
+
+if __name__ == '__main__':
+    unittest.main()
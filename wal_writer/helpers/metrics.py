@@ -46,6 +46,7 @@ from opentelemetry.sdk.resources import (
     Resource,
 )
 from walwriter.config import config
+from walwriter.supervisor import get_worker_id
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -82,6 +83,18 @@ WALWRITER_MESSAGE_SIRI_DURATION = METRIC + "messages.siri.duration"
 WALWRITER_MESSAGE_WRITE_DURATION = METRIC + "messages.write.duration"
 WALWRITER_WAL_FILES_OPEN = METRIC + "wal.files.open"
 WALWRITER_WAL_FILES_CREATED = METRIC + "wal.files.created"
+WALWRITER_SIRI_FLUSH_DURATION = METRIC + "siri.flush.duration"
+WALWRITER_SIRI_DROPPED_POINTS = METRIC + "siri.points.dropped"
+WALWRITER_PREFETCH_COUNT = METRIC + "prefetch.count"
+WALWRITER_PREFETCH_ADJUSTMENTS = METRIC + "prefetch.adjustments"
+WALWRITER_WAL_FILES_EVICTED = METRIC + "wal.files.evicted"
+WALWRITER_WAL_FILES_REOPENED = METRIC + "wal.files.reopened"
+WALWRITER_WAL_FILES_ROTATED = METRIC + "wal.files.rotated"
+WALWRITER_MESSAGE_STAGE_DURATION = METRIC + "messages.stage.duration"
+WALWRITER_INGEST_LAG = METRIC + "ingest.lag"
+WALWRITER_DEVICE_INGEST_LAG = METRIC + "ingest.lag.device"
+WALWRITER_WAL_RECOVERED_FILES = METRIC + "wal.recovery.repaired.files"
+WALWRITER_WAL_RECOVERED_BYTES = METRIC + "wal.recovery.truncated.bytes"
 
 # Set global Metrics module values
 EXPORT_INTERVAL = os.environ.get("OTEL_METRIC_EXPORT_INTERVAL", 5_000)
@@ -93,6 +106,8 @@ resource_attrib[SERVICE_NAME] = os.environ.get(OTEL_SERVICE_NAME, "atriumdb-walw
 # here you can add more custom labels that are useful for metrics timeseries
 # resource_attrib["custom key"] = "value"
 resource_attrib["atriumdb_instance"] = config.instance_name
+# each wal writer worker process exports its own metrics, this label lets them be summed into one view
+resource_attrib["walwriter_worker"] = str(get_worker_id())
 
 
 # TO DO verify that this is not over exposed
@@ -110,6 +125,22 @@ set_meter_provider(_provider)
 _meter = get_meter_provider().get_meter("opentelemetry.instrumentation.wal-writer")
 
 _ADAPTER_METRICS = None
+# largest ingest lag seen since the last time the ingest lag gauge was exported
+_max_ingest_lag_ms = None
+
+
+def set_ingest_lag(lag_ms: float):
+    """Report the ingest lag of a message, the gauge exports the largest one seen each interval"""
+    global _max_ingest_lag_ms
+    if _max_ingest_lag_ms is None or lag_ms > _max_ingest_lag_ms:
+        _max_ingest_lag_ms = lag_ms
+
+
+def _observe_ingest_lag(options: CallbackOptions):
+    global _max_ingest_lag_ms
+    if _max_ingest_lag_ms is not None:
+        yield Observation(_max_ingest_lag_ms)
+        _max_ingest_lag_ms = None
 
 
 def _init_metrics(meter: Meter):
@@ -153,6 +184,62 @@ def _init_metrics(meter: Meter):
             WALWRITER_WAL_FILES_CREATED,
             description="Number of WAL files created"
         )
+        siri_flush_duration = meter.create_histogram(
+            WALWRITER_SIRI_FLUSH_DURATION,
+            description="siri buffered batch insert times",
+            unit="ms",
+        )
+        siri_dropped_points_counter = meter.create_counter(
+            WALWRITER_SIRI_DROPPED_POINTS,
+            description="number of siri points dropped because the retry queue was full"
+        )
+        prefetch_count_gauge = meter.create_up_down_counter(
+            WALWRITER_PREFETCH_COUNT,
+            description="current RabbitMQ prefetch count chosen by the adaptive prefetch controller"
+        )
+        prefetch_adjustments_counter = meter.create_counter(
+            WALWRITER_PREFETCH_ADJUSTMENTS,
+            description="number of prefetch count changes, labeled by direction and reason"
+        )
+        wal_files_evicted_counter = meter.create_counter(
+            WALWRITER_WAL_FILES_EVICTED,
+            description="Number of WAL files closed early because the open file limit was reached"
+        )
+        wal_files_reopened_counter = meter.create_counter(
+            WALWRITER_WAL_FILES_REOPENED,
+            description="Number of evicted WAL files reopened in append mode"
+        )
+        wal_files_rotated_counter = meter.create_counter(
+            WALWRITER_WAL_FILES_ROTATED,
+            description="Number of WAL files closed early because they hit their size or sample count limit"
+        )
+        message_stage_duration = meter.create_histogram(
+            WALWRITER_MESSAGE_STAGE_DURATION,
+            description="time spent in each stage of processing a message, labeled by stage. Only a sample of messages "
+                        "are recorded",
+            unit="ms",
+        )
+        meter.create_observable_gauge(
+            WALWRITER_INGEST_LAG,
+            callbacks=[_observe_ingest_lag],
+            description="largest time from a message's mtime to it being written to a WAL file since the last export",
+            unit="ms",
+        )
+        wal_recovered_files_counter = meter.create_counter(
+            WALWRITER_WAL_RECOVERED_FILES,
+            description="Number of WAL files with a torn tail that were truncated by the start up recovery scan"
+        )
+        wal_recovered_bytes_counter = meter.create_counter(
+            WALWRITER_WAL_RECOVERED_BYTES,
+            description="Number of bytes of partially written messages removed by the start up recovery scan",
+            unit="By",
+        )
+        device_ingest_lag = meter.create_histogram(
+            WALWRITER_DEVICE_INGEST_LAG,
+            description="time from a message's mtime to it being written to a WAL file, labeled by device. Only a "
+                        "sample of messages are recorded",
+            unit="ms",
+        )
 
         adapter_metrics = {
             WALWRITER_ERRORS: exception_counter,
@@ -164,6 +251,17 @@ def _init_metrics(meter: Meter):
             WALWRITER_MESSAGE_WRITE_DURATION: message_processing_duration_write,
             WALWRITER_WAL_FILES_OPEN: open_wal_files_gauge,
             WALWRITER_WAL_FILES_CREATED: wal_files_created_counter,
+            WALWRITER_SIRI_FLUSH_DURATION: siri_flush_duration,
+            WALWRITER_SIRI_DROPPED_POINTS: siri_dropped_points_counter,
+            WALWRITER_PREFETCH_COUNT: prefetch_count_gauge,
+            WALWRITER_PREFETCH_ADJUSTMENTS: prefetch_adjustments_counter,
+            WALWRITER_WAL_FILES_EVICTED: wal_files_evicted_counter,
+            WALWRITER_WAL_FILES_REOPENED: wal_files_reopened_counter,
+            WALWRITER_WAL_FILES_ROTATED: wal_files_rotated_counter,
+            WALWRITER_MESSAGE_STAGE_DURATION: message_stage_duration,
+            WALWRITER_DEVICE_INGEST_LAG: device_ingest_lag,
+            WALWRITER_WAL_RECOVERED_FILES: wal_recovered_files_counter,
+            WALWRITER_WAL_RECOVERED_BYTES: wal_recovered_bytes_counter,
         }
 
         _ADAPTER_METRICS = adapter_metrics
@@ -24,14 +24,21 @@ import sys
 import signal
 import ssl
 import orjson
+import numpy as np
 import asyncio
+import itertools
 import aio_pika
 from aio_pika.abc import AbstractIncomingMessage
 from siridb.connector import SiriDBClient
-from time import time
+from time import time, perf_counter
 from logging import getLogger, Formatter, StreamHandler
 from walwriter.siridb_admin_tool import SiriDBAdmin
 from walwriter.wal_file_manager import WALFileManager
+from walwriter.siri_buffer import SiriInsertBuffer
+from walwriter.supervisor import WALWriterSupervisor, get_worker_id
+from walwriter.prefetch_controller import PrefetchController
+from walwriter import binary_message
+from walwriter.wal_recovery import recover_wal_files
 from atriumdb import AtriumSDK
 from walwriter.config import config
 from helpers.metrics import (get_metric,
@@ -41,7 +48,10 @@ from helpers.metrics import (get_metric,
                              WALWRITER_ERRORS,
                              WALWRITER_NO_SIRI_CONNECTION,
                              WALWRITER_PROCESSED_MESSAGE_WAVEFORMS,
-                             WALWRITER_PROCESSED_MESSAGE_METRICS)
+                             WALWRITER_PROCESSED_MESSAGE_METRICS,
+                             WALWRITER_MESSAGE_STAGE_DURATION,
+                             WALWRITER_DEVICE_INGEST_LAG,
+                             set_ingest_lag)
 
 
 # set up logging
@@ -52,16 +62,76 @@ handler.setFormatter(fmt)
 _LOGGER.addHandler(handler)
 _LOGGER.setLevel(config.loglevel.upper())
 
-# start wal file manager which will actually write the wal files to disk
-wal = WALFileManager(path=config.svc_wal_writer['wal_folder_path'], file_length_time=config.svc_wal_writer['file_length_time'],
-                     idle_timeout=config.svc_wal_writer['idle_timeout'], gc_schedule_min=config.svc_wal_writer['gc_schedule_min'])
-
-if config.svc_wal_writer['create_dataset']:
-    AtriumSDK.create_dataset(dataset_location=config.dataset_location, database_type=config.svc_wal_writer['metadb_connection']['type'],
-                             connection_params=config.CONNECTION_PARAMS, overwrite='ignore')
-# Instantiate atriumDB sdk object
-atrium_sdk = AtriumSDK(dataset_location=config.dataset_location, metadata_connection_type=config.svc_wal_writer['metadb_connection']['type'],
-                       connection_params=config.CONNECTION_PARAMS)
+# the wal file manager and sdk are created per worker process in init_worker()
+wal = None
+atrium_sdk = None
+# only set when adaptive_prefetch is enabled
+prefetch_controller = None
+# only set once siri is connected, so it's still None if start up fails before then
+siri_buffer = None
+# stage durations and per device lag are only recorded for every nth message to keep the metrics overhead low
+stage_metrics_sample_every = max(1, config.svc_wal_writer.get('stage_metrics_sample_every', 100))
+message_counter = itertools.count()
+
+
+def create_dataset():
+    if config.svc_wal_writer['create_dataset']:
+        AtriumSDK.create_dataset(dataset_location=config.dataset_location, database_type=config.svc_wal_writer['metadb_connection']['type'],
+                                 connection_params=config.CONNECTION_PARAMS, overwrite='ignore')
+
+
+def init_worker():
+    global wal
+    global atrium_sdk
+
+    # start wal file manager which will actually write the wal files to disk
+    wal = WALFileManager(path=config.svc_wal_writer['wal_folder_path'], file_length_time=config.svc_wal_writer['file_length_time'],
+                         idle_timeout=config.svc_wal_writer['idle_timeout'], gc_schedule_min=config.svc_wal_writer['gc_schedule_min'],
+                         num_stripes=config.svc_wal_writer.get('num_lock_stripes', 16),
+                         max_open_files=config.svc_wal_writer.get('max_open_files', None),
+                         reopen_max_age=config.svc_wal_writer.get('evicted_file_reopen_time', 900),
+                         rotation_policy=get_rotation_policy(),
+                         narrow_value_types=config.svc_wal_writer.get('narrow_value_types', False),
+                         compression_frame_size=config.svc_wal_writer.get('wal_compression_frame_size', 0),
+                         compression_level=config.svc_wal_writer.get('wal_compression_level', 3),
+                         columnar_chunk_size=config.svc_wal_writer.get('wal_columnar_chunk_size', 0),
+                         max_frame_age=config.svc_wal_writer.get('wal_frame_max_age', 5))
+
+    # Instantiate atriumDB sdk object
+    atrium_sdk = AtriumSDK(dataset_location=config.dataset_location, metadata_connection_type=config.svc_wal_writer['metadb_connection']['type'],
+                           connection_params=config.CONNECTION_PARAMS)
+
+
+# turns the wal_rotation config into value and byte limits for each message type. Sample limits are given as a number of
+# tsc blocks so the tsc generator can fill whole blocks from each WAL file
+def get_rotation_policy():
+    # this is the wal writer's own copy of the tsc generator's optimal_block_num_values so it doesn't need that section
+    block_num_values = config.svc_wal_writer.get('wal_rotation_block_num_values', 131072)
+    policy = {}
+    for msg_type, limits in (config.svc_wal_writer.get('wal_rotation') or {}).items():
+        policy[msg_type] = {"max_values": (limits.get('max_blocks') or 0) * block_num_values,
+                            "max_bytes": limits.get('max_bytes') or 0}
+    return policy
+
+
+# returns a callback for wal.write that resolves the future from whichever thread ends up writing the message's frame
+def frame_written_callback(loop, future):
+    def on_written(error):
+        try:
+            loop.call_soon_threadsafe(_resolve_frame_future, future, error)
+        except RuntimeError:
+            # the event loop is already closed, the message can't be acked anymore so rabbitmq will redeliver it
+            pass
+    return on_written
+
+
+def _resolve_frame_future(future, error):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
 
 
 def convert(x):
@@ -73,6 +143,19 @@ def convert(x):
 
 
 async def on_message(message: AbstractIncomingMessage):
+    if prefetch_controller is None:
+        await process_message(message)
+        return
+
+    # let the prefetch controller see how many messages are being worked on at once
+    prefetch_controller.message_started()
+    try:
+        await process_message(message)
+    finally:
+        prefetch_controller.message_finished()
+
+
+async def process_message(message: AbstractIncomingMessage):
     async with message.process(ignore_processed=True):
         processed_counter = get_metric(WALWRITER_PROCESSED_MESSAGE)
         message_siri_duration = get_metric(WALWRITER_MESSAGE_SIRI_DURATION)
@@ -82,15 +165,26 @@ async def on_message(message: AbstractIncomingMessage):
         processed_waveforms_counter = get_metric(WALWRITER_PROCESSED_MESSAGE_WAVEFORMS)
         processed_metrics_counter = get_metric(WALWRITER_PROCESSED_MESSAGE_METRICS)
 
-        # attempt to parse the message into json dictionary
+        # stage timings are only collected for sampled messages, for the rest this stays None
+        timings = {} if next(message_counter) % stage_metrics_sample_every == 0 else None
+        if timings is not None:
+            stage_start = perf_counter()
+
+        # attempt to parse the message into a dictionary, JSON unless the producer marked it as a binary message
         try:
-            data = orjson.loads(message.body)
-        except orjson.JSONDecodeError:
+            if message.content_type == binary_message.CONTENT_TYPE:
+                data = binary_message.decode_message(message.body)
+            else:
+                data = orjson.loads(message.body)
+        except (orjson.JSONDecodeError, binary_message.BinaryMessageError):
             await message.nack()
-            _LOGGER.error("Error parsing json nacking message", exc_info=True)
+            _LOGGER.error("Error parsing message nacking message", exc_info=True)
             exception_counter.add(1)
             return
 
+        if timings is not None:
+            timings["parse"] = perf_counter() - stage_start
+
         # once the message is parsed pass the message arguments to the wal writer, so it can make the wal file
 
         # if alarm drop msg since we don't need alarm messages for now
@@ -99,6 +193,8 @@ async def on_message(message: AbstractIncomingMessage):
             return
         # if the message is a waveform
         elif data['type'] == "wav" or data['type'] == "met":
+            if timings is not None:
+                stage_start = perf_counter()
 
             # If the measure id doesn't exist input it
             measure_id = atrium_sdk.get_measure_id(measure_tag=data['mname'], freq=int(data['freq'] * (10 ** 9)), units=data['uom'])
@@ -115,6 +211,16 @@ async def on_message(message: AbstractIncomingMessage):
                 device_id = atrium_sdk.get_device_id(device_tag=str(data['devid']))
                 if device_id is None:
                     raise RuntimeError("Inserting a new device into AtriumDB failed")
+
+            if timings is not None:
+                timings["metadata"] = perf_counter() - stage_start
+        # compressed and columnar WAL files hold messages in memory until a whole frame of them is written, so for those
+        # the message is only acked once this future says its frame is on disk
+        frame_written, on_written = None, None
+        if wal.buffers_messages():
+            loop = asyncio.get_running_loop()
+            frame_written = loop.create_future()
+            on_written = frame_written_callback(loop, frame_written)
         try:
             start_time = time()
             if data['type'] == "wav":
@@ -122,16 +228,29 @@ async def on_message(message: AbstractIncomingMessage):
 
                 wal.write(device_name=str(data['devid']), server_time_ns=data['systime'], msg_type=data['type'],
                           measure_name=data['mname'], data_time_ns=data['mtime'], measure_units=data['uom'],
-                          freq=data['freq'], data=data['val'], meta_data=meta_data)
+                          freq=data['freq'], data=data['val'], meta_data=meta_data, timings=timings,
+                          on_written=on_written)
                 processed_waveforms_counter.add(1)
             # if the message is a metric message it won't contain the metadata field
             elif data['type'] == "met":
                 wal.write(device_name=str(data['devid']), server_time_ns=data['systime'], msg_type=data['type'],
                           measure_name=data['mname'], data_time_ns=data['mtime'], measure_units=data['uom'],
-                          freq=data['freq'], data=data['val'])
+                          freq=data['freq'], data=data['val'], timings=timings, on_written=on_written)
                 processed_metrics_counter.add(1)
-            message_write_duration.record((time() - start_time) * 1_000_000.00)
+            end_time = time()
+            write_duration = end_time - start_time
+            message_write_duration.record(write_duration * 1_000_000.00)
+            if prefetch_controller is not None:
+                prefetch_controller.observe_write(write_duration * 1000)
+
+            # how far behind the data is by the time it's in a WAL file
+            ingest_lag_ms = (end_time * 1_000_000_000 - data['mtime']) / 1_000_000
+            set_ingest_lag(ingest_lag_ms)
+            if timings is not None:
+                get_metric(WALWRITER_DEVICE_INGEST_LAG).record(ingest_lag_ms, {"device": str(data['devid'])})
         except:
+            if frame_written is not None:
+                frame_written.cancel()
             await message.nack()
             _LOGGER.error("Error nacking message", exc_info=True)
             exception_counter.add(1)
@@ -145,33 +264,68 @@ async def on_message(message: AbstractIncomingMessage):
 
             if data["type"] == "wav":
                 sample_time = int((10 ** 9) // freq)
-                values = data["val"].split("^")
+                values = data["val"].tolist() if isinstance(data["val"], np.ndarray) else data["val"].split("^")
                 name = "wave-{}-{}".format(str(device_id), str(measure_id))
                 tuples = [[int(start_time + (sample_time * i)), convert(value)] for i, value in enumerate(values)]
 
-                if siri.connected:
-                    await siri.insert({name: tuples})
-                else:
-                    siri_no_connection_counter.add(1)
+                await siri_buffer.add(name, tuples)
 
             elif data["type"] == "met":
                 name = "metric-{}-{}".format(str(device_id), str(measure_id))
 
-                if siri.connected:
-                    await siri.insert({name: [[int(start_time), convert(data["val"])]]})
-                else:
-                    siri_no_connection_counter.add(1)
-
-            message_siri_duration.record((time() - start_time_met) * 1_000_000.00)
+                await siri_buffer.add(name, [[int(start_time), convert(data["val"])]])
+
+            # the points are still buffered and will be retried when siri reconnects, but count the message like before
+            if not siri.connected:
+                siri_no_connection_counter.add(1)
+
+            siri_duration = time() - start_time_met
+            message_siri_duration.record(siri_duration * 1_000_000.00)
+            if timings is not None:
+                timings["siri"] = siri_duration
+
+        # the siri points are sent before waiting on the frame so the live data isn't held back by the frame age
+        if frame_written is not None:
+            if timings is not None:
+                stage_start = perf_counter()
+            if prefetch_controller is not None:
+                prefetch_controller.frame_wait_started()
+            try:
+                await frame_written
+            except Exception:
+                await message.nack()
+                _LOGGER.error("Error writing WAL frame nacking message", exc_info=True)
+                exception_counter.add(1)
+                return
+            finally:
+                if prefetch_controller is not None:
+                    prefetch_controller.frame_wait_finished()
+            if timings is not None:
+                timings["frame"] = perf_counter() - stage_start
+
+        if timings is not None:
+            stage_start = perf_counter()
 
         await message.ack()
         processed_counter.add(1)
 
+        if timings is not None:
+            timings["ack"] = perf_counter() - stage_start
+            record_stage_durations(timings)
+
+
+def record_stage_durations(timings: dict):
+    stage_duration = get_metric(WALWRITER_MESSAGE_STAGE_DURATION)
+    for stage, duration in timings.items():
+        stage_duration.record(duration * 1000, {"stage": stage})
+
 
 async def start_wal_writer():
     global siri
+    global siri_buffer
     global connection
     global channel
+    global prefetch_controller
 
     loop = asyncio.get_running_loop()
     # set up signals for graceful exit
@@ -231,22 +385,34 @@ async def start_wal_writer():
         resp = await siri.query("alter database set expiration_num {} set ignore_threshold true".format(config.siridb['data_expiration_time']))
         _LOGGER.info(resp)
 
+        # coalesce the points from many messages into fewer, larger siri inserts
+        siri_buffer = SiriInsertBuffer(siri,
+                                       max_points=config.siridb.get('insert_buffer_max_points', 10_000),
+                                       flush_interval=config.siridb.get('insert_buffer_flush_interval', 1),
+                                       max_concurrency=config.siridb.get('insert_max_concurrency', 4),
+                                       max_retry_points=config.siridb.get('insert_retry_max_points', 1_000_000))
+        siri_buffer.start()
+
     async with connection:
         try:
             # Creating channel
             channel = await connection.channel(publisher_confirms=False)
 
             # Maximum message count which will be processing at the same time.
-            await channel.set_qos(prefetch_count=config.svc_wal_writer['prefetch_count'])
-
-            # make default queue for dev if none was specified
-            if config.svc_wal_writer['inbound_queue'] == "" or config.svc_wal_writer['inbound_queue'] == "test_queue":
-                _LOGGER.info("Queue name either empty or left as default creating default queue")
-                queue = await channel.declare_queue(name="test_queue", durable=True)
-
-            # if queue was specified connect to that queue
+            if config.svc_wal_writer.get('adaptive_prefetch', False):
+                # start at prefetch_count and let the controller move it between the min and max from there
+                prefetch_controller = PrefetchController(
+                    channel, initial_prefetch=config.svc_wal_writer['prefetch_count'],
+                    min_prefetch=config.svc_wal_writer.get('prefetch_min', 100),
+                    max_prefetch=config.svc_wal_writer.get('prefetch_max', 5000),
+                    target_latency_ms=config.svc_wal_writer.get('prefetch_target_write_latency_ms', 5),
+                    max_rss_mb=config.svc_wal_writer.get('prefetch_max_rss_mb', 2048),
+                    interval=config.svc_wal_writer.get('prefetch_adjust_interval', 5))
+                await prefetch_controller.start()
             else:
-                queue = await channel.declare_queue(name=config.svc_wal_writer['inbound_queue'], passive=True, durable=True)
+                await channel.set_qos(prefetch_count=config.svc_wal_writer['prefetch_count'])
+
+            queue = await declare_inbound_queue(channel)
             _LOGGER.info("Starting Ingest")
 
             # start listening for messages
@@ -258,7 +424,35 @@ async def start_wal_writer():
             await cleanup()
 
 
+async def declare_inbound_queue(channel):
+    # when running multiple workers with a shard exchange each worker gets its own queue bound to a consistent hash
+    # exchange. Producers publish with the device id as the routing key so every message for a device lands on the
+    # same worker, and that worker is the only process writing that device's WAL files
+    if config.svc_wal_writer.get('num_workers', 1) > 1 and config.svc_wal_writer.get('shard_exchange', ""):
+        worker_id = get_worker_id()
+        exchange = await channel.declare_exchange(name=config.svc_wal_writer['shard_exchange'], type="x-consistent-hash",
+                                                  durable=True)
+        queue = await channel.declare_queue(name="{}.shard-{}".format(config.svc_wal_writer['inbound_queue'], worker_id),
+                                            durable=True)
+        # for a consistent hash exchange the binding key is the weight of the queue in the hash ring
+        await queue.bind(exchange, routing_key="1")
+        _LOGGER.info(f"Worker {worker_id} consuming from shard queue {queue.name}")
+        return queue
+
+    # make default queue for dev if none was specified
+    if config.svc_wal_writer['inbound_queue'] == "" or config.svc_wal_writer['inbound_queue'] == "test_queue":
+        _LOGGER.info("Queue name either empty or left as default creating default queue")
+        return await channel.declare_queue(name="test_queue", durable=True)
+
+    # if queue was specified connect to that queue
+    return await channel.declare_queue(name=config.svc_wal_writer['inbound_queue'], passive=True, durable=True)
+
+
 async def cleanup():
+    # stop changing the qos on a channel that is about to close
+    if prefetch_controller is not None:
+        await prefetch_controller.stop()
+
     # close rabbit channel so we don't get any new messages
     if not channel.is_closed:
         await channel.close()
@@ -272,6 +466,10 @@ async def cleanup():
     # shut down the WAL file manager and close all open WAL files
     wal.close()
 
+    # push out any buffered siri points before closing the connection
+    if siri_buffer is not None:
+        await siri_buffer.close()
+
     # close siri connection if its still open
     if config.svc_wal_writer['enable_siri'] and siri.connected:
         siri.close()
@@ -295,10 +493,33 @@ async def signal_handler(signame):
     await asyncio.gather(*tasks, return_exceptions=True)
 
 
-if __name__ == "__main__":
+def run_worker():
+    init_worker()
     try:
         asyncio.run(start_wal_writer())
     # this will catch the canceled error from "await asyncio.Future()" in start_wal_writer() function and also the,
     # loop.run_until_complete(start_wal_writer()) line above
     except asyncio.exceptions.CancelledError:
         pass
+
+
+if __name__ == "__main__":
+    # workers sharing one queue would each write WAL files for the same devices, so sharding is required
+    if config.svc_wal_writer.get('num_workers', 1) > 1 and not config.svc_wal_writer.get('shard_exchange', ""):
+        raise ValueError(f"num_workers is {config.svc_wal_writer['num_workers']} but shard_exchange isn't set. Without a "
+                         f"shard exchange every worker consumes from inbound_queue and writes WAL files for the same "
+                         f"devices. Set shard_exchange and publish to it with the device id as the routing key, or set "
+                         f"num_workers to 1.")
+
+    # create the dataset once up front so the workers don't race each other to create it
+    create_dataset()
+
+    # clean up any messages left half written by a crash before anything starts appending to the WAL folder
+    if config.svc_wal_writer.get('recover_on_startup', True):
+        recover_wal_files(config.svc_wal_writer['wal_folder_path'],
+                          max_workers=config.svc_wal_writer.get('recovery_workers', None))
+
+    if config.svc_wal_writer.get('num_workers', 1) > 1:
+        WALWriterSupervisor(target=run_worker, num_workers=config.svc_wal_writer['num_workers']).run()
+    else:
+        run_worker()
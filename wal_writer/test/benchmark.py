@@ -0,0 +1,242 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+import numpy as np
+import orjson
+
+# ********************************************************************************************************************
+# Runs messages through the WAL writer's on_message in process, no RabbitMQ or SiriDB needed. The metadata goes into
+# a throwaway sqlite dataset and siri inserts go to an in memory stub. The wal writer's python requirements still have
+# to be installed (pip install -r requirements.txt). Run from anywhere with:
+#   python wal_writer/test/benchmark.py --devices 50 --sample-rate 500 --samples-per-message 256
+# ********************************************************************************************************************
+
+WAL_WRITER_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(WAL_WRITER_DIR.parent / "lib"))
+
+from tests.benchmark_helpers import StageTimer, write_config, import_service_main, peak_rss_mb
+
+REQUIRED_MODULES = ("aio_pika", "siridb", "requests", "apscheduler", "xxhash", "atriumdb", "opentelemetry")
+
+
+class FakeMessage:
+    """Stands in for aio_pika's AbstractIncomingMessage, only has what on_message uses."""
+
+    def __init__(self, body: bytes, content_type: str = None):
+        self.body = body
+        self.content_type = content_type
+        self.state = None
+
+    def process(self, ignore_processed=False):
+        return _FakeProcess(self)
+
+    async def ack(self):
+        self.state = "ack"
+
+    async def nack(self):
+        self.state = "nack"
+
+
+class _FakeProcess:
+    def __init__(self, message: FakeMessage):
+        self.message = message
+
+    async def __aenter__(self):
+        return self.message
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None and self.message.state is None:
+            self.message.state = "reject"
+        return False
+
+
+class FakeSiriDB:
+    """In memory SiriDB client, keeps count of the points inserted and can add a fixed delay to each insert."""
+
+    def __init__(self, insert_delay: float = 0):
+        self.connected = True
+        self.insert_delay = insert_delay
+        self.num_points = 0
+        self.num_inserts = 0
+
+    async def insert(self, data: dict):
+        if self.insert_delay:
+            await asyncio.sleep(self.insert_delay)
+        self.num_inserts += 1
+        self.num_points += sum(len(points) for points in data.values())
+
+    def close(self):
+        self.connected = False
+
+
+def write_bench_config(work_dir: Path, args):
+    write_config(work_dir, work_dir, {
+        'svc_wal_writer': {'metadb_connection': "bench_metadb", 'wal_folder_path': str(work_dir / "wal"),
+                           'create_dataset': True, 'enable_siri': args.siri, 'idle_timeout': 10 ** 6,
+                           'num_lock_stripes': args.lock_stripes, 'max_open_files': args.max_open_files}})
+    (work_dir / "wal").mkdir(exist_ok=True)
+
+
+def generate_messages(args):
+    rng = np.random.default_rng(42)
+    start_ns = 1_700_000_000 * 10 ** 9
+    message_period_ns = int(args.samples_per_message / args.sample_rate * 10 ** 9)
+    scale_m, scale_b = 0.0003907204, -0.4
+    binary = None
+    if args.binary:
+        from walwriter import binary_message as binary
+
+    messages = []
+    for i in range(args.messages):
+        device = i % args.devices
+        measure = (i // args.devices) % args.measures_per_device
+        message_num = i // (args.devices * args.measures_per_device)
+        mtime = start_ns + message_num * message_period_ns
+        is_metric = args.metric_ratio > 0 and rng.random() < args.metric_ratio
+
+        if is_metric:
+            value = float(rng.integers(40, 180))
+            if binary:
+                body = binary.encode_message("met", str(device), "MDC_HR", "bpm", 1, mtime, mtime, np.float64(value))
+            else:
+                body = orjson.dumps({"type": "met", "devid": device, "mname": "MDC_HR", "uom": "bpm", "freq": 1,
+                                     "mtime": mtime, "systime": mtime, "val": str(value)})
+        else:
+            samples = rng.integers(-2048, 2048, size=args.samples_per_message)
+            mname = "MDC_WAVE_{}".format(measure)
+            if binary:
+                body = binary.encode_message("wav", str(device), mname, "MDC_DIM_X", args.sample_rate, mtime, mtime,
+                                             samples.astype(np.int16), scale_m, scale_b)
+            else:
+                values = "^".join("{:.7g}".format(v) for v in samples * scale_m + scale_b)
+                body = orjson.dumps({"type": "wav", "devid": device, "mname": mname, "uom": "MDC_DIM_X",
+                                     "freq": args.sample_rate, "mtime": mtime, "systime": mtime, "val": values,
+                                     "srcmeta": {"scale_m": scale_m, "scale_b": scale_b}})
+
+        messages.append(FakeMessage(body, binary.CONTENT_TYPE if binary else None))
+    return messages
+
+
+async def run_benchmark(main, messages, args):
+    timer = StageTimer()
+
+    # wrap the pieces of on_message so their latency can be reported separately
+    main.orjson = types.SimpleNamespace(loads=timer.wrap("parse", orjson.loads), JSONDecodeError=orjson.JSONDecodeError)
+    main.binary_message = types.SimpleNamespace(CONTENT_TYPE=main.binary_message.CONTENT_TYPE,
+                                                BinaryMessageError=main.binary_message.BinaryMessageError,
+                                                decode_message=timer.wrap("parse", main.binary_message.decode_message))
+    for func in ('get_measure_id', 'get_device_id'):
+        setattr(main.atrium_sdk, func, timer.wrap("metadata", getattr(main.atrium_sdk, func)))
+    main.wal.write = timer.wrap("wal_write", main.wal.write)
+
+    siri = None
+    if args.siri:
+        siri = FakeSiriDB(insert_delay=args.siri_insert_delay)
+        main.siri = siri
+        main.siri_buffer = main.SiriInsertBuffer(siri, max_points=args.siri_buffer_points, flush_interval=1,
+                                                 max_concurrency=4, max_retry_points=1_000_000)
+        main.siri_buffer.start()
+        main.siri_buffer.add = timer.wrap("siri", main.siri_buffer.add)
+
+    on_message = timer.wrap("total", main.on_message)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def consume(message):
+        async with semaphore:
+            await on_message(message)
+
+    start = time.perf_counter()
+    if args.concurrency == 1:
+        for message in messages:
+            await on_message(message)
+    else:
+        await asyncio.gather(*(consume(message) for message in messages))
+    elapsed = time.perf_counter() - start
+
+    open_files = main.wal.open_file_count()
+    if args.siri:
+        await main.siri_buffer.close()
+    main.wal.close()
+
+    return timer, elapsed, open_files, siri
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="In process throughput benchmark for the WAL writer")
+    parser.add_argument("--messages", type=int, default=20_000, help="number of messages to send")
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--measures-per-device", type=int, default=4)
+    parser.add_argument("--sample-rate", type=float, default=500, help="waveform sample rate in Hz")
+    parser.add_argument("--samples-per-message", type=int, default=256)
+    parser.add_argument("--metric-ratio", type=float, default=0.1, help="fraction of messages that are metrics")
+    parser.add_argument("--binary", action="store_true", help="send binary messages instead of JSON")
+    parser.add_argument("--siri", action="store_true", help="also run the SiriDB path against an in memory stub")
+    parser.add_argument("--siri-insert-delay", type=float, default=0, help="seconds each stub siri insert takes")
+    parser.add_argument("--siri-buffer-points", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, default=1, help="messages processed at once, like the prefetch")
+    parser.add_argument("--lock-stripes", type=int, default=16)
+    parser.add_argument("--max-open-files", type=int, default=None)
+    parser.add_argument("--work-dir", type=str, default=None, help="defaults to a new temporary directory")
+    args = parser.parse_args()
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="walwriter-bench-")).resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    write_bench_config(work_dir, args)
+    main = import_service_main(WAL_WRITER_DIR, "WALWRITER_CONFIG_DIR", work_dir, REQUIRED_MODULES)
+
+    main.create_dataset()
+    main.init_worker()
+
+    messages = generate_messages(args)
+    body_bytes = sum(len(message.body) for message in messages)
+
+    timer, elapsed, open_files, siri = asyncio.run(run_benchmark(main, messages, args))
+
+    states = {}
+    for message in messages:
+        states[message.state] = states.get(message.state, 0) + 1
+    wal_files = list((work_dir / "wal").glob("*.wal"))
+
+    print("Work dir: {}".format(work_dir))
+    print("Messages: {} ({:.1f} MB of message bodies, {})".format(
+        len(messages), body_bytes / 2 ** 20, "binary" if args.binary else "json"))
+    print("Elapsed: {:.2f}s  Throughput: {:.0f} msgs/s".format(elapsed, len(messages) / elapsed))
+    print("Message states: {}".format(states))
+    print("Latency per stage:")
+    timer.report()
+    print("Open WAL files at the end: {}  Peak RSS: {:.1f} MB".format(open_files, peak_rss_mb()))
+    print("WAL files written: {}  Bytes written: {:.1f} MB".format(
+        len(wal_files), sum(f.stat().st_size for f in wal_files) / 2 ** 20))
+    if siri is not None:
+        print("SiriDB inserts: {}  Points: {}".format(siri.num_inserts, siri.num_points))
+
+
+if __name__ == "__main__":
+    main_cli()
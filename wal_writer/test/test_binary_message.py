@@ -0,0 +1,93 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import unittest
+import numpy as np
+from walwriter import binary_message
+from walwriter.binary_message import BinaryMessageError, HEADER_STRUCT, decode_message, encode_message
+
+# run from the wal_writer directory: python -m pytest test/test_binary_message.py
+
+
+class TestBinaryMessage(unittest.TestCase):
+
+    def test_round_trip_waveform(self):
+        values = np.arange(-128, 128, dtype=np.int16)
+        body = encode_message("wav", "97", "MDC_ECG_LEAD_II", "MDC_DIM_MILLI_VOLT", 500, 10 ** 18, 10 ** 18 + 5, values,
+                              scale_m=0.001, scale_b=-0.5)
+        data = decode_message(body)
+
+        self.assertEqual(data['type'], "wav")
+        self.assertEqual((data['devid'], data['mname'], data['uom']), ("97", "MDC_ECG_LEAD_II", "MDC_DIM_MILLI_VOLT"))
+        self.assertEqual((data['freq'], data['mtime'], data['systime']), (500, 10 ** 18, 10 ** 18 + 5))
+        self.assertEqual(data['srcmeta'], {'scale_m': 0.001, 'scale_b': -0.5})
+        np.testing.assert_array_equal(data['val'], values)
+
+    def test_round_trip_metric(self):
+        data = decode_message(encode_message("met", "97", "MDC_PULS_OXIM_SAT_O2", "%", 1, 10 ** 18, 10 ** 18,
+                                             np.float64(97.5)))
+        self.assertEqual(data['type'], "met")
+        self.assertEqual(data['val'], 97.5)
+        self.assertNotIn('srcmeta', data)
+
+    def test_round_trip_non_ascii(self):
+        # multi byte characters make the byte lengths in the header longer than the string lengths
+        values = np.array([1.5, -2.25, 3.0])
+        data = decode_message(encode_message("wav", "bed-µ3", "SpO₂ pleth", "°C", 125.0, 1, 2, values))
+        self.assertEqual((data['devid'], data['mname'], data['uom']), ("bed-µ3", "SpO₂ pleth", "°C"))
+        np.testing.assert_array_equal(data['val'], values)
+
+        data = decode_message(encode_message("met", "bed-µ3", "temp", "°C", 1, 1, 2, np.float64(36.6)))
+        self.assertEqual((data['devid'], data['mname'], data['uom'], data['val']), ("bed-µ3", "temp", "°C", 36.6))
+
+    def test_round_trip_empty_strings_and_values(self):
+        data = decode_message(encode_message("wav", "", "", "", 500, 1, 2, np.array([], dtype=np.int32)))
+        self.assertEqual((data['devid'], data['mname'], data['uom']), ("", "", ""))
+        self.assertEqual(data['val'].size, 0)
+
+    def test_metric_without_one_value(self):
+        with self.assertRaises(BinaryMessageError):
+            decode_message(encode_message("met", "97", "hr", "bpm", 1, 1, 2, np.array([], dtype=np.float64)))
+        with self.assertRaises(BinaryMessageError):
+            decode_message(encode_message("met", "97", "hr", "bpm", 1, 1, 2, np.array([60.0, 61.0])))
+
+    def test_invalid_utf8(self):
+        body = bytearray(encode_message("wav", "97", "hr", "bpm", 1, 1, 2, np.array([1.0])))
+        # replace the first byte of the device id with a lone continuation byte
+        body[HEADER_STRUCT.size] = 0x80
+        with self.assertRaises(BinaryMessageError):
+            decode_message(bytes(body))
+
+    def test_bad_lengths(self):
+        body = encode_message("wav", "97", "hr", "bpm", 1, 1, 2, np.array([1.0, 2.0]))
+        with self.assertRaises(BinaryMessageError):
+            decode_message(body[:-1])
+        with self.assertRaises(BinaryMessageError):
+            decode_message(body[:HEADER_STRUCT.size - 1])
+
+    def test_bad_header_fields(self):
+        body = encode_message("wav", "97", "hr", "bpm", 1, 1, 2, np.array([1.0]))
+        for field, value in ((0, binary_message.VERSION + 1), (1, 7), (2, 255)):
+            header = list(HEADER_STRUCT.unpack_from(body, 0))
+            header[field] = value
+            with self.assertRaises(BinaryMessageError):
+                decode_message(HEADER_STRUCT.pack(*header) + body[HEADER_STRUCT.size:])
@@ -0,0 +1,108 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+import unittest
+from walwriter.prefetch_controller import PrefetchController
+
+# run from the wal_writer directory with the service's requirements and config, for example:
+#   WALWRITER_CONFIG_DIR=/path/to/config python -m pytest test/test_prefetch_controller.py
+
+
+class FakeChannel:
+    def __init__(self):
+        self.prefetch_counts = []
+
+    async def set_qos(self, prefetch_count, global_=False):
+        self.prefetch_counts.append(prefetch_count)
+
+
+def make_controller(initial_prefetch=1000, min_prefetch=100, max_prefetch=5000, channel=None):
+    return PrefetchController(channel, initial_prefetch=initial_prefetch, min_prefetch=min_prefetch,
+                              max_prefetch=max_prefetch, target_latency_ms=5, max_rss_mb=2048, interval=5)
+
+
+class TestPrefetchController(unittest.TestCase):
+
+    def test_raise_with_headroom(self):
+        controller = make_controller()
+        self.assertEqual(controller.decide(latency_ms=1, max_in_flight=10, rss_mb=100), (1050, "headroom"))
+
+    def test_steady_without_traffic(self):
+        controller = make_controller()
+        self.assertEqual(controller.decide(latency_ms=None, max_in_flight=0, rss_mb=100), (1000, "steady"))
+        # latency between half the target and the target isn't enough headroom to grow
+        self.assertEqual(controller.decide(latency_ms=4, max_in_flight=10, rss_mb=100), (1000, "steady"))
+
+    def test_lower_on_latency(self):
+        controller = make_controller()
+        self.assertEqual(controller.decide(latency_ms=6, max_in_flight=10, rss_mb=100), (500, "latency"))
+
+    def test_lower_on_memory(self):
+        controller = make_controller()
+        # memory is checked first, even if the latency is also too high
+        self.assertEqual(controller.decide(latency_ms=6, max_in_flight=10, rss_mb=4096), (500, "memory"))
+        # close to the memory limit it holds steady instead of growing
+        self.assertEqual(controller.decide(latency_ms=1, max_in_flight=10, rss_mb=1800), (1000, "steady"))
+
+    def test_lower_on_queue(self):
+        controller = make_controller()
+        self.assertEqual(controller.decide(latency_ms=1, max_in_flight=501, rss_mb=100), (500, "queue"))
+
+    def test_clamped_to_bounds(self):
+        controller = make_controller(initial_prefetch=150, max_prefetch=1020)
+        self.assertEqual(controller.decide(latency_ms=6, max_in_flight=0, rss_mb=100), (100, "latency"))
+
+        controller = make_controller(initial_prefetch=1000, max_prefetch=1020)
+        self.assertEqual(controller.decide(latency_ms=1, max_in_flight=0, rss_mb=100), (1020, "headroom"))
+
+        # the initial prefetch is clamped too
+        self.assertEqual(make_controller(initial_prefetch=10).prefetch, 100)
+        self.assertEqual(make_controller(initial_prefetch=10_000).prefetch, 5000)
+
+    def test_adjust_applies_new_prefetch(self):
+        channel = FakeChannel()
+        controller = make_controller(initial_prefetch=200, channel=channel)
+
+        async def run():
+            # slow writes halve the prefetch, the second halving stops at min_prefetch
+            for _ in range(2):
+                controller.observe_write(10)
+                await controller.adjust()
+            # no change doesn't touch the channel
+            await controller.adjust()
+            # fast writes grow it again
+            controller.observe_write(1)
+            await controller.adjust()
+
+        asyncio.run(run())
+        self.assertEqual(channel.prefetch_counts, [100, 150])
+        self.assertEqual(controller.prefetch, 150)
+
+    def test_frame_waits_not_counted_as_queue(self):
+        controller = make_controller()
+        for _ in range(600):
+            controller.message_started()
+            controller.frame_wait_started()
+        controller.message_started()
+        # only the one message that isn't waiting for its WAL frame counts as in progress
+        self.assertEqual(controller.max_in_flight, 1)
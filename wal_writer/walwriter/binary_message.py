@@ -0,0 +1,118 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import struct
+import numpy as np
+from wal.io.data import value_data_type_dict
+
+# AMQP content type producers set to send a message in the binary format instead of JSON
+CONTENT_TYPE = "application/x-atriumdb-cmf"
+VERSION = 1
+
+# version, msg type, value type, flags, devid length, mname length, uom length, number of values, freq (Hz),
+# mtime (ns), systime (ns), scale_m, scale_b. After this comes devid, mname and uom as utf-8 and then the samples as a
+# little endian array of the value type
+HEADER_STRUCT = struct.Struct("<BBBBHHHIdqqdd")
+
+MSG_TYPES = {0: "wav", 1: "met", 2: "alm"}
+MSG_TYPE_CODES = {name: code for code, name in MSG_TYPES.items()}
+
+# set if scale_m and scale_b are filled in. It means the same thing as srcmeta in a JSON message, the samples are
+# integers and if m or b are non-zero they were scaled to get there
+FLAG_HAS_SCALE = 1
+
+
+class BinaryMessageError(ValueError):
+    pass
+
+
+# decodes a binary message into the same dictionary a JSON message is parsed into, except 'val' is a read only numpy
+# view of the message body for waveforms and a numpy scalar for metrics instead of a string
+def decode_message(body: bytes) -> dict:
+    try:
+        version, msg_type, value_type, flags, devid_len, mname_len, uom_len, num_values, freq, mtime, systime, \
+            scale_m, scale_b = HEADER_STRUCT.unpack_from(body, 0)
+    except struct.error as e:
+        raise BinaryMessageError("Binary message is too short for its header") from e
+
+    if version != VERSION:
+        raise BinaryMessageError("Unsupported binary message version {}".format(version))
+    if msg_type not in MSG_TYPES:
+        raise BinaryMessageError("Unknown binary message type {}".format(msg_type))
+    if value_type not in value_data_type_dict:
+        raise BinaryMessageError("Unknown binary message value type {}".format(value_type))
+
+    # a metric message is a single value, it's stored as one time value pair
+    if MSG_TYPES[msg_type] == "met" and num_values != 1:
+        raise BinaryMessageError("Binary metric message has {} values instead of 1".format(num_values))
+
+    dtype = value_data_type_dict[value_type]
+    offset = HEADER_STRUCT.size
+    values_offset = offset + devid_len + mname_len + uom_len
+    if len(body) != values_offset + num_values * dtype.itemsize:
+        raise BinaryMessageError("Binary message length doesn't match the lengths in its header")
+
+    # the lengths are in bytes so each string has to be cut out of the body before it's decoded
+    try:
+        devid = _decode_string(body, offset, devid_len)
+        mname = _decode_string(body, offset + devid_len, mname_len)
+        uom = _decode_string(body, offset + devid_len + mname_len, uom_len)
+    except UnicodeDecodeError as e:
+        raise BinaryMessageError("Binary message has a string that isn't valid utf-8") from e
+    values = np.frombuffer(body, dtype=dtype, count=num_values, offset=values_offset)
+
+    data = {'type': MSG_TYPES[msg_type],
+            'devid': devid,
+            'mname': mname,
+            'uom': uom,
+            'freq': freq,
+            'mtime': mtime,
+            'systime': systime,
+            'val': values[0] if MSG_TYPES[msg_type] == "met" else values}
+
+    if flags & FLAG_HAS_SCALE:
+        data['srcmeta'] = {'scale_m': scale_m, 'scale_b': scale_b}
+
+    return data
+
+
+def _decode_string(body: bytes, offset: int, length: int) -> str:
+    return bytes(body[offset:offset + length]).decode('utf-8')
+
+
+# builds a binary message, used by producers and test tools
+def encode_message(msg_type: str, devid: str, mname: str, uom: str, freq: float, mtime: int, systime: int,
+                   values: np.ndarray, scale_m: float = None, scale_b: float = None) -> bytes:
+    values = np.atleast_1d(values)
+    value_type = next((code for code, dtype in value_data_type_dict.items() if dtype == values.dtype.newbyteorder('<')),
+                      None)
+    if value_type is None:
+        raise BinaryMessageError("Values of type {} can't be sent in a binary message".format(values.dtype))
+
+    devid, mname, uom = devid.encode('utf-8'), mname.encode('utf-8'), uom.encode('utf-8')
+    has_scale = scale_m is not None and scale_b is not None
+
+    header = HEADER_STRUCT.pack(VERSION, MSG_TYPE_CODES[msg_type], value_type, FLAG_HAS_SCALE if has_scale else 0,
+                                len(devid), len(mname), len(uom), values.size, freq, mtime, systime,
+                                scale_m if has_scale else 0, scale_b if has_scale else 0)
+
+    return b''.join((header, devid, mname, uom, values.astype(value_data_type_dict[value_type], copy=False).tobytes()))
@@ -23,6 +23,11 @@
 import yaml
 from pathlib import Path
 import ast
+import os
+
+# the config and secrets files are mounted at the root of the container, this lets tools like the benchmark point
+# somewhere else
+CONFIG_DIR = os.environ.get("WALWRITER_CONFIG_DIR", "/")
 
 
 class Config:
@@ -59,7 +64,7 @@ class Config:
             self.siridb['hosts'] = [ast.literal_eval(conn) for conn in self.siridb['hosts']]
 
     def load_config(self, file_name):
-        stream = open(f"/{file_name}", 'r')
+        stream = open(Path(CONFIG_DIR) / file_name, 'r')
         data = yaml.load(stream, Loader=yaml.FullLoader)
         config_keys = data.keys()
         # keys (k) will be the non-indented headers such as metadb, svc_tsc_gen ect
@@ -0,0 +1,156 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import asyncio
+import logging
+import resource
+from helpers.metrics import (get_metric,
+                             WALWRITER_ERRORS,
+                             WALWRITER_PREFETCH_COUNT,
+                             WALWRITER_PREFETCH_ADJUSTMENTS)
+
+
+class PrefetchController:
+    """
+    Adjusts the RabbitMQ prefetch count at runtime. Every interval it looks at the average WAL write latency, how many
+    messages are being processed at once (the internal queue) and the process RSS. If any of them is over its limit the
+    prefetch is cut by decrease_factor, if they all have plenty of headroom it is raised by increase_step, always
+    staying within [min_prefetch, max_prefetch].
+    """
+
+    def __init__(self, channel, initial_prefetch: int, min_prefetch: int, max_prefetch: int, target_latency_ms: float,
+                 max_rss_mb: float, interval: float, increase_step: int = None, decrease_factor: float = 0.5):
+        self._LOGGER = logging.getLogger(__name__)
+        self.channel = channel
+        self.min_prefetch = min_prefetch
+        self.max_prefetch = max_prefetch
+        self.target_latency_ms = target_latency_ms
+        self.max_rss_mb = max_rss_mb
+        self.interval = interval
+        self.increase_step = increase_step if increase_step is not None else max(1, min_prefetch // 2)
+        self.decrease_factor = decrease_factor
+
+        self.prefetch = self._clamp(initial_prefetch)
+
+        # observations collected since the last adjustment
+        self.latency_sum_ms = 0.0
+        self.latency_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # messages that are written and only waiting for their WAL frame to be written before they're acked. They are
+        # expected to pile up with compressed or columnar WAL files so they don't count towards the queue limit
+        self.waiting_on_frame = 0
+
+        self.task = None
+        self.exception_counter = get_metric(WALWRITER_ERRORS)
+        self.prefetch_gauge = get_metric(WALWRITER_PREFETCH_COUNT)
+        self.adjustment_counter = get_metric(WALWRITER_PREFETCH_ADJUSTMENTS)
+
+    async def start(self):
+        # global qos is a limit on the whole channel and, unlike per consumer qos, can be changed while consuming
+        await self.channel.set_qos(prefetch_count=self.prefetch, global_=True)
+        self.prefetch_gauge.add(self.prefetch)
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def observe_write(self, duration_ms: float):
+        self.latency_sum_ms += duration_ms
+        self.latency_count += 1
+
+    def message_started(self):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight - self.waiting_on_frame)
+
+    def message_finished(self):
+        self.in_flight -= 1
+
+    def frame_wait_started(self):
+        self.waiting_on_frame += 1
+
+    def frame_wait_finished(self):
+        self.waiting_on_frame -= 1
+
+    def decide(self, latency_ms, max_in_flight: int, rss_mb: float):
+        """Returns the new prefetch count and the reason for it, latency_ms is None if no messages were written."""
+        if rss_mb > self.max_rss_mb:
+            return self._clamp(int(self.prefetch * self.decrease_factor)), "memory"
+
+        if latency_ms is not None and latency_ms > self.target_latency_ms:
+            return self._clamp(int(self.prefetch * self.decrease_factor)), "latency"
+
+        # more than half the prefetched messages are stuck inside the wal writer (usually waiting on siri inserts)
+        if max_in_flight > self.prefetch // 2:
+            return self._clamp(int(self.prefetch * self.decrease_factor)), "queue"
+
+        # only grow while there is traffic and plenty of headroom on both latency and memory
+        if latency_ms is not None and latency_ms < self.target_latency_ms / 2 and rss_mb < self.max_rss_mb * 0.8:
+            return self._clamp(self.prefetch + self.increase_step), "headroom"
+
+        return self.prefetch, "steady"
+
+    async def adjust(self):
+        latency_ms = self.latency_sum_ms / self.latency_count if self.latency_count != 0 else None
+        new_prefetch, reason = self.decide(latency_ms, self.max_in_flight, get_rss_mb())
+
+        self.latency_sum_ms, self.latency_count = 0.0, 0
+        self.max_in_flight = self.in_flight - self.waiting_on_frame
+
+        if new_prefetch == self.prefetch:
+            return
+
+        self._LOGGER.debug(f"Changing prefetch count from {self.prefetch} to {new_prefetch} ({reason}), "
+                           f"avg write latency={latency_ms} ms")
+        await self.channel.set_qos(prefetch_count=new_prefetch, global_=True)
+
+        direction = "up" if new_prefetch > self.prefetch else "down"
+        self.prefetch_gauge.add(new_prefetch - self.prefetch)
+        self.adjustment_counter.add(1, {"direction": direction, "reason": reason})
+        self.prefetch = new_prefetch
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.adjust()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._LOGGER.error("Error adjusting the prefetch count", exc_info=True)
+                self.exception_counter.add(1)
+
+    def _clamp(self, prefetch: int) -> int:
+        return max(self.min_prefetch, min(self.max_prefetch, prefetch))
+
+
+def get_rss_mb() -> float:
+    # current resident set size from /proc, fall back to the peak rss on systems without it
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
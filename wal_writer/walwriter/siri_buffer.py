@@ -0,0 +1,152 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import asyncio
+import logging
+from collections import deque
+from time import time
+from helpers.metrics import (get_metric,
+                             WALWRITER_ERRORS,
+                             WALWRITER_SIRI_FLUSH_DURATION,
+                             WALWRITER_SIRI_DROPPED_POINTS)
+
+
+class SiriInsertBuffer:
+    """
+    Coalesces SiriDB points from many messages into a few large inserts. Points are accumulated per series and flushed
+    when the buffer holds max_points or every flush_interval seconds, with at most max_concurrency inserts in flight.
+    Batches that can't be inserted (no connection or insert error) are kept in a retry queue capped at
+    max_retry_points, the oldest batches are dropped first once that cap is reached.
+    """
+
+    def __init__(self, siri, max_points: int, flush_interval: float, max_concurrency: int, max_retry_points: int):
+        self._LOGGER = logging.getLogger(__name__)
+        self.siri = siri
+        self.max_points = max_points
+        self.flush_interval = flush_interval
+        self.max_retry_points = max_retry_points
+
+        # series name -> list of [time, value] points waiting to be inserted
+        self.points = {}
+        self.num_points = 0
+
+        # (batch, num_points) tuples that failed to insert and will be retried once siri is connected again
+        self.retry_queue = deque()
+        self.num_retry_points = 0
+
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.insert_tasks = set()
+        self.flush_task = None
+
+        self.exception_counter = get_metric(WALWRITER_ERRORS)
+        self.flush_duration = get_metric(WALWRITER_SIRI_FLUSH_DURATION)
+        self.dropped_points_counter = get_metric(WALWRITER_SIRI_DROPPED_POINTS)
+
+    def start(self):
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def add(self, name: str, points: list):
+        self.points.setdefault(name, []).extend(points)
+        self.num_points += len(points)
+
+        if self.num_points >= self.max_points:
+            await self.flush()
+
+    async def flush(self):
+        if self.num_points == 0:
+            return
+
+        batch, num_points = self.points, self.num_points
+        self.points, self.num_points = {}, 0
+
+        # wait for a free insert slot, this applies backpressure to the message consumer if siri can't keep up
+        await self.semaphore.acquire()
+        self._spawn_insert(batch, num_points)
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+
+        # push out anything still buffered and wait for all inserts to finish
+        await self.flush()
+        await asyncio.gather(*self.insert_tasks, return_exceptions=True)
+
+        if self.num_retry_points != 0:
+            self._LOGGER.warning(f"Dropping {self.num_retry_points} SiriDB points that could not be inserted before shutdown")
+            self.dropped_points_counter.add(self.num_retry_points)
+            self.retry_queue.clear()
+            self.num_retry_points = 0
+
+    def _spawn_insert(self, batch: dict, num_points: int):
+        task = asyncio.create_task(self._insert(batch, num_points))
+        self.insert_tasks.add(task)
+        task.add_done_callback(self.insert_tasks.discard)
+
+    async def _insert(self, batch: dict, num_points: int):
+        try:
+            if not self.siri.connected:
+                self._queue_retry(batch, num_points)
+                return
+
+            start_time = time()
+            await self.siri.insert(batch)
+            self.flush_duration.record((time() - start_time) * 1_000_000.00)
+        except asyncio.CancelledError:
+            self._queue_retry(batch, num_points)
+            raise
+        except Exception:
+            self._LOGGER.error("Error inserting points into SiriDB, queueing them for retry", exc_info=True)
+            self.exception_counter.add(1)
+            self._queue_retry(batch, num_points)
+        finally:
+            self.semaphore.release()
+
+    def _queue_retry(self, batch: dict, num_points: int):
+        self.retry_queue.append((batch, num_points))
+        self.num_retry_points += num_points
+
+        # drop the oldest batches so the retry queue doesn't grow without bound during a long siri outage
+        while self.num_retry_points > self.max_retry_points and len(self.retry_queue) > 1:
+            _, dropped_points = self.retry_queue.popleft()
+            self.num_retry_points -= dropped_points
+            self.dropped_points_counter.add(dropped_points)
+
+    async def _retry(self):
+        while self.retry_queue and self.siri.connected:
+            batch, num_points = self.retry_queue.popleft()
+            self.num_retry_points -= num_points
+
+            await self.semaphore.acquire()
+            self._spawn_insert(batch, num_points)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                await self._retry()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._LOGGER.error("Error flushing SiriDB insert buffer", exc_info=True)
+                self.exception_counter.add(1)
@@ -0,0 +1,101 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import signal
+import logging
+import threading
+import multiprocessing
+
+# environment variable each worker process reads its id from, it is also used to label the worker's metrics
+WORKER_ID_ENV = "WALWRITER_WORKER_ID"
+
+
+class WALWriterSupervisor:
+    """
+    Runs num_workers wal writer processes and restarts any that exit unexpectedly. Each worker is a fresh (spawned)
+    interpreter with its own event loop, RabbitMQ connection and WALFileManager, so no state or file handles are shared
+    between them.
+    """
+
+    def __init__(self, target, num_workers: int, restart_delay: float = 5, stop_timeout: float = 60):
+        self._LOGGER = logging.getLogger(__name__)
+        self.target = target
+        self.num_workers = num_workers
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+        # spawn instead of fork so workers don't inherit the supervisor's threads (metrics exporter) or open sockets
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers = {}
+        self.exit_event = threading.Event()
+
+    def run(self):
+        for sig in ('SIGTERM', 'SIGHUP', 'SIGINT'):
+            if hasattr(signal, sig):
+                signal.signal(getattr(signal, sig), self._signal_handler)
+
+        for worker_id in range(self.num_workers):
+            self._start_worker(worker_id)
+
+        while not self.exit_event.is_set():
+            for worker_id, process in list(self.workers.items()):
+                if not process.is_alive():
+                    self._LOGGER.warning(f"WAL writer worker {worker_id} exited with code {process.exitcode}, restarting it "
+                                         f"in {self.restart_delay}s")
+                    if self.exit_event.wait(self.restart_delay):
+                        break
+                    self._start_worker(worker_id)
+
+            self.exit_event.wait(1)
+
+        self._stop_workers()
+
+    def _start_worker(self, worker_id: int):
+        # the spawned interpreter copies the environment when it starts so the id has to be set before start()
+        os.environ[WORKER_ID_ENV] = str(worker_id)
+        process = self.ctx.Process(target=self.target, name=f"walwriter-{worker_id}")
+        process.start()
+        self.workers[worker_id] = process
+        self._LOGGER.info(f"Started WAL writer worker {worker_id} (pid {process.pid})")
+
+    def _stop_workers(self):
+        # SIGTERM lets every worker close its RabbitMQ connection and WAL files cleanly
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+        for worker_id, process in self.workers.items():
+            process.join(timeout=self.stop_timeout)
+            if process.is_alive():
+                self._LOGGER.error(f"WAL writer worker {worker_id} did not stop after {self.stop_timeout}s, killing it")
+                process.kill()
+                process.join()
+
+        self._LOGGER.info("All WAL writer workers stopped")
+
+    def _signal_handler(self, signo, _frame):
+        self._LOGGER.info(f"Supervisor interrupted by signal {signo}, stopping workers")
+        self.exit_event.set()
+
+
+def get_worker_id() -> int:
+    return int(os.environ.get(WORKER_ID_ENV, 0))
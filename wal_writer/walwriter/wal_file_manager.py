@@ -23,56 +23,144 @@
 import orjson
 import numpy as np
 import atexit
+import ctypes
+import math
+import os
 import random
 import time
 import threading
 import logging
 import xxhash
+from typing import Union
+from collections import OrderedDict
 from apscheduler.schedulers.background import BackgroundScheduler
-from wal import WALWriter, ValueType, ValueMode, ScaleType, get_null_header_dictionary
-from helpers.metrics import get_metric, WALWRITER_WAL_FILES_OPEN, WALWRITER_WAL_FILES_CREATED
+from wal import WALWriter, WALHeaderStructure, WAL_FLAG_ZSTD, WAL_FLAG_COLUMNAR, ValueType, ValueMode, ScaleType, get_null_header_dictionary
+from helpers.metrics import get_metric, WALWRITER_WAL_FILES_OPEN, WALWRITER_WAL_FILES_CREATED, \
+    WALWRITER_WAL_FILES_EVICTED, WALWRITER_WAL_FILES_REOPENED, WALWRITER_WAL_FILES_ROTATED
 
 
-class WALFileManager:
+class WALFileStripe:
+    """One shard of the WAL file pool, a stripe's lock only guards the files whose key hashes to it."""
+
+    def __init__(self):
+        # ordered from least to most recently used so the oldest file is the first one evicted
+        self.pool = OrderedDict()
+        # files closed because the stripe was full, kept so the next write to that key can reopen the same file
+        self.evicted = {}
+        self.lock = threading.Lock()
+
 
-    pool = {}
-    lock = threading.Lock()
+class WALFileManager:
 
-    def __init__(self, path: str, file_length_time: int, idle_timeout: int, gc_schedule_min: int):
+    def __init__(self, path: str, file_length_time: int, idle_timeout: int, gc_schedule_min: int, num_stripes: int = 16,
+                 max_open_files: int = None, reopen_max_age: int = 900, rotation_policy: dict = None,
+                 narrow_value_types: bool = False, compression_frame_size: int = 0, compression_level: int = 3,
+                 columnar_chunk_size: int = 0, max_frame_age: float = 5):
 
         self._LOGGER = logging.getLogger(__name__)
         self.path = path
         self.idle_timeout = idle_timeout
         self.file_length_time = file_length_time
+        # the pool is split into stripes so writers to different files don't contend on a single lock
+        self.stripes = [WALFileStripe() for _ in range(num_stripes)]
+        # the open file limit is enforced per stripe so evicting never needs more than the one lock already held
+        self.max_open_per_stripe = None if not max_open_files else max(1, math.ceil(max_open_files / num_stripes))
+        # an evicted file is only reopened if it was written to this recently, this has to stay well under the tsc
+        # generator's wait_close_time so it never appends to a file that is being ingested
+        self.reopen_max_age = reopen_max_age
+        # msg_type -> {"max_values": int, "max_bytes": int}, a file is closed early once it hits either limit so the
+        # tsc generator gets inputs of a bounded size. Message types that aren't in here are only split by time
+        self.rotation_policy = rotation_policy if rotation_policy is not None else {}
+        # store scaled waveforms as the smallest int type their values fit in instead of always using int64
+        self.narrow_value_types = narrow_value_types
+        # if set WAL files are written as zstd frames of this many messages
+        self.compression_frame_size = compression_frame_size
+        self.compression_level = compression_level
+        # if set WAL files store chunks of this many messages column by column, if they are also compressed each chunk
+        # is one frame
+        self.columnar_chunk_size = columnar_chunk_size
+        # a frame that hasn't filled up is written anyway once its oldest message has waited this many seconds. Messages
+        # aren't acked until their frame is written and the file's mtime only moves when a frame is written, so this
+        # bounds both the ack delay and how stale a file being written to can look to the tsc generator
+        self.max_frame_age = max_frame_age
         self.scheduler = BackgroundScheduler(daemon=True)
         self.scheduler.add_job(func=self._gc, trigger="interval", minutes=gc_schedule_min)
+        if self.buffers_messages():
+            self.scheduler.add_job(func=self._write_old_frames, trigger="interval", seconds=max(self.max_frame_age / 2, 0.1))
         self.scheduler.start()
         self.open_wal_file_counter = get_metric(WALWRITER_WAL_FILES_OPEN)  # open telemetry metric
         self.wal_files_created_counter = get_metric(WALWRITER_WAL_FILES_CREATED)
+        self.wal_files_evicted_counter = get_metric(WALWRITER_WAL_FILES_EVICTED)
+        self.wal_files_reopened_counter = get_metric(WALWRITER_WAL_FILES_REOPENED)
+        self.wal_files_rotated_counter = get_metric(WALWRITER_WAL_FILES_ROTATED)
         atexit.register(self.close)
 
-    # writes data to the appropriate file
+    # True if messages are held in memory until a whole frame or chunk of them is written
+    def buffers_messages(self) -> bool:
+        return bool(self.compression_frame_size or self.columnar_chunk_size)
+
+    # writes data to the appropriate file. on_written is called with None once the message is on disk, or with the
+    # exception if writing it failed. If buffers_messages() is True that can be after this returns and from another
+    # thread, otherwise it's called before this returns
     def write(self, device_name: str,  server_time_ns: int, msg_type: str, measure_name: str, data_time_ns: int,
-              measure_units: str, freq: float, data: str, meta_data: dict = None):
+              measure_units: str, freq: float, data: Union[str, np.ndarray], meta_data: dict = None,
+              timings: dict = None, on_written=None):
+        # if a timings dict is passed the time spent in each step is put in it for the stage duration metrics
+        if timings is not None:
+            start = time.perf_counter()
 
         header, values = self.parse_header(device_name=device_name, msg_type=msg_type, measure_name=measure_name,
                                            data_time_ns=data_time_ns, measure_units=measure_units, freq=freq, data=data,
                                            meta_data=meta_data)
 
-        with self.lock:
-            file = self._get_file(meta_data=header)
+        key = self._get_key(meta_data=header)
+        stripe = self._get_stripe(key)
+
+        if timings is not None:
+            header_end = time.perf_counter()
+            timings["header"] = header_end - start
+
+        # the key is made from the int64 header so the width a file ends up using doesn't change which file it is
+        min_value_type = None
+        if self.narrow_value_types and header["input_value_type"] == ValueType.INT64.value:
+            min_value_type = get_narrowest_int_type(values)
+
+        with stripe.lock:
+            file = self._get_file(stripe=stripe, key=key, meta_data=header, min_value_type=min_value_type)
+            if min_value_type is not None:
+                values = values.astype(file.value_dtype, copy=False)
+            if timings is not None:
+                pool_end = time.perf_counter()
+                timings["pool"] = pool_end - header_end
+
             if header["mode"] == ValueMode.INTERVALS.value:
                 file.write_interval_message(start_time_nominal=int(data_time_ns), start_time_server=int(server_time_ns),
-                                            values=values)
+                                            values=values, on_written=on_written)
+                num_values = values.size
             else:
                 file.write_time_value_pair_message(time_nominal=int(data_time_ns), time_server=int(server_time_ns),
-                                                   value=values)
+                                                   value=values, on_written=on_written)
+                num_values = 1
+
+            if file.frame_age() >= self.max_frame_age:
+                file.write_frame()
+
+            if msg_type in self.rotation_policy:
+                self._rotate_if_full(stripe=stripe, key=key, msg_type=msg_type, num_values=num_values)
+
+        if timings is not None:
+            timings["file_write"] = time.perf_counter() - pool_end
 
     def parse_header(self, device_name: str, msg_type: str, measure_name: str, data_time_ns: int, measure_units: str,
-                     freq: float, data: str, meta_data: dict = None):
+                     freq: float, data: Union[str, np.ndarray], meta_data: dict = None):
 
         header = self.get_base_header()
         header["version"] = 1
+        if self.compression_frame_size or self.columnar_chunk_size:
+            header["version"] = 2
+            header["flags"] = (WAL_FLAG_ZSTD if self.compression_frame_size else 0) | \
+                (WAL_FLAG_COLUMNAR if self.columnar_chunk_size else 0)
+            header["frame_size"] = self.columnar_chunk_size or self.compression_frame_size
         header["device_name"] = bytes(device_name+("\0"*(64-len(device_name))), 'utf-8')
         header["sample_freq"] = int(freq * (10 ** 9))
         # all files within an hour of mtime go in the same file
@@ -94,8 +182,11 @@ class WALFileManager:
         if msg_type =="wav":
             header["mode"] = ValueMode.INTERVALS.value
             header["samples_per_message"] = 0  # not used for waveforms
-            # parse the values from the '^' delimited string
-            values = np.fromstring(data, dtype=float, sep='^')
+            # binary messages already come in as a numpy array, JSON ones need the '^' delimited string parsed
+            if isinstance(data, np.ndarray):
+                values = data
+            else:
+                values = np.fromstring(data, dtype=float, sep='^')
 
             # check for scale factors for Phillips and Draeger data
             if meta_data is not None and "scale_m" in meta_data and "scale_b" in meta_data:
@@ -121,6 +212,7 @@ class WALFileManager:
             # here no scaling is applied and floats are written to disk
             else:
                 header["input_value_type"] = ValueType.FLOAT64.value
+                values = values.astype(np.float64, copy=False)
 
         # metrics dont get scaled
         elif msg_type == "met":
@@ -136,14 +228,79 @@ class WALFileManager:
         header["version"] = 1
         return header
 
-    # gets file from the pool, creating one if it doesn't exist
-    def _get_file(self, meta_data: dict):
-        key = self._get_key(meta_data)
-        if key not in self.pool.keys():
-            self._create_and_register(meta_data)
+    # total number of open WAL files across all stripes
+    def open_file_count(self) -> int:
+        return sum(len(stripe.pool) for stripe in self.stripes)
+
+    # finds the stripe that owns a file key
+    def _get_stripe(self, key: str) -> WALFileStripe:
+        # the key is a hex digest so its leading bits are already uniformly distributed
+        return self.stripes[int(key[:8], 16) % len(self.stripes)]
+
+    # gets file from the pool, creating one if it doesn't exist. If min_value_type is set the file's value type has to be
+    # at least that wide, if it isn't the file is finished and a new one is started with the wider type. Must be called
+    # while holding the stripe's lock
+    def _get_file(self, stripe: WALFileStripe, key: str, meta_data: dict, min_value_type: int = None):
+        if key in stripe.pool and min_value_type is not None and stripe.pool[key]["value_type"] < min_value_type:
+            self._retire(stripe=stripe, key=key, msg_type="wav", reason="promote")
+
+        if key in stripe.pool:
+            stripe.pool.move_to_end(key)
+        else:
+            if min_value_type is not None:
+                meta_data = dict(meta_data, input_value_type=min_value_type)
+
+            evicted = stripe.evicted.pop(key, None)
+            if evicted is None or evicted["value_type"] < meta_data["input_value_type"] or \
+                    not self._reopen_and_register(stripe=stripe, key=key, meta_data=meta_data, evicted=evicted):
+                self._create_and_register(stripe=stripe, key=key, meta_data=meta_data)
 
-        self.pool[key]["last_access"] = time.time()
-        return self.pool[key]["handle"]
+            if self.max_open_per_stripe is not None:
+                while len(stripe.pool) > self.max_open_per_stripe:
+                    self._evict_oldest(stripe)
+
+        entry = stripe.pool[key]
+        entry["last_access"] = time.time()
+        return entry["handle"]
+
+    # closes the least recently used file in the stripe and remembers it so it can be reopened. Must be called while
+    # holding the stripe's lock
+    def _evict_oldest(self, stripe: WALFileStripe):
+        key, entry = stripe.pool.popitem(last=False)
+        self._LOGGER.debug("Evicting: {}".format(entry["file_path"]))
+        entry["handle"].close()
+        stripe.evicted[key] = {"file_name": entry["file_name"], "file_path": entry["file_path"],
+                               "num_values": entry["num_values"], "value_type": entry["value_type"]}
+        self.open_wal_file_counter.add(-1)
+        self.wal_files_evicted_counter.add(1)
+
+    # reopens an evicted file in append mode, returns False if the file can't safely be appended to anymore
+    def _reopen_and_register(self, stripe: WALFileStripe, key: str, meta_data: dict, evicted: dict) -> bool:
+        try:
+            stat = os.stat(evicted["file_path"])
+        except FileNotFoundError:
+            # the tsc generator already ingested and deleted it
+            return False
+
+        # if it hasn't been written to in a while the tsc generator may be about to pick it up, so start a new file
+        if time.time() - stat.st_mtime >= self.reopen_max_age or stat.st_size < ctypes.sizeof(WALHeaderStructure):
+            return False
+
+        writer = WALWriter(directory=self.path, filename=evicted["file_name"], append=True,
+                           compression_level=self.compression_level)
+        # the file may have been promoted to a wider type than this message needs, keep using the file's type
+        writer.load_header(dict(meta_data, input_value_type=evicted["value_type"]))
+        stripe.pool[key] = {
+            "file_name": evicted["file_name"],
+            "file_path": evicted["file_path"],
+            "handle": writer,
+            "last_access": time.time(),
+            "num_values": evicted["num_values"],
+            "value_type": evicted["value_type"]
+        }
+        self.open_wal_file_counter.add(1)
+        self.wal_files_reopened_counter.add(1)
+        return True
 
     def _hash_metadata(self, meta_data: dict):
         # convert any values that are bytes in the dictionary to string so it can serialize
@@ -159,48 +316,137 @@ class WALFileManager:
     def _get_key(self, meta_data) -> str:
         return "{}".format(self._hash_metadata(meta_data))
 
-    # creates a few file and registers it into the connection pool
-    def _create_and_register(self, meta_data: dict):
-        key = self._get_key(meta_data=meta_data)
+    # creates a new file and registers it into the stripe's pool
+    def _create_and_register(self, stripe: WALFileStripe, key: str, meta_data: dict):
         file_name = self._get_file_name(meta_data=meta_data)
-        writer = WALWriter(directory=self.path, filename=file_name)
+        writer = WALWriter(directory=self.path, filename=file_name, compression_level=self.compression_level)
         writer.write_header(meta_data)
         entry = {
             "file_name": file_name,
             "file_path": '/'.join((self.path, file_name)),
             "handle": writer,
-            "last_access": time.time()
+            "last_access": time.time(),
+            "num_values": 0,
+            "value_type": meta_data["input_value_type"]
         }
-        self.pool[key] = entry
+        stripe.pool[key] = entry
         self.open_wal_file_counter.add(1)
         self.wal_files_created_counter.add(1)
 
+    # closes the file for good once it reaches the size or sample count limit for its message type, the next write to
+    # this key will start a new file. Must be called while holding the stripe's lock
+    def _rotate_if_full(self, stripe: WALFileStripe, key: str, msg_type: str, num_values: int):
+        entry = stripe.pool[key]
+        entry["num_values"] += num_values
+        policy = self.rotation_policy[msg_type]
+
+        if policy.get("max_values") and entry["num_values"] >= policy["max_values"]:
+            reason = "values"
+        elif policy.get("max_bytes") and entry["handle"].current_file_pointer.tell() >= policy["max_bytes"]:
+            reason = "bytes"
+        else:
+            return
+
+        self._retire(stripe=stripe, key=key, msg_type=msg_type, reason=reason)
+
+    # closes a file and removes it from the pool without remembering it for a reopen. Must be called while holding the
+    # stripe's lock
+    def _retire(self, stripe: WALFileStripe, key: str, msg_type: str, reason: str):
+        entry = stripe.pool.pop(key)
+        self._LOGGER.debug("Rotating: {}".format(entry["file_path"]))
+        entry["handle"].close()
+        self.open_wal_file_counter.add(-1)
+        self.wal_files_rotated_counter.add(1, {"msg_type": msg_type, "reason": reason})
+
     # garbage collect stale file handles
     def _gc(self):
         self._LOGGER.debug("Running GC")
-        with self.lock:
-            keys = tuple(self.pool.keys())
-            for key in keys:
-                self.pool[key]["handle"].flush()
-                if time.time() - self.pool[key]["last_access"] >= self.idle_timeout:
-                    self._LOGGER.debug("Closing: {}".format(self.pool[key]["file_path"]))
-                    self.pool[key]["handle"].close()
-                    del self.pool[key]
-                    self.open_wal_file_counter.add(-1)
+        for stripe in self.stripes:
+            self._gc_stripe(stripe)
+
+    def _gc_stripe(self, stripe: WALFileStripe):
+        now = time.time()
+
+        # the open files are flushed while holding the lock, otherwise a writer could evict or rotate one and close it
+        # before it's flushed. Any partial frame or chunk is written out first so its messages get acked. Flushing only
+        # hands the buffered bytes to the OS so it's quick, the slower closing of the idle files happens after the lock
+        # is released
+        with stripe.lock:
+            idle_keys = [key for key, entry in stripe.pool.items() if now - entry["last_access"] >= self.idle_timeout]
+            idle_entries = [stripe.pool.pop(key) for key in idle_keys]
+            for entry in stripe.pool.values():
+                self._gc_call(entry, "write_frame")
+                self._gc_call(entry, "flush")
+            evicted = list(stripe.evicted.items())
+
+        # evicted files that are too old to be reopened don't need to be remembered anymore
+        stale_keys = [key for key, entry in evicted if not self._is_reopenable(entry["file_path"], now)]
+        if stale_keys:
+            with stripe.lock:
+                for key in stale_keys:
+                    stripe.evicted.pop(key, None)
+
+        # idle entries are no longer in the pool so nothing else can be holding them
+        for entry in idle_entries:
+            self._LOGGER.debug("Closing: {}".format(entry["file_path"]))
+            self._gc_call(entry, "close")
+            self.open_wal_file_counter.add(-1)
+
+    # one file failing to flush, write or close shouldn't stop the gc from getting to the rest of the files
+    def _gc_call(self, entry: dict, method: str):
+        try:
+            getattr(entry["handle"], method)()
+        except Exception:
+            self._LOGGER.error("Failed to {} WAL file {}".format(method, entry["file_path"]), exc_info=True)
+
+    # writes out the frames that have been waiting longer than max_frame_age, so a slow stream's messages get acked and
+    # its file's mtime keeps moving
+    def _write_old_frames(self):
+        for stripe in self.stripes:
+            with stripe.lock:
+                for entry in stripe.pool.values():
+                    if entry["handle"].frame_age() >= self.max_frame_age:
+                        self._gc_call(entry, "write_frame")
+
+    def _is_reopenable(self, file_path: str, now: float) -> bool:
+        try:
+            return now - os.path.getmtime(file_path) < self.reopen_max_age
+        except FileNotFoundError:
+            return False
 
     # when the wal writer exits this will close all open files and shut down the scheduler
     def close(self):
         if self.scheduler.running:
             self.scheduler.shutdown()
 
-        if len(self.pool) != 0:
+        if self.open_file_count() != 0:
             self._LOGGER.info("Closing open WAL files...")
-            with self.lock:
-                keys = tuple(self.pool.keys())
-                for key in keys:
-                    self.pool[key]["handle"].flush()
-                    self._LOGGER.info("Closing: {}".format(self.pool[key]["file_path"]))
-                    self.pool[key]["handle"].close()
-                    del self.pool[key]
+            for stripe in self.stripes:
+                with stripe.lock:
+                    entries = list(stripe.pool.values())
+                    stripe.pool.clear()
+                    stripe.evicted.clear()
+
+                for entry in entries:
+                    entry["handle"].flush()
+                    self._LOGGER.info("Closing: {}".format(entry["file_path"]))
+                    entry["handle"].close()
                     self.open_wal_file_counter.add(-1)
             self._LOGGER.info("All WAL files closed")
+
+
+# ordered narrowest to widest, the ValueType values for ints also go up with their width so they can be compared
+_NARROW_INT_TYPES = [(ValueType.INT8.value, np.iinfo(np.int8)), (ValueType.INT16.value, np.iinfo(np.int16)),
+                     (ValueType.INT32.value, np.iinfo(np.int32))]
+
+
+# finds the smallest int value type that can hold all the values without losing anything
+def get_narrowest_int_type(values: np.ndarray) -> int:
+    if values.size == 0:
+        return _NARROW_INT_TYPES[0][0]
+
+    min_value, max_value = values.min(), values.max()
+    for value_type, info in _NARROW_INT_TYPES:
+        if info.min <= min_value and max_value <= info.max:
+            return value_type
+    return ValueType.INT64.value
@@ -0,0 +1,67 @@
+#
+# AtriumDB is a timeseries database software designed to best handle the unique
+# features and challenges that arise from clinical waveform data.
+#
+# Copyright (c) 2025 The Hospital for Sick Children.
+#
+# This file is part of AtriumDB 
+# (see atriumdb.io).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from wal import repair_file
+from helpers.metrics import get_metric, WALWRITER_WAL_RECOVERED_FILES, WALWRITER_WAL_RECOVERED_BYTES
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def recover_wal_files(path: str, max_workers: int = None):
+    """
+    Truncates the torn tails a crash can leave at the end of WAL files back to their last complete message. This has
+    to run before any wal writer workers start since it assumes nothing has the files open.
+    """
+    start_time = time.time()
+    wal_paths = list(Path(path).glob("*.wal"))
+    if len(wal_paths) == 0:
+        return 0, 0
+
+    _LOGGER.info(f"Checking {len(wal_paths)} WAL files for partially written messages")
+
+    repaired_files, truncated_bytes = 0, 0
+    # spawn instead of fork since the metrics exporter already has threads running in this process
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for wal_path, num_bytes in zip(wal_paths, executor.map(_repair, wal_paths, chunksize=64)):
+            if num_bytes > 0:
+                _LOGGER.info(f"Truncated {num_bytes} bytes of partially written messages from {wal_path}")
+                repaired_files += 1
+                truncated_bytes += num_bytes
+
+    get_metric(WALWRITER_WAL_RECOVERED_FILES).add(repaired_files)
+    get_metric(WALWRITER_WAL_RECOVERED_BYTES).add(truncated_bytes)
+    _LOGGER.info(f"WAL recovery finished in {time.time() - start_time:.1f}s, repaired {repaired_files} of "
+                 f"{len(wal_paths)} files and truncated {truncated_bytes} bytes")
+    return repaired_files, truncated_bytes
+
+
+def _repair(wal_path: Path):
+    try:
+        return repair_file(wal_path)
+    except FileNotFoundError:
+        # the tsc generator ingested and deleted it while we were scanning
+        return 0